@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+
+# Add the repository root to the path so that we can import the training modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ml.preprocess import decode_images, preprocess_images
+
+
+def decode_images_serial(images, binary_images, requested_size):
+    """
+    The previous implementation: decodes and resizes the images one after another.
+    """
+    for i, img_data in enumerate(binary_images):
+        images[i] = preprocess_images(img_data, requested_size)
+    return images
+
+
+def time_call(fn, repeats):
+    """
+    Returns the median duration of a function call in seconds.
+    """
+    # Warm-up call that is not measured
+    fn()
+
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start_time)
+    return np.median(timings)
+
+
+def benchmark(n_images, image_size, input_size, worker_counts, chunk_size, repeats):
+    """
+    Compares the images/sec of the serial decoding loop with the parallel decoding.
+    """
+    # JPEGs of the size of the training images
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur(
+        rng.integers(0, 256, (*image_size, 3), dtype=np.uint8), (9, 9), 0
+    )
+    _, encoded = cv2.imencode(".jpg", image)
+    binary_images = np.array([encoded.tobytes()] * n_images, dtype=object)
+
+    requested_size = (input_size, input_size)
+    images = np.zeros((n_images, input_size, input_size, 3), dtype=np.uint8)
+
+    serial_time = time_call(
+        lambda: decode_images_serial(images, binary_images, requested_size), repeats
+    )
+    print(f"{'workers':>8} {'images/s':>10} {'speedup':>8}")
+    print(f"{'serial':>8} {n_images / serial_time:>10.1f} {1.0:>7.2f}x")
+
+    for workers in worker_counts:
+        parallel_time = time_call(
+            lambda: decode_images(
+                images, binary_images, requested_size, workers, chunk_size
+            ),
+            repeats,
+        )
+        print(
+            f"{workers:>8} {n_images / parallel_time:>10.1f} "
+            f"{serial_time / parallel_time:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the decoding of the training images"
+    )
+    parser.add_argument("--n-images", type=int, default=1000)
+    parser.add_argument("--image-height", type=int, default=450)
+    parser.add_argument("--image-width", type=int, default=600)
+    parser.add_argument("--input-size", type=int, default=255)
+    parser.add_argument(
+        "--workers", type=int, nargs="*", help="Thread counts of the parallel decoding"
+    )
+    parser.add_argument("--chunk-size", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else 1
+    worker_counts = args.workers or sorted({1, 2, n_cpus // 2 or 1, n_cpus})
+
+    print(
+        f"\nImage decoding benchmark ({args.n_images} JPEGs of "
+        f"{args.image_width}x{args.image_height}):"
+    )
+    print("=" * 60)
+
+    benchmark(
+        args.n_images,
+        (args.image_height, args.image_width),
+        args.input_size,
+        worker_counts,
+        args.chunk_size,
+        args.repeats,
+    )
@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+# Add the server directory to the path so that we can import the prediction modules
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+)
+
+from application.predictions.inference import CompiledPredictor
+
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64]
+
+
+def build_model(input_size):
+    """
+    Builds the same architecture as ml/train.py with random weights.
+    """
+    image_input = tf.keras.layers.Input(shape=input_size)
+    tabular_input = tf.keras.layers.Input(shape=(3,))
+    pretrained = tf.keras.applications.DenseNet169(
+        weights=None, include_top=False, input_tensor=image_input
+    )
+    x = tf.keras.layers.GlobalAveragePooling2D()(pretrained.output)
+    x = tf.keras.layers.Dense(256, activation="relu")(x)
+    y = tf.keras.layers.Dense(128, activation="relu")(tabular_input)
+    y = tf.keras.layers.Dense(64, activation="relu")(y)
+    z = tf.keras.layers.concatenate([x, y])
+    z = tf.keras.layers.Dense(256, activation="relu")(z)
+    output = tf.keras.layers.Dense(7, activation="softmax")(z)
+    return tf.keras.models.Model(inputs=[image_input, tabular_input], outputs=output)
+
+
+def time_call(fn, repeats):
+    """
+    Returns the median latency of a function call in milliseconds.
+    """
+    # Warm-up call that is not measured
+    fn()
+
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return np.median(timings)
+
+
+def benchmark(input_size, repeats):
+    """
+    Compares the latency of model.predict with the compiled predictor for batch sizes 1-64.
+    """
+    model = build_model(input_size)
+
+    # Tracing happens once per bucket when the predictor is created
+    start_time = time.perf_counter()
+    predictor = CompiledPredictor(model)
+    print(f"Compiled predictor traced in {time.perf_counter() - start_time:.2f} s")
+
+    print(f"{'batch':>6} {'predict (ms)':>14} {'compiled (ms)':>14} {'speedup':>8}")
+    for batch_size in BATCH_SIZES:
+        images = np.random.uniform(-1, 1, (batch_size, *input_size)).astype(np.float16)
+        tabular = np.random.normal(size=(batch_size, 3))
+
+        predict_time = time_call(
+            lambda: model.predict([images.astype(np.float32), tabular], verbose=0),
+            repeats,
+        )
+        compiled_time = time_call(lambda: predictor.predict(images, tabular), repeats)
+
+        print(
+            f"{batch_size:>6} {predict_time:>14.1f} {compiled_time:>14.1f} {predict_time / compiled_time:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark model.predict against the compiled inference path"
+    )
+    parser.add_argument("--input-size", type=int, default=224)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    print("\nInference latency benchmark:")
+    print("=" * 60)
+
+    benchmark((args.input_size, args.input_size, 3), args.repeats)
@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+
+# Add the server directory to the path so that we can import the prediction modules
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+)
+
+from application.predictions.preprocess_user_data import preprocess_images
+
+
+def preprocess_images_serial(image_list, target_input_shape):
+    """
+    The previous implementation: resizes the images one after another and
+    normalizes them through a float64 intermediate.
+    """
+    preprocessed_images = []
+    for image in image_list:
+        if image.shape[-1] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
+        resized_image = cv2.resize(
+            image, target_input_shape, interpolation=cv2.INTER_AREA
+        )
+        preprocessed_images.append(resized_image / 127.5 - 1.0)
+    return np.array(preprocessed_images, dtype=np.float16)
+
+
+def time_call(fn, repeats):
+    """
+    Returns the median latency of a function call in milliseconds.
+    """
+    # Warm-up call that is not measured
+    fn()
+
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return np.median(timings)
+
+
+def benchmark(batch_size, image_size, input_size, repeats):
+    """
+    Compares the serial preprocessing loop with the parallel batch preprocessing.
+    """
+    # Phone camera sized uploads
+    images = [
+        np.random.randint(0, 256, (*image_size, 3), dtype=np.uint8)
+        for _ in range(batch_size)
+    ]
+    target_input_shape = (input_size, input_size)
+
+    serial_time = time_call(
+        lambda: preprocess_images_serial(images, target_input_shape), repeats
+    )
+    parallel_time = time_call(
+        lambda: preprocess_images(images, target_input_shape), repeats
+    )
+
+    print(f"{'serial (ms)':>14} {'parallel (ms)':>14} {'speedup':>8}")
+    print(
+        f"{serial_time:>14.1f} {parallel_time:>14.1f} {serial_time / parallel_time:>7.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the preprocessing of a prediction batch"
+    )
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--image-height", type=int, default=3024)
+    parser.add_argument("--image-width", type=int, default=4032)
+    parser.add_argument("--input-size", type=int, default=224)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(
+        f"\nPreprocessing benchmark ({args.batch_size} images of "
+        f"{args.image_width}x{args.image_height}):"
+    )
+    print("=" * 60)
+
+    benchmark(
+        args.batch_size,
+        (args.image_height, args.image_width),
+        args.input_size,
+        args.repeats,
+    )
@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import subprocess
+import multiprocessing
+import numpy as np
+
+# Add the server directory to the path so that we can import the prediction modules
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+)
+
+
+def training_load(affinity, niceness):
+    """
+    Simulates a training process that competes for the CPUs. It runs in its own
+    process, as the TensorFlow thread pools are shared by all threads of a process.
+    """
+    from application.predictions.resources import (
+        set_thread_affinity,
+        lower_thread_priority,
+    )
+
+    # Set before the first operation, so that the TensorFlow pools inherit them
+    set_thread_affinity(affinity)
+    lower_thread_priority(niceness)
+
+    import tensorflow as tf
+
+    a = tf.random.normal((512, 512))
+    while True:
+        tf.linalg.matmul(a, a).numpy()
+
+
+def run_configuration(args):
+    """
+    Runs the prediction loop with one thread configuration and prints its latency
+    and throughput as JSON. The thread pools of TensorFlow can only be sized before
+    its first operation, so every configuration runs in a new process.
+    """
+    from application.predictions.resources import (
+        configure_tensorflow_threads,
+        set_thread_affinity,
+    )
+    from application.predictions.preprocess_user_data import (
+        configure_preprocess_pool,
+        preprocess_images,
+    )
+
+    configure_tensorflow_threads(args.intra_op, args.inter_op)
+    configure_preprocess_pool(args.preprocess_threads)
+    set_thread_affinity(args.affinity)
+
+    from application.predictions.inference import CompiledPredictor
+    from benchmark_inference import build_model
+
+    input_size = (args.input_size, args.input_size, 3)
+    predictor = CompiledPredictor(build_model(input_size))
+
+    # Queued jobs hold uint8 images that are already resized to the model input
+    images = [
+        np.random.randint(0, 256, input_size, dtype=np.uint8)
+        for _ in range(args.batch_size)
+    ]
+    tabular = np.random.normal(size=(args.batch_size, 3))
+
+    # Simulate a concurrent training process that competes for the CPUs
+    training_process = None
+    if args.training_load:
+        training_process = multiprocessing.get_context("spawn").Process(
+            target=training_load,
+            args=(args.training_affinity, args.training_niceness),
+            daemon=True,
+        )
+        training_process.start()
+
+    # Warm-up batch that is not measured
+    predictor.predict(preprocess_images(images, input_size[:2]), tabular)
+
+    latencies = []
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < args.duration:
+        batch_start = time.perf_counter()
+        predictor.predict(preprocess_images(images, input_size[:2]), tabular)
+        latencies.append(time.perf_counter() - batch_start)
+    elapsed = time.perf_counter() - start_time
+    if training_process is not None:
+        training_process.terminate()
+
+    print(
+        json.dumps(
+            {
+                "p50": float(np.percentile(latencies, 50)) * 1000,
+                "p99": float(np.percentile(latencies, 99)) * 1000,
+                "throughput": len(latencies) * args.batch_size / elapsed,
+            }
+        )
+    )
+
+
+def sweep(args):
+    """
+    Runs the prediction loop for every combination of the thread settings.
+    """
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else 1
+    intra_op_values = args.intra_op_values or sorted({1, 2, n_cpus // 2 or 1, n_cpus})
+    inter_op_values = args.inter_op_values or [1, 2]
+    affinities = args.affinities or [None]
+
+    print(
+        f"{'intra':>6} {'inter':>6} {'affinity':>10} {'p50 (ms)':>10} "
+        f"{'p99 (ms)':>10} {'samples/s':>10}"
+    )
+    for intra_op, inter_op, affinity in itertools.product(
+        intra_op_values, inter_op_values, affinities
+    ):
+        command = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--run",
+            "--intra-op",
+            str(intra_op),
+            "--inter-op",
+            str(inter_op),
+            "--input-size",
+            str(args.input_size),
+            "--batch-size",
+            str(args.batch_size),
+            "--duration",
+            str(args.duration),
+            "--training-niceness",
+            str(args.training_niceness),
+        ]
+        if affinity:
+            command += ["--affinity", affinity]
+        if args.preprocess_threads:
+            command += ["--preprocess-threads", str(args.preprocess_threads)]
+        if args.training_load:
+            command += ["--training-load"]
+        if args.training_affinity:
+            command += ["--training-affinity", args.training_affinity]
+
+        output = subprocess.run(
+            command, capture_output=True, text=True, env={**os.environ}
+        )
+        try:
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+        except (IndexError, json.JSONDecodeError):
+            print(f"Configuration failed:\n{output.stderr[-2000:]}")
+            continue
+
+        print(
+            f"{intra_op:>6} {inter_op:>6} {affinity or 'all':>10} "
+            f"{result['p50']:>10.1f} {result['p99']:>10.1f} "
+            f"{result['throughput']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Sweep the thread settings of the prediction loop and report "
+        "its batch latency (p50/p99) and throughput"
+    )
+    parser.add_argument("--input-size", type=int, default=224)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument(
+        "--intra-op-values", type=int, nargs="*", help="Intra-op thread counts to sweep"
+    )
+    parser.add_argument(
+        "--inter-op-values", type=int, nargs="*", help="Inter-op thread counts to sweep"
+    )
+    parser.add_argument(
+        "--affinities",
+        nargs="*",
+        help='CPU lists of the prediction thread to sweep, e.g. "0-3" "0-7"',
+    )
+    parser.add_argument("--preprocess-threads", type=int)
+    parser.add_argument(
+        "--training-load",
+        action="store_true",
+        help="Run a concurrent training-like load next to the prediction loop",
+    )
+    parser.add_argument("--training-affinity")
+    parser.add_argument("--training-niceness", type=int, default=10)
+    # Options of a single configuration (used by the sweep)
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--intra-op", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--inter-op", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--affinity", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_configuration(args)
+    else:
+        print("\nPrediction loop thread settings benchmark:")
+        print("=" * 60)
+        sweep(args)
@@ -2,9 +2,248 @@
 # * Contributor: <alexandersafstrom@proton.me>
 # * Contributor: <elindstr@student.chalmers.se>
 import os
+import json
+import time
 import pickle
 import gc
-from .preprocess import clean_data, load_data, feature_preprocessing
+import sqlite3
+import warnings
+import numpy as np
+import pandas as pd
+from .preprocess import (
+    clean_data,
+    load_data,
+    load_row_ids,
+    feature_preprocessing,
+    decode_images,
+    encode_features,
+)
+
+# Version of the image cache format, caches of other versions are rebuilt
+# 2: raw uint8 pixels instead of normalized float16 pixels
+# 3: the image_ids and created_at high-water mark of the rows, for incremental updates
+IMAGE_CACHE_VERSION = 3
+
+
+def read_image_cache_metadata(metadata_path):
+    """Returns the metadata sidecar of an image cache, or None if it does not exist."""
+    try:
+        with open(metadata_path, "r") as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if metadata.get("version") != IMAGE_CACHE_VERSION:
+        return None
+    return metadata
+
+
+def write_image_cache_metadata(
+    metadata_path, images, requested_size, start_row, row_limit, row_ids
+):
+    """
+    Writes the metadata sidecar of an image cache. The sidecar is written last,
+    so a cache without one is incomplete and is rebuilt.
+
+    `row_ids` holds the image_id and created_at of every row that the cache was built
+    from, including the rows that were dropped by the cleaning.
+    """
+    metadata = {
+        "version": IMAGE_CACHE_VERSION,
+        "shape": list(images.shape),
+        "dtype": str(images.dtype),
+        "requested_size": list(requested_size),
+        # Range of database rows that the cache was built from
+        "start_row": start_row,
+        "row_limit": row_limit,
+        # Rows that the cache was built from, in the order of the database, and the
+        # newest of them. Rows after them or created later are added incrementally
+        "image_ids": row_ids["image_id"].astype(str).tolist(),
+        "max_created_at": int(row_ids["created_at"].max()) if len(row_ids) else 0,
+        "created_at": int(time.time()),
+    }
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f)
+
+
+def covers_rows(metadata, requested_size, start_row, row_limit):
+    """Returns True if a cache was built from the requested rows at the requested size."""
+    if metadata is None or tuple(metadata["requested_size"]) != tuple(requested_size):
+        return False
+
+    # The requested rows must lie within the cached rows
+    if start_row < metadata["start_row"]:
+        return False
+    if metadata["row_limit"] is None:
+        return True
+    if row_limit is None:
+        return False
+    return start_row + row_limit <= metadata["start_row"] + metadata["row_limit"]
+
+
+def select_rows(processed_data, images, start_row=0, row_limit=None):
+    """
+    Returns the cached samples of the database rows [start_row, start_row + row_limit).
+
+    The processed data is indexed by the database row of every sample (see
+    `query_db_or_cache`), and the samples are in the order of their rows. The
+    selected images are a slice of the memory-mapped array, so nothing is copied.
+    """
+    rows = processed_data.index.to_numpy()
+    first = np.searchsorted(rows, start_row)
+    last = np.searchsorted(rows, start_row + row_limit) if row_limit else len(rows)
+    return processed_data.iloc[first:last], images[first:last]
+
+
+def load_cached_data(
+    processed_data_path,
+    lesion_encoder_path,
+    localization_encoder_path,
+    images_path,
+    start_row=0,
+    row_limit=None,
+):
+    """
+    Loads the cached tabular data and encoders, and opens the cached images as a
+    read-only memory map. Only the pages of the images that are used are read
+    from the disk, and the OS page cache keeps them for the next training run.
+    """
+    with open(processed_data_path, "rb") as f:
+        processed_data = pickle.load(f)
+    with open(lesion_encoder_path, "rb") as f:
+        lesion_type_encoder = pickle.load(f)
+    with open(localization_encoder_path, "rb") as f:
+        localization_encoder = pickle.load(f)
+    images = np.load(images_path, mmap_mode="r")
+
+    processed_data, images = select_rows(processed_data, images, start_row, row_limit)
+    return processed_data, lesion_type_encoder, localization_encoder, images
+
+
+def first_changed_row(metadata, row_ids):
+    """
+    Returns the position of the first database row that differs from the rows that a
+    cache was built from, i.e. a row that was added, replaced, removed or created
+    after the high-water mark. The rows before it are still valid in the cache.
+    """
+    cached_ids = metadata["image_ids"]
+    n = min(len(cached_ids), len(row_ids))
+    unchanged = (
+        row_ids["image_id"].astype(str).to_numpy()[:n]
+        == np.array(cached_ids[:n], dtype=object)
+    ) & (row_ids["created_at"].to_numpy()[:n] <= metadata["max_created_at"])
+    return n if unchanged.all() else int(np.argmin(unchanged))
+
+
+def update_cached_data(
+    db_path,
+    table_name,
+    processed_data_path,
+    lesion_encoder_path,
+    localization_encoder_path,
+    images_path,
+    images_metadata_path,
+    metadata,
+    preprocess_workers=None,
+):
+    """
+    Brings a cache that was built from all rows after its start row up to date with
+    the database. Only the rows from the first changed row on (usually the rows that
+    were added since, e.g. by AddData) are loaded and preprocessed, and are appended
+    to the cached rows before them.
+
+    The cached images are copied into a new file that replaces the cache once it is
+    complete, so that arrays that still map the previous cache stay valid.
+
+    Returns:
+        tuple: The processed data, encoders and images like `query_db_or_cache`, or
+            None if the cache has to be rebuilt, e.g. because the new rows change
+            the encoders.
+    """
+    cache_start = metadata["start_row"]
+    row_ids = load_row_ids(db_path, table_name, start_row=cache_start)
+    first_changed = first_changed_row(metadata, row_ids)
+
+    processed_data, lesion_type_encoder, localization_encoder, images = (
+        load_cached_data(
+            processed_data_path,
+            lesion_encoder_path,
+            localization_encoder_path,
+            images_path,
+        )
+    )
+    if first_changed == len(row_ids) == len(metadata["image_ids"]):
+        print("Cached data is up to date")
+        return processed_data, lesion_type_encoder, localization_encoder, images
+    if first_changed == 0:
+        return None
+
+    print(f"Loading {len(row_ids) - first_changed} new or changed rows...")
+    new_data = load_data(
+        db_path=db_path, table_name=table_name, start_row=cache_start + first_changed
+    )
+    new_data.index += cache_start + first_changed
+    new_data = clean_data(new_data)
+
+    # Keep the samples of the rows before the first changed row
+    n_kept = int(np.searchsorted(processed_data.index, cache_start + first_changed))
+    kept_data = processed_data.iloc[:n_kept]
+
+    # New classes (or classes that only the replaced rows had) change the encoders,
+    # which changes the labels of all cached rows
+    for column, encoder in [
+        ("localization", localization_encoder),
+        ("lesion_type", lesion_type_encoder),
+    ]:
+        classes = set(encoder.inverse_transform(kept_data[column].unique()))
+        classes.update(new_data[column].unique())
+        if classes != set(encoder.classes_):
+            print(f"The {column} classes have changed")
+            return None
+
+    # Copy the kept images and decode the new images after them
+    print("Processing new images...")
+    updated_images = np.lib.format.open_memmap(
+        f"{images_path}.tmp",
+        mode="w+",
+        dtype=images.dtype,
+        shape=(n_kept + len(new_data),) + images.shape[1:],
+    )
+    for start in range(0, n_kept, 1024):
+        end = min(start + 1024, n_kept)
+        updated_images[start:end] = images[start:end]
+    decode_images(
+        updated_images[n_kept:],
+        new_data["image"].to_numpy(),
+        tuple(metadata["requested_size"]),
+        preprocess_workers,
+    )
+    del images
+
+    new_data = new_data.drop(columns=["image_id", "image"])
+    new_data, _, _ = encode_features(
+        new_data, lesion_type_encoder, localization_encoder
+    )
+    processed_data = pd.concat([kept_data, new_data])
+
+    print("Saving processed data to cache...")
+    os.remove(images_metadata_path)
+    with open(processed_data_path, "wb") as f:
+        pickle.dump(processed_data, f)
+    updated_images.flush()
+    os.replace(f"{images_path}.tmp", images_path)
+    write_image_cache_metadata(
+        images_metadata_path,
+        updated_images,
+        metadata["requested_size"],
+        cache_start,
+        None,
+        row_ids,
+    )
+    print("Data cache updated successfully")
+
+    images = np.load(images_path, mmap_mode="r")
+    return processed_data, lesion_type_encoder, localization_encoder, images
 
 
 def query_db_or_cache(
@@ -19,8 +258,10 @@ def query_db_or_cache(
     tabular_features="tabular_data.pkl",
     lesion_encoder="lesion_type_encoder.pkl",
     localization_encoder_fname="localization_encoder.pkl",
-    images="images.pkl",
+    images="images.npy",
+    images_metadata="images.json",
     requested_size=(224, 224),
+    preprocess_workers=None,
 ):
     # We need to know where this script is located
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -36,6 +277,7 @@ def query_db_or_cache(
         script_dir, cache_dir, localization_encoder_fname
     )
     IMAGES_PATH = os.path.join(script_dir, cache_dir, images)
+    IMAGES_METADATA_PATH = os.path.join(script_dir, cache_dir, images_metadata)
 
     # Define test data paths
     test_data_dir = os.path.join(script_dir, test_data_dir)
@@ -45,49 +287,92 @@ def query_db_or_cache(
         script_dir, test_data_dir, localization_encoder_fname
     )
     TEST_IMAGES_PATH = os.path.join(script_dir, test_data_dir, images)
+    TEST_IMAGES_METADATA_PATH = os.path.join(script_dir, test_data_dir, images_metadata)
 
     # Update the db_name to be relative to the script location
     db_name = os.path.join(script_dir, db_name)
 
-    # Try to load cached data (if it exists) and this is not a test run
-    if (
-        not clear_cache
-        and not test
-        and os.path.exists(PROCESSED_DATA_PATH)
-        and os.path.exists(LESION_ENCODER_PATH)
-        and os.path.exists(LOCALIZATION_ENCODER_PATH)
-    ):
-        print("Loading cached processed data...")
-        with open(PROCESSED_DATA_PATH, "rb") as f:
-            processed_data = pickle.load(f)
-        with open(LESION_ENCODER_PATH, "rb") as f:
-            lesion_type_encoder = pickle.load(f)
-        with open(LOCALIZATION_ENCODER_PATH, "rb") as f:
-            localization_encoder = pickle.load(f)
-        with open(IMAGES_PATH, "rb") as f:
-            images = pickle.load(f)
-        print("Cached data loaded successfully")
-        return processed_data, lesion_type_encoder, localization_encoder, images
+    # Paths of the cache of this run
+    if test:
+        processed_data_path = TEST_PROCESSED_DATA_PATH
+        lesion_encoder_path = TEST_LESION_ENCODER_PATH
+        localization_encoder_path = TEST_LOCALIZATION_ENCODER_PATH
+        images_path = TEST_IMAGES_PATH
+        images_metadata_path = TEST_IMAGES_METADATA_PATH
+    else:
+        processed_data_path = PROCESSED_DATA_PATH
+        lesion_encoder_path = LESION_ENCODER_PATH
+        localization_encoder_path = LOCALIZATION_ENCODER_PATH
+        images_path = IMAGES_PATH
+        images_metadata_path = IMAGES_METADATA_PATH
 
-    # Try to load cached test data (if it exists) and this is a test run
-    if (
+    # Try to load cached data (if it exists) or cached test data if this is a test run
+    metadata = read_image_cache_metadata(images_metadata_path)
+    cache_exists = (
         not clear_cache
-        and test
-        and os.path.exists(TEST_PROCESSED_DATA_PATH)
-        and os.path.exists(TEST_LESION_ENCODER_PATH)
-        and os.path.exists(TEST_LOCALIZATION_ENCODER_PATH)
+        and metadata is not None
+        and os.path.exists(processed_data_path)
+        and os.path.exists(lesion_encoder_path)
+        and os.path.exists(localization_encoder_path)
+    )
+    # A cache of all rows after its start row is brought up to date with the rows
+    # that were added to the database since, instead of being rebuilt
+    if (
+        cache_exists
+        and metadata["row_limit"] is None
+        and tuple(metadata["requested_size"]) == tuple(requested_size)
+        and start_row >= metadata["start_row"]
     ):
-        print("Loading cached test data...")
-        with open(TEST_PROCESSED_DATA_PATH, "rb") as f:
-            processed_data = pickle.load(f)
-        with open(TEST_LESION_ENCODER_PATH, "rb") as f:
-            lesion_type_encoder = pickle.load(f)
-        with open(TEST_LOCALIZATION_ENCODER_PATH, "rb") as f:
-            localization_encoder = pickle.load(f)
-        with open(TEST_IMAGES_PATH, "rb") as f:
-            images = pickle.load(f)
-        print("Cached test data loaded successfully")
-        return processed_data, lesion_type_encoder, localization_encoder, images
+        print("Updating cached test data..." if test else "Updating cached data...")
+        try:
+            cached_data = update_cached_data(
+                db_name,
+                images_table_name,
+                processed_data_path,
+                lesion_encoder_path,
+                localization_encoder_path,
+                images_path,
+                images_metadata_path,
+                metadata,
+                preprocess_workers,
+            )
+        except (sqlite3.Error, pd.errors.DatabaseError) as e:
+            # Without the database the cache is used as it is
+            warnings.warn(f"Failed to update the cached data: {e}", UserWarning)
+            cached_data = load_cached_data(
+                processed_data_path,
+                lesion_encoder_path,
+                localization_encoder_path,
+                images_path,
+            )
+        if cached_data is not None:
+            processed_data, lesion_type_encoder, localization_encoder, images = (
+                cached_data
+            )
+            processed_data, images = select_rows(
+                processed_data, images, start_row, row_limit
+            )
+            return processed_data, lesion_type_encoder, localization_encoder, images
+    elif cache_exists and covers_rows(metadata, requested_size, start_row, row_limit):
+        print(
+            "Loading cached test data..."
+            if test
+            else "Loading cached processed data..."
+        )
+        cached_data = load_cached_data(
+            processed_data_path,
+            lesion_encoder_path,
+            localization_encoder_path,
+            images_path,
+            start_row,
+            row_limit,
+        )
+        print(
+            "Cached test data loaded successfully"
+            if test
+            else "Cached data loaded successfully"
+        )
+        return cached_data
 
     # If the data is not cached, we must load and process it
 
@@ -99,6 +384,13 @@ def query_db_or_cache(
         row_limit=row_limit,
         start_row=start_row,
     )
+
+    # Index the samples by their database row, so that row ranges can be
+    # selected from the cache later
+    image_data_df.index += start_row
+    # Rows that the cache is built from, including the rows that are cleaned out
+    row_ids = image_data_df[["image_id", "created_at"]].copy()
+
     print("Cleaning data...")
 
     # Clean the data from duplicates and missing values
@@ -108,10 +400,18 @@ def query_db_or_cache(
     del image_data_df
     gc.collect()
 
+    # Invalidate the previous image cache before it is overwritten
+    if os.path.exists(images_metadata_path):
+        os.remove(images_metadata_path)
+
     print("Processing features...")
-    # Process the data
+    # Process the data, the images are written straight into a memory-mapped file.
+    # The file replaces the cached images once it is complete, so that arrays that
+    # still map the previous cache are not truncated
     processed_data, lesion_type_encoder, localization_encoder, images = (
-        feature_preprocessing(cleaned_data, requested_size)
+        feature_preprocessing(
+            cleaned_data, requested_size, f"{images_path}.tmp", preprocess_workers
+        )
     )
 
     # Drop the cleaned_data DataFrame to free up memory
@@ -120,26 +420,19 @@ def query_db_or_cache(
 
     # Cache the processed data
     print("Saving processed data to cache...")
-    if test:
-        with open(TEST_PROCESSED_DATA_PATH, "wb") as f:
-            pickle.dump(processed_data, f)
-        with open(TEST_LESION_ENCODER_PATH, "wb") as f:
-            pickle.dump(lesion_type_encoder, f)
-        with open(TEST_LOCALIZATION_ENCODER_PATH, "wb") as f:
-            pickle.dump(localization_encoder, f)
-        with open(TEST_IMAGES_PATH, "wb") as f:
-            pickle.dump(images, f)
-        print("Test data cached successfully")
-        return processed_data, lesion_type_encoder, localization_encoder, images
-
-    # Cache the processed data (non-test)
-    with open(PROCESSED_DATA_PATH, "wb") as f:
+    with open(processed_data_path, "wb") as f:
         pickle.dump(processed_data, f)
-    with open(LESION_ENCODER_PATH, "wb") as f:
+    with open(lesion_encoder_path, "wb") as f:
         pickle.dump(lesion_type_encoder, f)
-    with open(LOCALIZATION_ENCODER_PATH, "wb") as f:
+    with open(localization_encoder_path, "wb") as f:
         pickle.dump(localization_encoder, f)
-    with open(IMAGES_PATH, "wb") as f:
-        pickle.dump(images, f)
-    print("Data cached successfully")
+    images.flush()
+    os.replace(f"{images_path}.tmp", images_path)
+    write_image_cache_metadata(
+        images_metadata_path, images, requested_size, start_row, row_limit, row_ids
+    )
+    print("Test data cached successfully" if test else "Data cached successfully")
+
+    # Reopen the images read-only, like a cached run
+    images = np.load(images_path, mmap_mode="r")
     return processed_data, lesion_type_encoder, localization_encoder, images
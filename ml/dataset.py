@@ -0,0 +1,116 @@
+import numpy as np
+import tensorflow as tf
+from sklearn.model_selection import train_test_split
+
+
+def split_indices(labels, test_size, random_state, stratify=True):
+    """
+    Splits the samples into a train and a validation set by their indices only, so
+    the images are not copied. The split is stratified by the labels.
+
+    Returns:
+        tuple: The sorted sample indices of the train and validation sets.
+    """
+    indices = np.arange(len(labels))
+    train_indices, val_indices = train_test_split(
+        indices,
+        test_size=test_size,
+        random_state=random_state,
+        stratify=labels if stratify else None,
+        shuffle=True,
+    )
+    # Sorted indices read the memory-mapped images sequentially
+    return np.sort(train_indices), np.sort(val_indices)
+
+
+def make_dataset(
+    images,
+    tabular_features,
+    labels,
+    indices,
+    batch_size,
+    shuffle=False,
+    shuffle_buffer=1024,
+    seed=None,
+    cache=None,
+    read_chunk_size=256,
+):
+    """
+    Creates a dataset that streams the samples at the given indices from the
+    (memory-mapped) images, and yields batches of ((images, tabular features), labels).
+    Only the batches that are being prepared are held in memory.
+
+    The batches are gathered in parallel (`num_parallel_calls`) and prefetched, so
+    reading from the cache overlaps with training. Without caching, the indices are
+    shuffled over the whole set every epoch, which is cheap as no images are moved.
+
+    Args:
+        images (np.ndarray): The images of all samples, usually a memory map of the cache.
+        tabular_features (np.ndarray): The tabular features of all samples.
+        labels (np.ndarray): The one-hot encoded labels of all samples.
+        indices (np.ndarray): The indices of the samples of the dataset.
+        batch_size (int): The batch size, None puts all samples into a single batch.
+        shuffle (bool): Whether to reshuffle the samples every epoch.
+        shuffle_buffer (int): Number of samples that are shuffled at a time when caching.
+        seed (int): The seed of the shuffling.
+        cache (str): Caches the samples after the first epoch in memory ("") or in
+            the given file. The samples are then shuffled within the shuffle buffer.
+        read_chunk_size (int): Number of samples that are read at a time when caching.
+
+    Returns:
+        tf.data.Dataset: The dataset.
+    """
+    batch_size = batch_size or len(indices)
+    image_shape = images.shape[1:]
+    image_dtype = tf.as_dtype(images.dtype)
+    tabular_features = np.asarray(tabular_features, dtype=np.float32)
+    labels = np.asarray(labels, dtype=np.float32)
+
+    def gather(batch_indices):
+        # The order within a batch does not matter for training, and reading
+        # the rows in order is faster for a memory map
+        batch_indices = np.sort(batch_indices)
+        return (
+            images[batch_indices],
+            tabular_features[batch_indices],
+            labels[batch_indices],
+        )
+
+    def load_batch(batch_indices):
+        batch_images, batch_tabular, batch_labels = tf.numpy_function(
+            gather,
+            [batch_indices],
+            [image_dtype, tf.float32, tf.float32],
+            stateful=False,
+        )
+        batch_images.set_shape((None,) + tuple(image_shape))
+        batch_tabular.set_shape((None, tabular_features.shape[1]))
+        batch_labels.set_shape((None, labels.shape[1]))
+        return (batch_images, batch_tabular), batch_labels
+
+    dataset = tf.data.Dataset.from_tensor_slices(np.asarray(indices, dtype=np.int64))
+
+    if cache is not None:
+        # Read the samples once in the order of the indices, and shuffle the
+        # cached samples instead of the indices
+        dataset = dataset.batch(read_chunk_size)
+        dataset = dataset.map(
+            load_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True
+        )
+        dataset = dataset.unbatch().cache(cache)
+        if shuffle:
+            dataset = dataset.shuffle(
+                shuffle_buffer, seed=seed, reshuffle_each_iteration=True
+            )
+        dataset = dataset.batch(batch_size)
+    else:
+        if shuffle:
+            dataset = dataset.shuffle(
+                len(indices), seed=seed, reshuffle_each_iteration=True
+            )
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(
+            load_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle
+        )
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
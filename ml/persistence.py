@@ -5,6 +5,7 @@
 import sqlite3
 import os
 import json
+import warnings
 from datetime import datetime
 import numpy as np
 import base64
@@ -41,6 +42,49 @@ def deserialize_weights(serialized_weights):
     return weights
 
 
+def export_onnx(model, opset=13):
+    """
+    Exports a model with an image and a tabular input to ONNX.
+
+    The export requires the optional tf2onnx package (see requirements-onnx.txt).
+    The model is traced through a tf.function with a fixed signature, which works
+    with Keras 3 models.
+
+    Returns:
+        bytes: The serialized ONNX model, or None if the model could not be exported.
+    """
+
+    try:
+        import tf2onnx
+    except ImportError:
+        warnings.warn(
+            "tf2onnx is not installed, the model is not exported to ONNX",
+            category=UserWarning,
+        )
+        return None
+
+    try:
+        # Keep the batch dimension dynamic, so any batch size can be served
+        input_signature = [
+            tf.TensorSpec((None, *shape[1:]), tf.float32, name=name)
+            for shape, name in zip(model.input_shape, ("image_input", "tabular_input"))
+        ]
+
+        @tf.function(input_signature=input_signature)
+        def serve(image_input, tabular_input):
+            return {
+                "probabilities": model([image_input, tabular_input], training=False)
+            }
+
+        model_proto, _ = tf2onnx.convert.from_function(
+            serve, input_signature=input_signature, opset=opset
+        )
+        return model_proto.SerializeToString()
+    except Exception as e:
+        warnings.warn(f"Failed to export the model to ONNX: {e}", category=UserWarning)
+        return None
+
+
 def save_model(
     db_path,
     app_table_name,
@@ -57,11 +101,16 @@ def save_model(
     lesion_type_encoder,
     localization_encoder,
     custom_recall,
+    grad_cam_layer=None,
+    input_normalization=None,
 ):
     try:
         # Serialize weights layer by layer
         serialized_weights = serialize_weights(model.get_weights())
 
+        # Export the model for serving with ONNX Runtime (None if not possible)
+        onnx_model = export_onnx(model)
+
         # Serialize and encode the scaler
         pickled_scaler = pickle.dumps(tabular_scaler)
         encoded_scaler = base64.b64encode(pickled_scaler).decode("utf-8")
@@ -93,6 +142,15 @@ def save_model(
             "custom_recall": float(custom_recall),
         }
 
+        # Store the layer used for Grad-CAM explanations of this model
+        if grad_cam_layer is not None:
+            hyperparameters["grad_cam_layer"] = grad_cam_layer
+
+        # "model" if the model takes raw pixels (0-255) and normalizes them itself,
+        # models without it take pixels that are normalized to the [-1, 1] range
+        if input_normalization is not None:
+            hyperparameters["input_normalization"] = input_normalization
+
         # Convert hyperparameters to JSON string
         hyperparameters_json = json.dumps(hyperparameters)
 
@@ -106,10 +164,10 @@ def save_model(
         # Insert model data
         cursor.execute(
             f"""
-            INSERT INTO {app_table_name} (created_at, weights, hyperparameters)
-            VALUES (?, ?, ?)
+            INSERT INTO {app_table_name} (created_at, weights, hyperparameters, onnx_model)
+            VALUES (?, ?, ?, ?)
         """,
-            (created_at, serialized_weights, hyperparameters_json),
+            (created_at, serialized_weights, hyperparameters_json, onnx_model),
         )
 
         # Commit changes and close connection
@@ -121,12 +179,14 @@ def save_model(
         raise
 
 
-def load_active_model_from_db(db_path):
+def load_active_model_from_db(conn):
     """
     Loads the active model from database with improved weight deserialization
+
+    The connection is opened by the caller, e.g. the server connects to the
+    database configured for Django.
     """
     try:
-        conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
 
         cursor.execute(
@@ -164,10 +224,47 @@ def load_active_model_from_db(db_path):
         # Set the model's weights
         model.set_weights(weights)
 
-        conn.close()
-
         return model, hyperparameters, model_version
 
     except Exception as e:
         print(f"Error loading model: {str(e)}")
         raise
+
+
+def load_onnx_model_from_db(conn, model_version):
+    """
+    Loads the ONNX export of a model version.
+
+    Returns:
+        bytes: The serialized ONNX model, or None if the version was not exported.
+    """
+
+    row = conn.execute(
+        "SELECT onnx_model FROM models WHERE version = ?", (model_version,)
+    ).fetchone()
+
+    return bytes(row[0]) if row is not None and row[0] is not None else None
+
+
+def store_inference_backend_check(conn, model_version, backend, check):
+    """
+    Stores the accuracy-drift check of an inference backend (e.g. a quantized
+    conversion) of a model in the hyperparameters of its version.
+    """
+
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT hyperparameters FROM models WHERE version = ?", (model_version,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError(f"Model version {model_version} does not exist")
+
+        hyperparameters = json.loads(row[0])
+        hyperparameters.setdefault("inference_backends", {})[backend] = check
+
+        cursor.execute(
+            "UPDATE models SET hyperparameters = ? WHERE version = ?",
+            (json.dumps(hyperparameters), model_version),
+        )
@@ -63,23 +63,24 @@ def validate_preprocessed_data(tabular_features_scaled, labels_cat, num_classes)
     print("> MLTEST OK: Preprocessed data validation passed :)")
 
 
-def validate_split_data(X_img_train, X_img_val, X_tab_train, X_tab_val, y_train, y_val):
-    # Ensure the lengths of the training and validation sets are equal
-    assert (
-        len(X_img_train) == len(X_tab_train) == len(y_train)
-    ), "Training set size mismatch"
-    assert (
-        len(X_img_val) == len(X_tab_val) == len(y_val)
-    ), "Validation set size mismatch"
-    # Check for NaN values
+def validate_split_indices(train_indices, val_indices, tabular_features):
+    # Ensure both sets contain samples
+    assert len(train_indices) > 0, "Training set is empty"
+    assert len(val_indices) > 0, "Validation set is empty"
+    # Ensure no sample is in both sets and every sample is in one of them
+    assert not np.intersect1d(
+        train_indices, val_indices
+    ).size, "Training and validation sets overlap"
+    assert len(train_indices) + len(val_indices) == len(
+        tabular_features
+    ), "Split set size mismatch"
+    # Check for NaN values, the images are raw pixels which cannot be NaN
     assert not np.isnan(
-        X_tab_train
+        tabular_features[train_indices]
     ).any(), "Training tabular features contain NaN values"
     assert not np.isnan(
-        X_tab_val
+        tabular_features[val_indices]
     ).any(), "Validation tabular features contain NaN values"
-    assert not np.isnan(X_img_train).any(), "Training images contain NaN values"
-    assert not np.isnan(X_img_val).any(), "Validation images contain NaN values"
     print("> MLTEST OK: Split data validation passed :)")
 
 
@@ -6,7 +6,6 @@ import numpy as np
 import matplotlib
 import gc
 from sklearn.utils import class_weight
-from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 from tensorflow.keras.models import Model
 from tensorflow.keras.layers import (
@@ -15,6 +14,7 @@ from tensorflow.keras.layers import (
     Dropout,
     concatenate,
     GlobalAveragePooling2D,
+    Rescaling,
 )
 from tensorflow.keras.utils import to_categorical
 from tensorflow.keras.metrics import Recall, Precision
@@ -24,12 +24,13 @@ from tensorflow.keras.losses import categorical_crossentropy
 
 # Custom modules
 from .cache import query_db_or_cache
+from .dataset import split_indices, make_dataset
 from .plot import plot
 from .persistence import save_model
 from .tests import (
     validate_input_data,
     validate_preprocessed_data,
-    validate_split_data,
+    validate_split_indices,
     validate_model_output,
 )
 from .callbacks import StatusUpdateCallback
@@ -70,6 +71,9 @@ def train(
     batch_size=16,
     learning_rate=1e-5,
     malignant_multiplier=15.0,
+    shuffle_buffer=1024,
+    cache_dataset=None,
+    preprocess_workers=None,
 ):
     # Custom status callback for job status update
     status_callback = StatusUpdateCallback(job, set_status)
@@ -99,6 +103,7 @@ def train(
             row_limit=row_limit,
             start_row=start_row,
             requested_size=input_size[:2],
+            preprocess_workers=preprocess_workers,
         )
     )
     set_status(job, "Validating input data")
@@ -160,18 +165,33 @@ def train(
     set_status(job, "Splitting data into train and validation sets")
     # Create the split by splitting the data into train and validation sets
     # For now, we will only use the train and validation sets as we do not
-    # have a broader dataset to split into train, validation, and test sets
-    X_img_train, X_img_val, X_tab_train, X_tab_val, y_train, y_val = train_test_split(
+    # have a broader dataset to split into train, validation, and test sets.
+    # Only the indices are split, the images stay in the (memory-mapped) cache
+    train_indices, val_indices = split_indices(labels, TEST_SIZE, RANDOM_STATE)
+
+    validate_split_indices(train_indices, val_indices, tabular_features_scaled)
+
+    # Stream the images of both sets from the cache instead of copying them into memory
+    train_dataset = make_dataset(
         images,
         tabular_features_scaled,
         labels_cat,
-        test_size=TEST_SIZE,
-        random_state=RANDOM_STATE,
-        stratify=labels,
+        train_indices,
+        BATCH_SIZE,
         shuffle=True,
+        shuffle_buffer=shuffle_buffer,
+        seed=RANDOM_STATE,
+        cache=cache_dataset,
     )
-
-    validate_split_data(X_img_train, X_img_val, X_tab_train, X_tab_val, y_train, y_val)
+    val_dataset = make_dataset(
+        images,
+        tabular_features_scaled,
+        labels_cat,
+        val_indices,
+        BATCH_SIZE,
+        cache=cache_dataset and f"{cache_dataset}.val",
+    )
+    y_val = labels_cat[val_indices]
 
     # Define the input layers for the model
     image_input = Input(shape=INPUT_SIZE)
@@ -179,9 +199,13 @@ def train(
 
     set_status(job, "Creating model")
 
+    # The model takes raw pixels (0-255) and normalizes them to the [-1, 1] range
+    # itself, so the training pipeline and the server cannot normalize differently
+    normalized_image = Rescaling(scale=1 / 127.5, offset=-1.0)(image_input)
+
     # Utilize a pre-trained model for abstract feature extraction
     pretrained = DenseNet169(
-        weights="imagenet", include_top=False, input_tensor=image_input
+        weights="imagenet", include_top=False, input_tensor=normalized_image
     )
 
     # Set the pre-trained model's output to be the input
@@ -257,21 +281,17 @@ def train(
 
     # Train the model on prepared data
     history = model.fit(
-        x=[X_img_train, X_tab_train],  # Specify image and tabular training data
-        y=y_train,  # Specify training labels
-        batch_size=BATCH_SIZE,  # N samples passed through model before weight update
+        train_dataset,  # Batches of image and tabular training data and labels
         epochs=NUM_EPOCHS,  # Specify number of epochs to train for
-        validation_data=(
-            [X_img_val, X_tab_val],
-            y_val,
-        ),  # Specify image and tabular validation data
+        validation_data=val_dataset,  # Batches of image and tabular validation data
         class_weight=class_weights,
         callbacks=[status_callback],
         verbose=is_verbose,
     )
 
     # Make predictions on the test set
-    y_predicted = model.predict([X_img_val, X_tab_val])
+    # (the validation set is not shuffled, so the predictions are in the order of y_val)
+    y_predicted = model.predict(val_dataset, verbose=is_verbose)
 
     # Get the predicted classes by extracting the index with highest probability
     predicted_classes = np.argmax(y_predicted, axis=1)
@@ -327,5 +347,8 @@ def train(
         lesion_type_encoder,
         localization_encoder,
         custom_recall,
+        # The last layer of the backbone is the final spatial feature map
+        grad_cam_layer=pretrained.layers[-1].name,
+        input_normalization="model",
     )
     print("Model saved successfully to database")
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from application.predictions.prediction_manager import run_prediction_worker
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs a prediction worker that processes the pending requests in the database. "
+        "Requires PREDICTION_QUEUE_BACKEND=database for the web server."
+    )
+
+    def handle(self, *args, **options):
+        run_prediction_worker()
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:26
+
+from django.db import migrations, models
+
+
+def set_existing_request_status(apps, schema_editor):
+    # Requests that were processed before the status existed are complete
+    Requests = apps.get_model("application", "Requests")
+    Requests.objects.filter(probability__isnull=False).update(status="classified")
+    Requests.objects.filter(heatmap__isnull=False).update(status="explained")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("application", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="requests",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("classified", "Classified"),
+                    ("explained", "Explained"),
+                ],
+                default="pending",
+                max_length=10,
+            ),
+        ),
+        migrations.RunPython(set_existing_request_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("application", "0002_requests_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="requests",
+            name="cam_grid",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="requests",
+            name="heatmap_base64",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="requests",
+            name="heatmap_format",
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("application", "0003_requests_heatmap_artifacts"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="requests",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("processing", "Processing"),
+                    ("classified", "Classified"),
+                    ("explained", "Explained"),
+                ],
+                default="pending",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("application", "0004_requests_processing_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="requests",
+            name="claimed_at",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="requests",
+            index=models.Index(
+                fields=["status", "created_at"], name="requests_status_created"
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-18 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("application", "0005_requests_claimed_at"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="requests",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("processing", "Processing"),
+                    ("classified", "Classified"),
+                    ("explained", "Explained"),
+                    ("failed", "Failed"),
+                ],
+                default="pending",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("application", "0006_requests_failed_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="model",
+            name="onnx_model",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -74,6 +74,9 @@ class Model(models.Model):
     version = models.AutoField(primary_key=True)
     created_at = models.IntegerField(null=False, blank=False)
     weights = models.BinaryField(null=False)
+    # ONNX export of the model, served by the ONNX Runtime inference backend
+    # (empty if the model could not be exported when it was saved)
+    onnx_model = models.BinaryField(blank=True, null=True)
     hyperparameters = models.TextField(default="default", null=False, blank=False)
 
     class Meta:
@@ -219,6 +222,15 @@ class Requests(models.Model):
     # Binary field for storing Grad-CAM heatmap
     heatmap = models.BinaryField(blank=True, null=True)
 
+    # Base64 encoded Grad-CAM overlay, encoded once when the explanation is stored
+    heatmap_base64 = models.TextField(blank=True, null=True)
+
+    # MIME type of the encoded overlay (e.g. image/webp)
+    heatmap_format = models.CharField(max_length=16, blank=True, null=True)
+
+    # Raw Grad-CAM grid (JSON), normalized to the [0, 1] range
+    cam_grid = models.TextField(blank=True, null=True)
+
     # Foreign Keys
     user = models.ForeignKey(Users, on_delete=models.CASCADE)
 
@@ -226,6 +238,34 @@ class Requests(models.Model):
     # We store this as a local column instead of a foreign key to allow keeping historical data
     model = models.PositiveIntegerField(blank=True, null=True)
 
+    # Stage of the prediction pipeline that the request has reached
+    # The classification is written before the (slower) explanation is computed
+    # A failed request keeps its classification if only the explanation failed
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("processing", "Processing"),
+        ("classified", "Classified"),
+        ("explained", "Explained"),
+        ("failed", "Failed"),
+    ]
+    status = models.CharField(
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default="pending",
+        blank=False,
+        null=False,
+    )
+
+    # Time when a prediction worker claimed the request (lease start)
+    # A request whose lease has run out without being explained is claimed again
+    claimed_at = models.IntegerField(blank=True, null=True)
+
     class Meta:
         managed = True
         db_table = "requests"
+        indexes = [
+            # Used to find the oldest pending requests and the expired ones
+            models.Index(
+                fields=["status", "created_at"], name="requests_status_created"
+            ),
+        ]
@@ -0,0 +1,154 @@
+import math
+import threading
+
+
+class AdmissionController:
+    """
+    Decides whether a new prediction request is admitted to the prediction queue.
+
+    The prediction manager reports the throughput of every processed batch, which
+    is smoothed with an exponential moving average. A request is rejected when the
+    queue has reached its maximum depth, or when the estimated time until the
+    request would be processed exceeds the wait budget.
+
+    The classified jobs still have to be explained, so the throughput of the
+    explanation stage and its queue are taken into account for the estimated wait
+    as well, as the slower of the two stages limits the pipeline.
+    """
+
+    # Weight of the most recent batch in the moving average of the throughput
+    SMOOTHING = 0.2
+    # Retry-After (in seconds) that is used before any throughput has been measured
+    DEFAULT_RETRY_AFTER = 5
+
+    def __init__(self, max_queue_depth=0, max_wait=0):
+        # Maximum number of queued jobs (0 disables the limit)
+        self.max_queue_depth = max_queue_depth
+        # Maximum estimated wait in seconds (0 disables the limit)
+        self.max_wait = max_wait
+
+        self._lock = threading.Lock()
+        # Smoothed number of jobs classified per second
+        self.throughput = None
+        # Smoothed number of jobs explained per second
+        self.explanation_throughput = None
+        self.admitted = 0
+        self.rejected = 0
+
+    def record_batch(self, batch_size, duration):
+        """Records the number of jobs of a classified batch and its duration in seconds."""
+        if batch_size <= 0 or duration <= 0:
+            return
+
+        with self._lock:
+            self.throughput = self._smooth(self.throughput, batch_size / duration)
+
+    def record_explanation_batch(self, batch_size, duration):
+        """Records the number of jobs of an explained batch and its duration in seconds."""
+        if batch_size <= 0 or duration <= 0:
+            return
+
+        with self._lock:
+            self.explanation_throughput = self._smooth(
+                self.explanation_throughput, batch_size / duration
+            )
+
+    def _smooth(self, average, throughput):
+        if average is None:
+            return throughput
+        return self.SMOOTHING * throughput + (1 - self.SMOOTHING) * average
+
+    def estimate_wait(self, queue_depth, explanation_depth=0):
+        """
+        Returns the estimated time in seconds until the queued jobs are explained
+        (None if unknown).
+
+        Args:
+            queue_depth (int): Number of jobs waiting to be classified.
+            explanation_depth (int): Number of classified jobs waiting to be explained.
+        """
+        if self.throughput is None:
+            return None
+
+        estimated_wait = queue_depth / self.throughput
+        if self.explanation_throughput is not None:
+            # The jobs are explained after all jobs ahead of them in both queues
+            estimated_wait = max(
+                estimated_wait,
+                (queue_depth + explanation_depth) / self.explanation_throughput,
+            )
+        return estimated_wait
+
+    def admit(self, queue_depth, explanation_depth=0):
+        """
+        Decides whether a new job is admitted to a queue with the given depth.
+        Only the depth of the prediction queue is limited, the classified jobs
+        waiting to be explained count towards the estimated wait.
+
+        Returns:
+            tuple: A tuple containing:
+                - True if the job is admitted.
+                - The number of seconds after which the client should retry
+                  (None if the job is admitted).
+        """
+
+        with self._lock:
+            # The new job has to wait for all queued jobs and itself
+            estimated_wait = self.estimate_wait(queue_depth + 1, explanation_depth)
+
+            queue_full = self.max_queue_depth and queue_depth >= self.max_queue_depth
+            wait_exceeded = (
+                self.max_wait
+                and estimated_wait is not None
+                and estimated_wait > self.max_wait
+            )
+
+            if queue_full or wait_exceeded:
+                self.rejected += 1
+                return False, self._retry_after(queue_depth, explanation_depth)
+
+            self.admitted += 1
+            return True, None
+
+    def reject(self, queue_depth, explanation_depth=0):
+        """Records a job that was rejected outside of `admit` and returns its Retry-After."""
+        with self._lock:
+            self.rejected += 1
+            return self._retry_after(queue_depth, explanation_depth)
+
+    def _retry_after(self, queue_depth, explanation_depth=0):
+        if self.throughput is None:
+            return self.DEFAULT_RETRY_AFTER
+
+        # The queues drain at the throughput of the slower stage
+        throughput = self.throughput
+        if self.explanation_throughput is not None:
+            throughput = min(throughput, self.explanation_throughput)
+
+        # Number of queued jobs above the limits at the current throughput
+        excess_jobs = 1
+        if self.max_queue_depth:
+            excess_jobs = max(excess_jobs, queue_depth - (self.max_queue_depth - 1))
+        if self.max_wait:
+            excess_jobs = max(
+                excess_jobs,
+                queue_depth + explanation_depth - (self.max_wait * throughput - 1),
+            )
+
+        # Time until the queues have drained down to the allowed depth
+        return max(1, math.ceil(excess_jobs / throughput))
+
+    def stats(self, queue_depth, explanation_depth=0):
+        """Returns the admission statistics for the given queue depths."""
+        with self._lock:
+            return {
+                "queue_depth": queue_depth,
+                "explanation_queue_depth": explanation_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "throughput": self.throughput,
+                "explanation_throughput": self.explanation_throughput,
+                "estimated_wait": self.estimate_wait(queue_depth, explanation_depth),
+                "max_wait": self.max_wait,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
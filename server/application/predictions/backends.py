@@ -0,0 +1,242 @@
+import sqlite3
+import time
+import warnings
+from abc import ABC, abstractmethod
+from contextlib import closing
+import numpy as np
+
+# Custom modules
+from application.mlsym.persistence import store_inference_backend_check
+from application.views.jobs.job import Job
+from .database import connect_db
+from .preprocess_user_data import (
+    decode_image,
+    preprocess_images,
+    extract_tabular_features,
+)
+
+
+class InferenceBackend(ABC):
+    """
+    Base class of the backends that classify batches instead of the float
+    TensorFlow model, e.g. a quantized conversion of it or another runtime.
+
+    A backend builds a predictor with the same interface as `CompiledPredictor`
+    when a model is loaded (see `build_predictor`). The predictor is compared with
+    the float model on a sample of the stored training images. The result of this
+    accuracy-drift check is stored with the model version, and the float model
+    keeps serving if the predictor agrees with it on too few samples. The
+    explanations always use the float model, as they need its gradients.
+
+    Without stored images, a backend that needs them for its calibration is
+    refused, and the other backends are served without a drift check.
+    """
+
+    # Name of the backend, used to store its drift checks
+    name = None
+
+    # Whether the predictor cannot be built without calibration data
+    requires_calibration = False
+
+    def __init__(
+        self,
+        calibration_samples=64,
+        min_agreement=0.95,
+        num_threads=None,
+        images_db_path=None,
+    ):
+        # Number of stored images that are used for calibration and the drift check
+        self.calibration_samples = calibration_samples
+        # Minimum share of samples with the same top-1 class as the float model
+        self.min_agreement = min_agreement
+        # Threads of the predictor (None lets the runtime decide)
+        self.num_threads = num_threads
+        # Database of the training images (see get_images_db_path)
+        self.images_db_path = images_db_path
+
+    @abstractmethod
+    def build_predictor(self, serving_model, db_path, calibration_data):
+        """
+        Builds the predictor of a loaded model.
+
+        Args:
+            serving_model (ServingModel): The loaded float model.
+            db_path: Path of the database that the model was loaded from.
+            calibration_data (tuple): Preprocessed (images, tabular) samples, or
+                None if there are no stored images.
+
+        Returns:
+            The predictor, which has a `predict(image_batch, tabular_batch)` method
+            and a `model_size` (in bytes).
+        """
+
+    def check_details(self):
+        """Returns the options of the backend that are stored with its drift checks."""
+        return {}
+
+    def apply(self, serving_model, db_path):
+        """
+        Replaces the predictor of a loaded model with the predictor of the backend
+        if it passes the drift check.
+
+        Returns:
+            dict: The result of the drift check.
+        """
+
+        start_time = time.perf_counter()
+
+        calibration_data = load_calibration_data(
+            self.images_db_path, serving_model, self.calibration_samples
+        )
+        if calibration_data is None:
+            if self.requires_calibration:
+                raise RuntimeError(
+                    f"The {self.name} backend needs stored images for its calibration"
+                )
+            warnings.warn(
+                f"There are no stored images to check the {self.name} backend of "
+                f"model version {serving_model.version}, it is served without a "
+                f"drift check",
+                category=UserWarning,
+            )
+
+        predictor = self.build_predictor(serving_model, db_path, calibration_data)
+
+        if calibration_data is not None:
+            # Compare the predictions of the backend with the float predictions
+            images, tabular = calibration_data
+            check = compare_predictions(
+                serving_model.predictor.predict(images, tabular),
+                predictor.predict(images, tabular),
+            )
+        else:
+            check = {
+                "samples": 0,
+                "top1_agreement": None,
+                "max_abs_diff": None,
+                "mean_abs_diff": None,
+            }
+        check.update(
+            {
+                **self.check_details(),
+                "checked": calibration_data is not None,
+                "model_size": predictor.model_size,
+                "min_agreement": self.min_agreement,
+                "accepted": calibration_data is None
+                or check["top1_agreement"] >= self.min_agreement,
+                "checked_at": int(time.time()),
+            }
+        )
+
+        if check["accepted"]:
+            serving_model.predictor = predictor
+            serving_model.inference_backend = self.name
+        else:
+            warnings.warn(
+                f"The {self.name} backend of model version {serving_model.version} "
+                f"agrees with the float model on {check['top1_agreement']:.1%} of the "
+                f"samples, serving the float model instead",
+                category=UserWarning,
+            )
+        serving_model.backend_check = check
+
+        # Keep the result of the check with the model version
+        try:
+            with closing(connect_db(db_path)) as conn:
+                store_inference_backend_check(
+                    conn, serving_model.version, self.name, check
+                )
+        except Exception as e:
+            warnings.warn(
+                f"Failed to store the drift check of model version "
+                f"{serving_model.version}: {e}",
+                category=UserWarning,
+            )
+
+        summary = (
+            f"top-1 agreement: {check['top1_agreement']:.1%}, "
+            f"max probability difference: {check['max_abs_diff']:.4f}"
+            if check["checked"]
+            else "not checked"
+        )
+        print(
+            f"Prepared the {self.name} backend of model version "
+            f"{serving_model.version} in {time.perf_counter() - start_time:.2f} s "
+            f"({summary})"
+        )
+        return check
+
+
+def load_calibration_data(images_db_path, serving_model, n_samples):
+    """
+    Loads and preprocesses a random sample of the stored training images, in the
+    same way as the images of the requests.
+
+    Returns:
+        tuple: The images and the tabular features, or None if there are no stored
+            images that the model can encode.
+    """
+
+    if images_db_path is None:
+        return None
+
+    known_localizations = set(serving_model.localization_encoder.classes_)
+
+    try:
+        with closing(connect_db(images_db_path, read_only=True)) as conn:
+            rows = conn.execute(
+                """
+                SELECT image_id, image, age, sex, localization
+                FROM images
+                WHERE age IS NOT NULL
+                ORDER BY RANDOM()
+                LIMIT ?
+                """,
+                (n_samples,),
+            ).fetchall()
+    except sqlite3.Error as e:
+        warnings.warn(f"Failed to load the stored images: {e}", category=UserWarning)
+        return None
+
+    jobs = []
+    for image_id, image, age, sex, localization in rows:
+        if localization not in known_localizations:
+            continue
+        try:
+            image = decode_image(image, serving_model.input_shape)
+        except Exception:
+            continue
+        parameters = {
+            "age": age,
+            "sex": sex,
+            "localization": localization,
+            "image": image,
+        }
+        jobs.append(Job(job_id=image_id, start_time=None, parameters=parameters))
+
+    if not jobs:
+        return None
+
+    images = preprocess_images(
+        [job.parameters["image"] for job in jobs],
+        serving_model.input_shape,
+        serving_model.normalize_inputs,
+    )
+    tabular, _ = extract_tabular_features(
+        jobs, serving_model.tabular_scaler, serving_model.localization_encoder
+    )
+    return images.astype(np.float32), tabular.astype(np.float32)
+
+
+def compare_predictions(reference, predictions):
+    """Returns the drift of the predicted probabilities from the reference ones."""
+
+    differences = np.abs(predictions - reference)
+    return {
+        "samples": len(reference),
+        "top1_agreement": float(
+            np.mean(predictions.argmax(axis=1) == reference.argmax(axis=1))
+        ),
+        "max_abs_diff": float(differences.max()),
+        "mean_abs_diff": float(differences.mean()),
+    }
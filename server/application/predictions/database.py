@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from django.conf import settings
+
+# Persistent database connections of the prediction threads
+db_connections = threading.local()
+
+
+def get_db_path():
+    """Returns the path of the database configured for Django."""
+    return str(settings.DATABASES["default"]["NAME"])
+
+
+def get_images_db_path():
+    """Returns the path of the database of the training images (see IMAGE_DB_MODELS)."""
+    return str(settings.DATABASES["db_images"]["NAME"])
+
+
+def connect_db(db_path, timeout=5.0, read_only=False):
+    """
+    Opens a new connection to a database. The path may also be a "file:" URI,
+    which Django uses for in-memory test databases.
+
+    A read-only connection does not create a database that does not exist.
+    """
+
+    db_path = str(db_path)
+    if read_only and not db_path.startswith("file:"):
+        db_path = Path(os.path.abspath(db_path)).as_uri() + "?mode=ro"
+
+    # SQLite only treats paths that start with "file:" as URIs
+    return sqlite3.connect(db_path, timeout=timeout, uri=True)
+
+
+def get_db_connection(db_path):
+    """
+    Returns the database connection of the calling thread, opening it on first use.
+
+    The connection is kept open for the lifetime of the thread instead of
+    reconnecting for every batch. The database is switched to WAL mode so that
+    writing results does not block the web server from reading requests.
+    """
+
+    connections = getattr(db_connections, "connections", None)
+    if connections is None:
+        connections = db_connections.connections = {}
+
+    if db_path not in connections:
+        conn = connect_db(db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        # Durable enough in WAL mode, but avoids a sync on every commit
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        connections[db_path] = conn
+
+    return connections[db_path]
+
+
+def close_db_connections():
+    """
+    Closes the database connections of the calling thread. Threads that do not
+    run for the lifetime of the process call this before they exit.
+    """
+
+    connections = getattr(db_connections, "connections", None)
+    if not connections:
+        return
+
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
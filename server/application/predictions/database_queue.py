@@ -0,0 +1,263 @@
+import math
+import time
+from contextlib import closing
+
+# Custom modules
+from application.views.jobs.job import Job
+from .database import connect_db, get_db_connection
+from .preprocess_user_data import decode_image, get_preprocess_pool
+
+
+class DatabaseJobQueue:
+    """
+    Prediction queue on the pending rows of the Requests table.
+
+    Every request that is created is a pending row, so the queue is shared by all
+    web server processes and survives restarts. Any number of worker processes can
+    take jobs from it, as claiming a batch marks its rows as processing within a
+    single write transaction, so no two workers claim the same request.
+    """
+
+    def __init__(self, db_path, poll_interval=0.1, lease_time=300):
+        self.db_path = db_path
+        # Time (in seconds) between two checks of an empty queue
+        self.poll_interval = poll_interval
+        # Time (in seconds) after which a claimed request that has not been
+        # explained is claimed again, as its worker has most likely crashed.
+        # The lease is renewed when the request is classified
+        self.lease_time = lease_time
+
+    def claim_jobs(self, limit, JOB_EXPIRY_TIME):
+        """
+        Claims up to `limit` of the oldest pending requests and identifies expired ones.
+
+        Requests whose lease has run out are claimed again, so the batch of a
+        crashed worker is retried until the requests expire.
+
+        Returns:
+            tuple: A tuple containing:
+                - List of claimed rows (request_id, created_at, localization, image, age, sex).
+                - List of expired request IDs.
+        """
+
+        now = int(time.time())
+        expiry_time = get_expiry_time(JOB_EXPIRY_TIME)
+
+        conn = get_db_connection(self.db_path)
+
+        # Take the write lock right away, so that the selected rows cannot
+        # be claimed by another worker before they are marked
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            rows = conn.execute(
+                """
+                SELECT requests.request_id, requests.created_at, requests.localization,
+                    requests.image, users.age, users.sex
+                FROM requests
+                JOIN users ON requests.user_id = users.username
+                WHERE requests.created_at >= ? AND (
+                    requests.status = 'pending'
+                    OR (
+                        requests.status IN ('processing', 'classified')
+                        AND requests.claimed_at < ?
+                    )
+                )
+                ORDER BY requests.created_at, requests.request_id
+                LIMIT ?;
+                """,
+                (expiry_time, now - self.lease_time, limit),
+            ).fetchall()
+
+            conn.executemany(
+                """
+                UPDATE requests SET status = 'processing', claimed_at = ?
+                WHERE request_id = ?;
+                """,
+                [(now, row[0]) for row in rows],
+            )
+
+            expired_jobs = find_expired_requests(conn, JOB_EXPIRY_TIME, self.lease_time)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        return rows, expired_jobs
+
+    def wait_for_jobs(
+        self,
+        BATCH_SIZE,
+        MAX_BATCH_WAIT,
+        JOB_EXPIRY_TIME,
+        IDLE_TIMEOUT,
+        target_input_shape=None,
+    ):
+        """
+        Waits for pending requests and claims them as a batch of jobs.
+
+        The queue is polled until the first requests are pending, for at most
+        `IDLE_TIMEOUT` seconds. If the batch is not full, the worker waits
+        `MAX_BATCH_WAIT` seconds once for more requests to arrive.
+
+        Args:
+            BATCH_SIZE (int): Maximum number of jobs to claim.
+            MAX_BATCH_WAIT (float): Time (seconds) to wait for more jobs after the first ones.
+            JOB_EXPIRY_TIME (int): Expiry time for pending jobs (seconds)
+            IDLE_TIMEOUT (float): Max time (seconds) to poll while the queue is empty.
+            target_input_shape: The input dimensions (height, width) of the served model.
+
+        Returns:
+            tuple: A tuple containing:
+                - List of valid job objects.
+                - List of expired job IDs.
+        """
+
+        idle_deadline = time.monotonic() + IDLE_TIMEOUT
+        expired_jobs = []
+
+        # Poll until the first requests are pending
+        while True:
+            rows, expired = self.claim_jobs(BATCH_SIZE, JOB_EXPIRY_TIME)
+            expired_jobs.extend(expired)
+            if rows or time.monotonic() >= idle_deadline:
+                break
+            time.sleep(self.poll_interval)
+
+        # Give more requests the chance to join the batch
+        if rows and len(rows) < BATCH_SIZE:
+            time.sleep(MAX_BATCH_WAIT)
+            more_rows, expired = self.claim_jobs(
+                BATCH_SIZE - len(rows), JOB_EXPIRY_TIME
+            )
+            rows.extend(more_rows)
+            expired_jobs.extend(expired)
+
+        return self.build_jobs(rows, target_input_shape), expired_jobs
+
+    def build_jobs(self, rows, target_input_shape=None):
+        """Creates the jobs of the claimed rows, decoding their images in parallel."""
+
+        def decode_row_image(row):
+            try:
+                return decode_image(row[3], target_input_shape)
+            except Exception as e:
+                print(f"Failed to decode the image of request {row[0]}: {e}")
+                return None
+
+        images = get_preprocess_pool().map(decode_row_image, rows)
+
+        jobs = []
+        for (request_id, created_at, localization, _, age, sex), image in zip(
+            rows, images
+        ):
+            # Skip requests whose image could not be decoded
+            if image is None:
+                continue
+
+            # The same parameters as the jobs created by CreateRequest
+            parameters = {
+                "request_id": request_id,
+                "age": age,
+                "sex": sex,
+                "localization": localization,
+                "image": image,
+            }
+            job = Job(job_id=request_id, start_time=created_at, parameters=parameters)
+            # The request has been waiting in the queue since it was created
+            job.queued_at = created_at
+            jobs.append(job)
+
+        return jobs
+
+    def iter_unfinished_jobs(
+        self,
+        JOB_EXPIRY_TIME,
+        target_input_shape=None,
+        max_request_id=None,
+        chunk_size=64,
+    ):
+        """
+        Yields the jobs of the requests that have not been explained yet, oldest first.
+
+        Used to rebuild the in-process queue after a restart, as the queued jobs
+        are lost with the process. The rows are loaded and decoded in chunks, so
+        that only a bounded number of decoded images is held at a time.
+
+        Args:
+            JOB_EXPIRY_TIME (int): Expiry time for pending jobs (seconds)
+            target_input_shape: The input dimensions (height, width) of the served model.
+            max_request_id (int): Only yield the requests up to this ID.
+            chunk_size (int): Number of requests to load at a time.
+        """
+
+        expiry_time = get_expiry_time(JOB_EXPIRY_TIME)
+        if max_request_id is None:
+            max_request_id = math.inf
+
+        last_request_id = 0
+        while True:
+            conn = get_db_connection(self.db_path)
+            rows = conn.execute(
+                """
+                SELECT requests.request_id, requests.created_at, requests.localization,
+                    requests.image, users.age, users.sex
+                FROM requests
+                JOIN users ON requests.user_id = users.username
+                WHERE requests.status IN ('pending', 'processing', 'classified')
+                    AND requests.created_at >= ?
+                    AND requests.request_id > ? AND requests.request_id <= ?
+                ORDER BY requests.request_id
+                LIMIT ?;
+                """,
+                (expiry_time, last_request_id, max_request_id, chunk_size),
+            ).fetchall()
+            if not rows:
+                return
+
+            last_request_id = rows[-1][0]
+            yield from self.build_jobs(rows, target_input_shape)
+
+    def get_max_request_id(self):
+        """Returns the ID of the most recent request (0 if there are none)."""
+        # Called from a request thread of the web server, which does not keep a connection
+        with closing(connect_db(self.db_path)) as conn:
+            row = conn.execute("SELECT MAX(request_id) FROM requests;").fetchone()
+        return row[0] or 0
+
+    def get_active_model_version(self):
+        """Returns the version of the active model, or None if there is none."""
+        conn = get_db_connection(self.db_path)
+        row = conn.execute("SELECT model_id FROM model_active WHERE id = 1;").fetchone()
+        return row[0] if row else None
+
+
+def get_expiry_time(JOB_EXPIRY_TIME):
+    """Returns the creation time before which requests are expired."""
+    if math.isinf(JOB_EXPIRY_TIME):
+        return -math.inf
+    return int(time.time() - JOB_EXPIRY_TIME)
+
+
+def find_expired_requests(conn, JOB_EXPIRY_TIME, lease_time):
+    """
+    Returns the IDs of the expired requests that have no result yet.
+
+    Claimed requests are only expired once their lease has run out, so that the
+    request of a worker that is still processing it is not deleted.
+
+    The query uses the index on (status, created_at), so it does not scan the
+    table and can be run on every poll of the queue.
+    """
+
+    return [
+        row[0]
+        for row in conn.execute(
+            """
+            SELECT request_id FROM requests
+            WHERE status IN ('pending', 'processing') AND created_at < ?
+                AND (status = 'pending' OR claimed_at IS NULL OR claimed_at < ?);
+            """,
+            (get_expiry_time(JOB_EXPIRY_TIME), int(time.time()) - lease_time),
+        )
+    ]
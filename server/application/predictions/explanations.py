@@ -0,0 +1,202 @@
+import warnings
+import cv2
+import numpy as np
+import tensorflow as tf
+from .inference import BATCH_BUCKETS, BucketedFunction
+
+
+def find_grad_cam_layer(model):
+    """
+    Finds the layer used for Grad-CAM by walking the model graph backwards.
+
+    The target is the last layer that still has a spatial (4D) output, which is the
+    final feature map of the convolutional backbone right before it is pooled.
+    This works for any backbone (DenseNet, MobileNet, EfficientNet, ...) without
+    hard-coding architecture specific layer names.
+
+    Args:
+        model (tf.keras.Model): The model used for predictions.
+
+    Returns:
+        str: The name of the Grad-CAM target layer.
+    """
+
+    for layer in reversed(model.layers):
+        # Skip the input layers, they have no activations to explain
+        if isinstance(layer, tf.keras.layers.InputLayer):
+            continue
+
+        # Batch, height, width and channels
+        if len(layer.output.shape) == 4:
+            return layer.name
+
+    raise ValueError("Model has no layer with a spatial output to use for Grad-CAM")
+
+
+class GradCamExplainer:
+    """
+    Predicts and explains batches for a loaded model.
+
+    The Grad-CAM sub-model and the compiled explanation function are built once
+    per loaded model version and reused for every batch, instead of constructing
+    a new Keras graph for every prediction.
+
+    The Grad-CAM target layer is read from the stored hyperparameters of the model
+    version if available, otherwise it is discovered from the model graph.
+    """
+
+    def __init__(self, model, conv_layer_name=None, buckets=BATCH_BUCKETS):
+        # Verify that the stored layer name exists in the model
+        layer_names = [layer.name for layer in model.layers]
+        if conv_layer_name is not None and conv_layer_name not in layer_names:
+            warnings.warn(
+                f"Grad-CAM layer '{conv_layer_name}' not found in model, discovering it instead",
+                category=UserWarning,
+            )
+            conv_layer_name = None
+
+        # Discover the target layer from the model graph
+        if conv_layer_name is None:
+            conv_layer_name = find_grad_cam_layer(model)
+        self.conv_layer_name = conv_layer_name
+
+        # Create an instance of the model that returns the output of the
+        # conv layer alongside the model output
+        conv_layer = model.get_layer(conv_layer_name)
+        self.grad_model = tf.keras.models.Model(
+            inputs=model.inputs, outputs=[conv_layer.output, model.output]
+        )
+
+        # Compile the explanation pass once per batch bucket so it is never retraced
+        image_shape, tabular_shape = model.input_shape
+        self._explain = BucketedFunction(
+            self._explain_fn, image_shape[1:], tabular_shape[1:], buckets
+        )
+        self.buckets = self._explain.buckets
+
+    def _explain_fn(self, image_input, tabular_input):
+        # Record a single forward pass for the whole batch
+        with tf.GradientTape() as tape:
+            # The conv outputs are tracked automatically as they are produced
+            # by trainable layers, the tabular input has to be watched explicitly
+            tape.watch(tabular_input)
+            conv_outputs, predictions = self.grad_model(
+                [image_input, tabular_input], training=False
+            )
+
+            # Select the score of the predicted class for every sample in the batch
+            predicted_class_indices = tf.argmax(predictions, axis=1)
+            class_scores = tf.gather(predictions, predicted_class_indices, batch_dims=1)
+
+        # Samples do not interact in inference mode, so the gradient of the
+        # summed class scores yields the per-sample gradients in one backward pass
+        conv_gradients, tabular_gradients = tape.gradient(
+            class_scores, [conv_outputs, tabular_input]
+        )
+
+        # For each conv feature calculate its importance for the predicted
+        # class across the entire image of that sample
+        feature_weights = tf.reduce_mean(conv_gradients, axis=(1, 2))
+
+        # Calculate the weighted sum of the conv outputs per pixel, which promotes
+        # features with a high activation and a high derivative for the predicted class
+        cams = tf.reduce_sum(conv_outputs * feature_weights[:, None, None, :], axis=-1)
+
+        # We are only interested in the magnitude of the impact of each tabular feature
+        tabular_importances = tf.abs(tabular_gradients)
+
+        return predictions, cams, tabular_importances
+
+    def explain(self, image_batch, tabular_batch):
+        """
+        Computes the predictions and the explanations for an entire batch in a single
+        taped forward and backward pass.
+
+        Args:
+            image_batch (np.ndarray): Batch of preprocessed images (N, H, W, 3).
+            tabular_batch (np.ndarray): Batch of standardized tabular features (N, F).
+
+        Returns:
+            tuple: A tuple containing:
+                - Class probabilities for each sample (N, num_classes).
+                - Grad-CAM activation maps for each sample (N, h, w).
+                - Absolute tabular feature gradients for each sample (N, F).
+        """
+
+        return self._explain(image_batch, tabular_batch)
+
+
+def render_heatmap(cam, image):
+    """
+    Renders a Grad-CAM activation map on top of the preprocessed image.
+
+    Args:
+        cam (np.ndarray): Grad-CAM activation map of a single sample (h, w).
+        image (np.ndarray): Preprocessed image, either raw uint8 pixels or
+            normalized to the [-1, 1] range (H, W, 3).
+
+    Returns:
+        tuple: The heatmap (H, W), the colored heatmap and the layered image (H, W, 3).
+    """
+
+    # Remove negatives and normalize the heatmap by rescaling it from 0 to 1
+    heatmap = np.maximum(cam, 0)
+    heatmap = heatmap / (np.max(heatmap) + 1e-7)  # Use 1e-7 to avoid division by zero
+
+    # Convert heatmap to 0-255 range and resize it to match the image size
+    heatmap = np.uint8(255 * heatmap)
+    heatmap = cv2.resize(heatmap, (image.shape[1], image.shape[0]))
+
+    # Convert heatmap to a color map (BGR, as used by OpenCV)
+    heatmap_colored = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
+
+    # Rescale the image from [-1, 1] back to 0-255 (unless it holds raw pixels)
+    # and convert it to BGR
+    if image.dtype == np.uint8:
+        original_img = image
+    else:
+        original_img = np.clip(
+            (np.asarray(image, np.float32) + 1.0) * 127.5, 0, 255
+        ).astype(np.uint8)
+    original_img = cv2.cvtColor(original_img, cv2.COLOR_RGB2BGR)
+
+    # Add the heatmap as a layer on top of the original image
+    # with a weight of 0.6 for the original image and 0.4 for the heatmap
+    layered = cv2.addWeighted(original_img, 0.6, heatmap_colored, 0.4, 0)
+
+    return heatmap, heatmap_colored, layered
+
+
+def compute_feature_impact(heatmap, tabular_importances, feature_names):
+    """
+    Combines the image and tabular importances into relative percentages.
+
+    Args:
+        heatmap (np.ndarray): Rendered heatmap of a single sample (H, W).
+        tabular_importances (np.ndarray): Absolute tabular gradients of a single sample (F,).
+        feature_names (list): Names of the tabular features.
+
+    Returns:
+        dict: Relative impact (in percent) of the image and every tabular feature.
+    """
+
+    # We can calculate the importance of the image
+    # by taking the mean activation value for each pixel
+    image_importance = np.mean(heatmap)
+
+    # Combine all importance values
+    all_importances = np.concatenate([[image_importance], tabular_importances])
+
+    # Calculate relative percentages
+    # we dont care about direction only magnitude
+    total_importance = np.sum(np.abs(all_importances))
+    relative_importances = (np.abs(all_importances) / total_importance) * 100
+
+    # Map importance values to feature names
+    return {
+        "image": float(relative_importances[0]),
+        **{
+            name: float(importance)
+            for name, importance in zip(feature_names, relative_importances[1:])
+        },
+    }
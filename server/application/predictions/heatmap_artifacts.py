@@ -0,0 +1,90 @@
+import base64
+import json
+import cv2
+import numpy as np
+
+# OpenCV file extension, quality flag and MIME type of every supported heatmap format
+HEATMAP_FORMATS = {
+    "png": (".png", None, "image/png"),
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY, "image/webp"),
+    "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY, "image/jpeg"),
+}
+
+
+class HeatmapEncoder:
+    """
+    Encodes rendered Grad-CAM heatmaps into the artifacts that are stored with a request.
+
+    The overlay is encoded and base64-encoded once when the explanation is written,
+    so the API can serve the stored string as is on every poll.
+    """
+
+    def __init__(
+        self, image_format="webp", quality=90, size=None, store_cam_grid=False
+    ):
+        if image_format not in HEATMAP_FORMATS:
+            raise ValueError(
+                f"Unsupported heatmap format '{image_format}', "
+                f"expected one of {list(HEATMAP_FORMATS)}"
+            )
+
+        self.image_format = image_format
+        # Quality (0-100) of the lossy formats, PNG is always lossless
+        self.quality = quality
+        # Size (in pixels) of the encoded overlay, None keeps the model input size
+        self.size = size
+        self.store_cam_grid = store_cam_grid
+
+        extension, quality_flag, mime_type = HEATMAP_FORMATS[image_format]
+        self.extension = extension
+        self.mime_type = mime_type
+        self.encode_params = [quality_flag, quality] if quality_flag is not None else []
+
+    def encode_image(self, image):
+        """Encodes an image (H, W, 3) in the configured format and returns the bytes."""
+
+        # Resize the overlay to the configured resolution
+        if self.size is not None and image.shape[:2] != (self.size, self.size):
+            image = cv2.resize(
+                image, (self.size, self.size), interpolation=cv2.INTER_AREA
+            )
+
+        success, encoded_image = cv2.imencode(self.extension, image, self.encode_params)
+        if not success:
+            raise ValueError(f"Failed to encode heatmap as {self.image_format}")
+
+        return encoded_image.tobytes()
+
+    def encode(self, cam, heatmap_tuple):
+        """
+        Builds the stored artifacts of a single explanation.
+
+        Args:
+            cam (np.ndarray): Grad-CAM activation map of a single sample (h, w).
+            heatmap_tuple (tuple): The rendered heatmap, colored heatmap and layered image.
+
+        Returns:
+            dict: The base64 encoded overlay, its MIME type and the
+            JSON encoded CAM grid (None if it is not stored).
+        """
+
+        layered_image = heatmap_tuple[2]
+        encoded_image = self.encode_image(layered_image)
+
+        return {
+            "heatmap_base64": base64.b64encode(encoded_image).decode("utf-8"),
+            "heatmap_format": self.mime_type,
+            "cam_grid": serialize_cam_grid(cam) if self.store_cam_grid else None,
+        }
+
+
+def serialize_cam_grid(cam, decimals=3):
+    """
+    Serializes a raw Grad-CAM grid (e.g. 7x7) to JSON, normalized to the [0, 1] range
+    in the same way as the rendered heatmap, so that clients can draw the overlay.
+    """
+
+    grid = np.maximum(np.asarray(cam, dtype=np.float32), 0)
+    grid = grid / (np.max(grid) + 1e-7)  # Use 1e-7 to avoid division by zero
+
+    return json.dumps(np.round(grid, decimals).tolist())
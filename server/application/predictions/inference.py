@@ -0,0 +1,116 @@
+import numpy as np
+import tensorflow as tf
+
+# Batch sizes that the compiled inference functions are traced for
+BATCH_BUCKETS = (1, 4, 16, 64)
+
+
+def get_bucket_size(batch_size, buckets=BATCH_BUCKETS):
+    """
+    Returns the smallest bucket that fits the batch, or the largest bucket
+    if the batch is bigger than all buckets (it is then processed in chunks).
+    """
+
+    for bucket in sorted(buckets):
+        if batch_size <= bucket:
+            return bucket
+    return max(buckets)
+
+
+def pad_batch(batch, size):
+    """Pads a batch with zero samples along the first axis up to the given size."""
+
+    padding = size - len(batch)
+    if padding <= 0:
+        return batch
+
+    # Only pad the batch axis
+    return np.pad(batch, [(0, padding)] + [(0, 0)] * (batch.ndim - 1))
+
+
+class BucketedFunction:
+    """
+    Compiles a function of an image batch and a tabular batch into one concrete
+    TensorFlow function per batch bucket.
+
+    All tracing happens once when the object is created (i.e. at model load).
+    Every call pads the batch up to the nearest bucket, calls the concrete
+    function directly and slices the padding off the outputs again, so no
+    retracing happens for new batch sizes.
+    """
+
+    def __init__(self, fn, image_shape, tabular_shape, buckets=BATCH_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.function = tf.function(fn)
+
+        # Trace one concrete function per bucket with a fully defined input shape
+        self._concrete_functions = {
+            size: self.function.get_concrete_function(
+                tf.TensorSpec(shape=(size, *image_shape), dtype=tf.float32),
+                tf.TensorSpec(shape=(size, *tabular_shape), dtype=tf.float32),
+            )
+            for size in self.buckets
+        }
+
+    def __call__(self, image_batch, tabular_batch):
+        # Ensure inputs are arrays with valid data types
+        image_batch = np.asarray(image_batch, dtype=np.float32)
+        tabular_batch = np.asarray(tabular_batch, dtype=np.float32)
+
+        # Batches larger than the largest bucket are processed in chunks
+        max_bucket = self.buckets[-1]
+        chunk_outputs = []
+
+        for start in range(0, len(image_batch), max_bucket):
+            images = image_batch[start : start + max_bucket]
+            tabular = tabular_batch[start : start + max_bucket]
+            n_samples = len(images)
+
+            # Pad the chunk up to the nearest bucket and run its concrete function
+            size = get_bucket_size(n_samples, self.buckets)
+            outputs = self._concrete_functions[size](
+                tf.constant(pad_batch(images, size)),
+                tf.constant(pad_batch(tabular, size)),
+            )
+
+            # Remove the padded samples from the outputs
+            chunk_outputs.append(
+                tf.nest.map_structure(lambda t: t.numpy()[:n_samples], outputs)
+            )
+
+        # Join the chunks back together to match the original batch
+        return tf.nest.map_structure(
+            lambda *chunks: np.concatenate(chunks), *chunk_outputs
+        )
+
+
+class CompiledPredictor:
+    """
+    Classifies batches with a compiled forward pass of the model instead of
+    `model.predict`, which builds a data adapter and callbacks on every call.
+    """
+
+    def __init__(self, model, buckets=BATCH_BUCKETS):
+        image_shape, tabular_shape = model.input_shape
+        self._predict = BucketedFunction(
+            lambda image_input, tabular_input: model(
+                [image_input, tabular_input], training=False
+            ),
+            image_shape[1:],
+            tabular_shape[1:],
+            buckets,
+        )
+
+    def predict(self, image_batch, tabular_batch):
+        """
+        Predicts the class probabilities of a batch.
+
+        Args:
+            image_batch (np.ndarray): Batch of preprocessed images (N, H, W, 3).
+            tabular_batch (np.ndarray): Batch of standardized tabular features (N, F).
+
+        Returns:
+            np.ndarray: Class probabilities for each sample (N, num_classes).
+        """
+
+        return self._predict(image_batch, tabular_batch)
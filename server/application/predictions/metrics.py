@@ -0,0 +1,185 @@
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the buckets of the stage latency histograms
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+)
+# Upper bounds of the buckets of the batch size histograms
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# Stages of the prediction pipeline in the order a request passes through them
+PIPELINE_STAGES = (
+    "queue_wait",  # From the admission of a request until its batch is taken
+    "image_preprocessing",  # Resizing and normalizing the images of a batch
+    "tabular_encoding",  # Encoding and scaling the tabular features of a batch
+    "forward_pass",  # Classifying a batch
+    "classification_write",  # Writing the classifications of a batch
+    "explanation_wait",  # From the classification of a job until it is explained
+    "gradients",  # Grad-CAM and tabular gradients of a batch (one backward pass)
+    "heatmap_rendering",  # Rendering the Grad-CAM overlay of a single job
+    "heatmap_encoding",  # Encoding the overlay of a single job
+    "explanation_write",  # Writing the explanations of a batch
+    "end_to_end",  # From the admission of a request until it is explained
+)
+
+
+class Histogram:
+    """Cumulative histogram of observed values with fixed bucket upper bounds."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class PipelineMetrics:
+    """
+    Collects the latency of every stage of the prediction pipeline, the batch sizes
+    and the number of processed jobs, and renders them in the Prometheus text format.
+
+    The metrics are collected by the process that runs the prediction manager,
+    so with the database queue every worker process has its own metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {stage: Histogram(LATENCY_BUCKETS) for stage in PIPELINE_STAGES}
+        self.batch_sizes = {
+            "classification": Histogram(BATCH_SIZE_BUCKETS),
+            "explanation": Histogram(BATCH_SIZE_BUCKETS),
+        }
+        # Number of jobs by their result (classified, explained, failed or expired)
+        self.jobs = {}
+        # Version of the served model (None until a model is loaded)
+        self.model_version = None
+
+    def observe(self, stage, seconds):
+        """Records the time (in seconds) that a stage took."""
+        with self._lock:
+            self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """Records the time of the enclosed block as the given stage."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time)
+
+    def observe_batch(self, pipeline, batch_size):
+        """Records the size of a classification or explanation batch."""
+        with self._lock:
+            self.batch_sizes[pipeline].observe(batch_size)
+
+    def count_jobs(self, result, count=1):
+        """Counts jobs with the given result."""
+        if count <= 0:
+            return
+        with self._lock:
+            self.jobs[result] = self.jobs.get(result, 0) + count
+
+    def set_model_version(self, version):
+        with self._lock:
+            self.model_version = version
+
+    def render(self, gauges=None, counters=None):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        Args:
+            gauges (dict): Additional gauges by name, as (help text, value) tuples.
+                Gauges without a value are left out.
+            counters (dict): Additional counters in the same form as the gauges.
+        """
+
+        lines = []
+        with self._lock:
+            lines += render_histograms(
+                "skinscan_prediction_stage_seconds",
+                "Time spent in each stage of the prediction pipeline.",
+                "stage",
+                self.stages,
+            )
+            lines += render_histograms(
+                "skinscan_prediction_batch_size",
+                "Number of jobs in each processed batch.",
+                "pipeline",
+                self.batch_sizes,
+            )
+
+            lines.append(
+                "# HELP skinscan_prediction_jobs_total Number of processed jobs by result."
+            )
+            lines.append("# TYPE skinscan_prediction_jobs_total counter")
+            for result, count in sorted(self.jobs.items()):
+                lines.append(
+                    f'skinscan_prediction_jobs_total{{result="{result}"}} {count}'
+                )
+
+            gauges = {
+                "skinscan_prediction_model_version": (
+                    "Version of the served model.",
+                    self.model_version,
+                ),
+                **(gauges or {}),
+            }
+
+        for metric_type, metrics in (("gauge", gauges), ("counter", counters or {})):
+            for name, (help_text, value) in metrics.items():
+                if value is None:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name} {format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def render_histograms(name, help_text, label, histograms):
+    """Renders a family of histograms that are distinguished by a single label."""
+
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for label_value, histogram in histograms.items():
+        labels = f'{label}="{label_value}"'
+        for upper_bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(
+                f'{name}_bucket{{{labels},le="{format_value(upper_bound)}"}} {count}'
+            )
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum{{{labels}}} {format_value(histogram.sum)}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+def format_value(value):
+    """Formats a number the way Prometheus expects it."""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,92 @@
+from contextlib import closing
+import numpy as np
+
+# Custom modules
+from application.mlsym.persistence import export_onnx, load_onnx_model_from_db
+from .backends import InferenceBackend
+from .database import connect_db
+from .inference import BATCH_BUCKETS
+
+
+class OnnxPredictor:
+    """
+    Classifies batches with an ONNX Runtime session of the exported model, with the
+    same interface as `CompiledPredictor`.
+
+    The session handles any batch size, so batches are not padded. Batches larger
+    than the largest bucket are still processed in chunks to bound the memory use.
+    """
+
+    def __init__(self, model_content, buckets=BATCH_BUCKETS, num_threads=None):
+        # ONNX Runtime is an optional dependency of this backend
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+
+        self.max_batch_size = max(buckets)
+        self.model_size = len(model_content)
+        self._session = onnxruntime.InferenceSession(
+            model_content, options, providers=["CPUExecutionProvider"]
+        )
+
+        # The image input is the only one with a rank of 4
+        inputs = self._session.get_inputs()
+        self._image_name = next(i.name for i in inputs if len(i.shape) == 4)
+        self._tabular_name = next(i.name for i in inputs if len(i.shape) != 4)
+
+    def predict(self, image_batch, tabular_batch):
+        """
+        Predicts the class probabilities of a batch.
+
+        Args:
+            image_batch (np.ndarray): Batch of preprocessed images (N, H, W, 3).
+            tabular_batch (np.ndarray): Batch of standardized tabular features (N, F).
+
+        Returns:
+            np.ndarray: Class probabilities for each sample (N, num_classes).
+        """
+
+        image_batch = np.asarray(image_batch, dtype=np.float32)
+        tabular_batch = np.asarray(tabular_batch, dtype=np.float32)
+
+        chunk_outputs = []
+        for start in range(0, len(image_batch), self.max_batch_size):
+            (outputs,) = self._session.run(
+                None,
+                {
+                    self._image_name: image_batch[start : start + self.max_batch_size],
+                    self._tabular_name: tabular_batch[
+                        start : start + self.max_batch_size
+                    ],
+                },
+            )
+            chunk_outputs.append(outputs)
+
+        return np.concatenate(chunk_outputs)
+
+
+class OnnxBackend(InferenceBackend):
+    """
+    Serves the classifications of a model with ONNX Runtime.
+
+    The ONNX export that is stored with the model version when it is saved is used.
+    Models that were saved without an export are exported when they are loaded.
+    """
+
+    name = "onnx"
+
+    def build_predictor(self, serving_model, db_path, calibration_data):
+        with closing(connect_db(db_path)) as conn:
+            model_content = load_onnx_model_from_db(conn, serving_model.version)
+        if model_content is None:
+            model_content = export_onnx(serving_model.model)
+        if model_content is None:
+            raise RuntimeError(
+                f"Model version {serving_model.version} has no ONNX export"
+            )
+
+        return OnnxPredictor(
+            model_content, serving_model.explainer.buckets, self.num_threads
+        )
@@ -4,297 +4,702 @@
 # * Contributor: <amirpooya78@gmail.com>
 # * Contributor: <arvinra@student.chalmers.se>
 # * Contributor: <kaisa.arumeel@gmail.com>
+import math
 import warnings
 import time
 import threading
-import base64
-import pickle
-import sqlite3
 from pathlib import Path
 import json
+from queue import Empty
 import tensorflow as tf
 import numpy as np
 
 import io
 from PIL import Image
+from django.conf import settings
 
 # Custom modules
-from application.views.jobs.state import PREDICTION_JOBS
-from application.mlsym.persistence import load_active_model_from_db
+from application.views.jobs.state import (
+    PREDICTION_JOBS,
+    EXPLANATION_JOBS,
+    PREDICTION_ADMISSION,
+    PIPELINE_METRICS,
+    RESULT_CACHE,
+)
 from .preprocess_user_data import (
     preprocess_images,
     extract_images,
     extract_tabular_features,
+    find_invalid_samples,
+    configure_preprocess_pool,
+)
+from .resources import configure_tensorflow_threads, set_thread_affinity
+from .inference import BATCH_BUCKETS
+from .explanations import render_heatmap, compute_feature_impact
+from .heatmap_artifacts import HeatmapEncoder
+from .database import (
+    get_db_path,
+    get_images_db_path,
+    get_db_connection,
+    close_db_connections,
+)
+from .database_queue import DatabaseJobQueue, find_expired_requests
+from .tflite_backend import TFLiteBackend
+from .onnx_backend import OnnxBackend
+from .serving_model import (
+    ModelReloader,
+    load_serving_model,
+    get_model_input_shape,
 )
 from application.models import Requests
 
 
-# Find the path to the database
-abs_db_path = "../db_app.sqlite3"
-
 # Event to signal model reload
 model_reload_event = threading.Event()
 
+# Event that is set once the first model is served
+serving_model_published = threading.Event()
+
+# Expiry time for pending jobs (in seconds)
+JOB_EXPIRY_TIME = 15 * 60
+
+# Guards the start of the prediction manager threads, which may be requested
+# by several request threads at once
+manager_lock = threading.Lock()
+manager_started = False
+
+# Input dimensions (height, width) of the served model, used to resize new requests
+# when they are admitted (None until a model is loaded)
+serving_input_shape = None
+# Version of the served model, used to look up cached results of new requests
+serving_model_version = None
+
+
+def manage_predictions(job_queue=None):
+    """
+    Runs the prediction loop.
+
+    Args:
+        job_queue (DatabaseJobQueue): The queue to take the jobs from in a standalone
+            worker process. By default the jobs are taken from the in-process queue.
+    """
 
-def manage_predictions():
     global PREDICTION_JOBS  # Global Job queue
-    BATCH_SIZE = 64  # Max number of jobs to process in one batch
-    INTERVAL = 3  # TODO decide actual time / make dynamic?
-    JOB_EXPIRY_TIME = 15 * 60  # Expiry time for pending jobs (in seconds)
+    # Max number of jobs to process in one batch
+    BATCH_SIZE = getattr(settings, "PREDICTION_MAX_BATCH_SIZE", 64)
+    # Max time (in seconds) to wait for more jobs after the first job of a batch arrives
+    MAX_BATCH_WAIT = getattr(settings, "PREDICTION_MAX_BATCH_WAIT", 0.05)
+    # Batch sizes that the compiled inference functions are traced for
+    BUCKETS = getattr(settings, "PREDICTION_BATCH_BUCKETS", BATCH_BUCKETS)
+    # Max time (in seconds) to block on an empty queue before checking for model reloads
+    IDLE_TIMEOUT = 1
+    # Time (in seconds) to wait before retrying when no model could be loaded
+    MODEL_RETRY_INTERVAL = 3
+    # Time (in seconds) between checks of the active model in a standalone worker
+    MODEL_CHECK_INTERVAL = 5
+    # Time (in seconds) between checks of the database for expired requests
+    EXPIRY_CHECK_INTERVAL = 60
+
+    # Keep the prediction thread (and the thread pools that it starts) on its CPUs
+    set_thread_affinity(getattr(settings, "PREDICTION_CPU_AFFINITY", None))
+
+    # Use the same database as Django
+    db_path = get_db_path()
+
+    # Backend that classifies the batches (None serves the float model)
+    backend = get_inference_backend()
 
     # Enable repeated warnings (otherwise subsequent matching warnings are silenced)
     warnings.simplefilter("always", UserWarning)
 
-    # Load the active model from the database
-    model, hyperparameters, model_version = load_active_model_from_db(abs_db_path)
-
-    # Global explainer
-    explainer = None
+    # Loads and warms up models in the background
+    reloader = ModelReloader(db_path, BUCKETS, backend)
 
-    if model != None:
-        # Load the feature scaler and decoders
-        tabular_scaler = get_scaler(hyperparameters)
-        localization_encoder, lesion_type_encoder = get_encoders(hyperparameters)
+    # Load the active model from the database before serving the first batch
+    serving_model = load_serving_model(db_path, BUCKETS, backend)
+    publish_serving_model(serving_model)
+    if serving_model is not None:
+        PIPELINE_METRICS.set_model_version(serving_model.version)
+    last_model_check = time.monotonic()
+    last_expiry_check = time.monotonic()
 
     # Predictions loop
     while True:
-        # Sleep thread to periodically check Job queue and not block app execution
-        time.sleep(INTERVAL)
-
         # Check if the active model should be reloaded
-        if model_reload_event.is_set() or model == None:
-            print("Reloading model...")
-            model, hyperparameters, model_version = load_active_model_from_db(
-                abs_db_path
-            )
+        if model_reload_event.is_set():
             # Clear the event for reuse
             model_reload_event.clear()
 
-            # Verify that the model was successfully loaded
-            if model == None:
+            # Load and warm up the new model without blocking the queue
+            print("Reloading model...")
+            reloader.request_reload()
+
+        # A standalone worker cannot be signalled by the web server,
+        # so it checks the active model version in the database instead
+        if (
+            job_queue is not None
+            and serving_model is not None
+            and time.monotonic() - last_model_check > MODEL_CHECK_INTERVAL
+        ):
+            last_model_check = time.monotonic()
+            if (
+                job_queue.get_active_model_version() != serving_model.version
+                and not reloader.is_reloading()
+            ):
+                print("Active model changed, reloading model...")
+                reloader.request_reload()
+
+        # Swap in the reloaded model once it is warmed up. This only happens
+        # between batches, so in-flight batches keep using the previous model
+        reloaded_model = reloader.take_ready_model()
+        if reloaded_model is not None:
+            serving_model = reloaded_model
+            publish_serving_model(serving_model)
+            PIPELINE_METRICS.set_model_version(serving_model.version)
+            print(f"Serving model version {serving_model.version}")
+
+        # Verify that a model is available
+        if serving_model is None:
+            if not reloader.is_reloading():
                 warnings.warn(
                     "Active model could not be loaded from database",
                     category=UserWarning,
                 )
-                # Skip this loop iteration to attempt to reload the model
-                continue
+                # Attempt to load the model again in the background
+                reloader.request_reload()
 
-            # Reload the feature scaler and encoders
-            tabular_scaler = get_scaler(hyperparameters)
-            localization_encoder, lesion_type_encoder = get_encoders(hyperparameters)
+            # Wait before the next loop iteration to check for the loaded model
+            time.sleep(MODEL_RETRY_INTERVAL)
+            continue
+
+        if job_queue is None:
+            # Block until jobs are put on the global queue and coalesce them into a batch
+            jobs_batch, expired_jobs = wait_for_jobs(
+                BATCH_SIZE, MAX_BATCH_WAIT, JOB_EXPIRY_TIME, IDLE_TIMEOUT
+            )
+        else:
+            # Claim a batch of the pending requests in the database
+            jobs_batch, expired_jobs = job_queue.wait_for_jobs(
+                BATCH_SIZE,
+                MAX_BATCH_WAIT,
+                JOB_EXPIRY_TIME,
+                IDLE_TIMEOUT,
+                serving_model.input_shape,
+            )
 
-        # Extract jobs from the global queue
-        jobs_batch, expired_jobs = extract_jobs_from_queue(BATCH_SIZE, JOB_EXPIRY_TIME)
+        # Jobs are only checked for expiry when they are dequeued, so the requests
+        # in the database that expired behind a long queue are looked up as well
+        if (
+            job_queue is None
+            and time.monotonic() - last_expiry_check > EXPIRY_CHECK_INTERVAL
+        ):
+            last_expiry_check = time.monotonic()
+            expired_jobs.extend(
+                find_expired_requests(
+                    get_db_connection(db_path),
+                    JOB_EXPIRY_TIME,
+                    getattr(settings, "PREDICTION_JOB_LEASE_TIME", 300),
+                )
+            )
 
         # Delete expired jobs (Request records) from the database
         if expired_jobs:
             delete_jobs_from_db(expired_jobs)
+            PIPELINE_METRICS.count_jobs("expired", len(expired_jobs))
 
         # If there are no Jobs to be processed, skip this loop iteration
         if not jobs_batch:
             continue
 
         print("Processing predictions...")
+        batch_start_time = time.perf_counter()
 
-        # Prepare resized images that fit the model input size
-        resized_images = preprocess_images(
-            extract_images(jobs_batch), get_model_input_shape(model)
-        )
-
-        # Extract the tabular features
-        tabular_features, feature_names = extract_tabular_features(
-            jobs_batch, tabular_scaler, localization_encoder
-        )
+        # Jobs that were handed over to the explanation stage are no longer
+        # owned by this loop, so they must not be marked as failed here
+        explained_jobs = set()
 
         try:
-            predictions, valid_indices = process_predictions(
-                model, resized_images, tabular_features
-            )
-
-            for batch_idx, original_idx in enumerate(valid_indices):
-                job = jobs_batch[original_idx]
-                prediction = predictions[batch_idx]
-                predicted_class_index = np.argmax(prediction)
-
-                # Prepare single-sample inputs for Grad-CAM
-                image_input = np.expand_dims(resized_images[original_idx], axis=0)
-                tabular_input = np.expand_dims(tabular_features[original_idx], axis=0)
-
-                # Compute grad cam for the image
-                heatmap = compute_grad_cam(
-                    model,
-                    [image_input, tabular_input],
-                    predicted_class_index,
-                    original_image_shape=(
-                        224,
-                        224,
-                    ),
+            # The metrics are recorded within the guarded block,
+            # so that they cannot stop the prediction loop
+            dequeued_at = time.time()
+            for job in jobs_batch:
+                PIPELINE_METRICS.observe(
+                    "queue_wait", max(dequeued_at - job.queued_at, 0)
+                )
+            PIPELINE_METRICS.observe_batch("classification", len(jobs_batch))
+
+            # Prepare resized images that fit the model input size
+            with PIPELINE_METRICS.time("image_preprocessing"):
+                resized_images = preprocess_images(
+                    extract_images(jobs_batch),
+                    serving_model.input_shape,
+                    serving_model.normalize_inputs,
                 )
 
-                # We can calculate the importance of the image
-                # by taking the mean activation value for each pixel
-                image_importance = np.mean(heatmap[0])
-
-                # Compute feature importance for tabular data
-                tabular_importances = compute_tabular_importance(
-                    model, [image_input, tabular_input], predicted_class_index
+            # Extract the tabular features
+            with PIPELINE_METRICS.time("tabular_encoding"):
+                tabular_features, feature_names = extract_tabular_features(
+                    jobs_batch,
+                    serving_model.tabular_scaler,
+                    serving_model.localization_encoder,
                 )
 
-                # Combine all importance values
-                all_importances = np.concatenate(
-                    [[image_importance], tabular_importances]
+            # Leave out the samples that cannot be classified,
+            # so that they do not make the whole batch fail
+            invalid_indices = find_invalid_samples(resized_images, tabular_features)
+            if invalid_indices:
+                update_failed_jobs_in_db(
+                    db_path, [jobs_batch[i] for i in invalid_indices]
+                )
+                invalid_samples = set(invalid_indices)
+                valid_samples = [
+                    i for i in range(len(jobs_batch)) if i not in invalid_samples
+                ]
+                jobs_batch = [jobs_batch[i] for i in valid_samples]
+                resized_images = resized_images[valid_samples]
+                tabular_features = tabular_features[valid_samples]
+                if not jobs_batch:
+                    continue
+
+            # Classify the batch with a single forward pass
+            with PIPELINE_METRICS.time("forward_pass"):
+                predictions, valid_indices = process_predictions(
+                    serving_model.predictor.predict, resized_images, tabular_features
                 )
 
-                # Calculate relative percentages
-                # we dont care about direction only magnitude
-                total_importance = np.sum(np.abs(all_importances))
-                relative_importances = (
-                    np.abs(all_importances) / total_importance
-                ) * 100
-
-                # Encode heatmap as binary
-                job.heatmap_binary = encode_heatmap_to_binary(heatmap)
-                print("Heat map is processed.")
-
-                # Map importance values to feature names
-                job.feature_impact = {
-                    "image": float(relative_importances[0]),
-                    **{
-                        name: float(importance)
-                        for name, importance in zip(
-                            feature_names, relative_importances[1:]
-                        )
-                    },
-                }
             valid_jobs = [jobs_batch[i] for i in valid_indices]
-            valid_predictions = predictions
             if valid_jobs:
-                # Update the requests table in the database with the results
-                update_requests_in_db(
-                    abs_db_path,
+                # Write the classification results right away,
+                # so they are visible before the explanations are ready
+                write_time = update_classifications_in_db(
+                    db_path,
                     valid_jobs,
-                    valid_predictions,
-                    lesion_type_encoder,
-                    model_version,
+                    predictions,
+                    serving_model.lesion_type_encoder,
+                    serving_model.version,
                 )
-            # Log failed predictions
-            failed_indices = set(range(len(jobs_batch))) - set(valid_indices)
-            if failed_indices:
-                failed_job_ids = [
-                    jobs_batch[i].parameters["request_id"] for i in failed_indices
-                ]
-                print(f"Failed to process jobs with IDs: {failed_job_ids}")
+
+                # Hand the classified jobs over to the explanation stage
+                if write_time is not None:
+                    PIPELINE_METRICS.observe("classification_write", write_time)
+                    PIPELINE_METRICS.count_jobs("classified", len(valid_jobs))
+                    for original_idx in valid_indices:
+                        job = jobs_batch[original_idx]
+                        job.classified_at = time.time()
+                        # Explain with the same model version that classified the job
+                        job.explainer = serving_model.explainer
+                        job.resized_image = resized_images[original_idx]
+                        job.tabular_features = tabular_features[original_idx]
+                        job.feature_names = feature_names
+                        # Blocks while the explanation queue is full, which holds
+                        # back the classification until the explanations catch up
+                        EXPLANATION_JOBS.put(job)
+                        explained_jobs.add(id(job))
+            # Mark the requests that could not be classified or stored as failed
+            failed_jobs = [job for job in jobs_batch if id(job) not in explained_jobs]
+            if failed_jobs:
+                update_failed_jobs_in_db(db_path, failed_jobs)
         except Exception as e:
             print(f"Error during prediction processing: {e}")
+            update_failed_jobs_in_db(
+                db_path, [job for job in jobs_batch if id(job) not in explained_jobs]
+            )
+            continue
+        finally:
+            # Report the throughput used to estimate the wait of new requests
+            PREDICTION_ADMISSION.record_batch(
+                len(jobs_batch), time.perf_counter() - batch_start_time
+            )
+
+
+def manage_explanations():
+    global EXPLANATION_JOBS  # Global queue of classified jobs
+    # Max number of jobs to explain in one batch
+    BATCH_SIZE = getattr(settings, "PREDICTION_MAX_BATCH_SIZE", 64)
+    # Max time (in seconds) to wait for more jobs after the first job of a batch arrives
+    MAX_BATCH_WAIT = getattr(settings, "PREDICTION_MAX_BATCH_WAIT", 0.05)
+    # Max time (in seconds) to block on an empty queue
+    IDLE_TIMEOUT = 1
+
+    # The explanations are computed on the same CPUs as the classifications
+    set_thread_affinity(getattr(settings, "PREDICTION_CPU_AFFINITY", None))
+
+    # Use the same database as Django
+    db_path = get_db_path()
+
+    # Encodes the heatmaps in the configured format
+    heatmap_encoder = HeatmapEncoder(
+        getattr(settings, "PREDICTION_HEATMAP_FORMAT", "webp"),
+        getattr(settings, "PREDICTION_HEATMAP_QUALITY", 90),
+        getattr(settings, "PREDICTION_HEATMAP_SIZE", None),
+        getattr(settings, "PREDICTION_STORE_CAM_GRID", False),
+    )
+
+    # Explanations loop
+    while True:
+        # Classified jobs do not expire, as their results are already stored
+        jobs_batch, _ = wait_for_jobs(
+            BATCH_SIZE, MAX_BATCH_WAIT, math.inf, IDLE_TIMEOUT, EXPLANATION_JOBS
+        )
+
+        # If there are no Jobs to be explained, skip this loop iteration
+        if not jobs_batch:
             continue
 
+        # Group the jobs by the model version that classified them,
+        # as a model swap can happen between two classification batches
+        jobs_by_explainer = {}
+        for job in jobs_batch:
+            jobs_by_explainer.setdefault(job.explainer, []).append(job)
+
+        batch_start_time = time.perf_counter()
+        for explainer, jobs in jobs_by_explainer.items():
+            try:
+                explain_jobs(db_path, explainer, jobs, heatmap_encoder)
+            except Exception as e:
+                print(f"Error during explanation processing: {e}")
+                update_failed_jobs_in_db(db_path, jobs)
+            finally:
+                # Release the preprocessed inputs and the model of the jobs
+                for job in jobs:
+                    job.explainer = None
+                    job.resized_image = None
+                    job.tabular_features = None
+
+        # Report the throughput of the explanations, which usually limits the pipeline
+        PREDICTION_ADMISSION.record_explanation_batch(
+            len(jobs_batch), time.perf_counter() - batch_start_time
+        )
+
+
+def explain_jobs(db_path, explainer, jobs_batch, heatmap_encoder):
+    """
+    Computes the heatmaps and the feature impacts of a batch of classified jobs
+    and writes them to the database.
+    """
+
+    print("Processing explanations...")
+
+    dequeued_at = time.time()
+    for job in jobs_batch:
+        PIPELINE_METRICS.observe(
+            "explanation_wait", max(dequeued_at - job.classified_at, 0)
+        )
+    PIPELINE_METRICS.observe_batch("explanation", len(jobs_batch))
+
+    resized_images = np.stack([job.resized_image for job in jobs_batch])
+    tabular_features = np.stack([job.tabular_features for job in jobs_batch])
+
+    # Explain the batch in a single forward/backward pass
+    with PIPELINE_METRICS.time("gradients"):
+        explanations, valid_indices = process_predictions(
+            explainer.explain, resized_images, tabular_features
+        )
+
+    for batch_idx, original_idx in enumerate(valid_indices):
+        job = jobs_batch[original_idx]
+        _, cams, tabular_importances = explanations
+
+        # Render the grad cam of the predicted class on top of the image
+        with PIPELINE_METRICS.time("heatmap_rendering"):
+            heatmap = render_heatmap(cams[batch_idx], resized_images[original_idx])
+
+        # Encode the heatmap artifacts once, so they can be served as is
+        with PIPELINE_METRICS.time("heatmap_encoding"):
+            job.heatmap_artifacts = heatmap_encoder.encode(cams[batch_idx], heatmap)
+        print("Heat map is processed.")
+
+        # Combine the image and tabular importances into relative percentages
+        job.feature_impact = compute_feature_impact(
+            heatmap[0], tabular_importances[batch_idx], job.feature_names
+        )
+
+    valid_jobs = [jobs_batch[i] for i in valid_indices]
+    stored_jobs = set()
+    if valid_jobs:
+        # Update the requests table in the database with the explanations
+        write_time = update_explanations_in_db(db_path, valid_jobs)
+        if write_time is not None:
+            stored_jobs = {id(job) for job in valid_jobs}
+            PIPELINE_METRICS.observe("explanation_write", write_time)
+            PIPELINE_METRICS.count_jobs("explained", len(valid_jobs))
+
+            explained_at = time.time()
+            for job in valid_jobs:
+                PIPELINE_METRICS.observe(
+                    "end_to_end", max(explained_at - job.queued_at, 0)
+                )
+                cache_result(job)
+
+    # Mark the requests that could not be explained or stored as failed,
+    # their classification is kept
+    failed_jobs = [job for job in jobs_batch if id(job) not in stored_jobs]
+    if failed_jobs:
+        update_failed_jobs_in_db(db_path, failed_jobs)
+
 
 ############################### HELPER FUNCTIONS ###############################
 
 
-def process_predictions(model, resized_images, tabular_features):
+def cache_result(job):
+    """Caches the result of an explained job, so resubmissions are answered right away."""
+
+    # Recovered jobs have no content key, as their original image is not decoded again
+    content_key = getattr(job, "content_key", None)
+    if content_key is None:
+        return
+
+    RESULT_CACHE.put(
+        content_key,
+        job.classification["model"],
+        {
+            **job.classification,
+            "feature_impact": json.dumps(job.feature_impact),
+            **job.heatmap_artifacts,
+        },
+    )
+
+
+def process_predictions(model_fn, resized_images, tabular_features):
+    """
+    Runs a batch through a model function (the classification or the explanation).
+
+    If the batch fails, it is split in halves that are processed separately, down
+    to single samples, until the failing samples are isolated. A single bad sample
+    in a batch of n samples therefore only takes O(log n) extra calls.
+
+    Args:
+        model_fn (callable): Function of an image batch and a tabular batch that
+            returns an array or a tuple of arrays with the batch as first axis.
+        resized_images (np.ndarray): Batch of preprocessed images (N, H, W, 3).
+        tabular_features (np.ndarray): Batch of standardized tabular features (N, F).
+
+    Returns:
+        tuple: A tuple containing:
+            - The outputs of `model_fn` for the valid samples (None if all failed).
+            - List of the indices of the valid samples.
+    """
+
     try:
-        # First we try to perform predictions on the entire batch
-        predictions = model.predict([resized_images, tabular_features])
+        # First we try to process the entire batch at once
+        outputs = model_fn(resized_images, tabular_features)
         # If success then the indices remain the same
         valid_indices = list(range(len(resized_images)))
-        return predictions, valid_indices
+        return outputs, valid_indices
     except Exception as e:
-        print(f"Batch prediction failed: {e}. Falling back to individual processing...")
+        print(f"Batch prediction failed: {e}. Bisecting the batch...")
 
-        # If batch prediction fails, process each image individually
-        # throwing out failed predictions
-        predictions = []
-        valid_indices = []
+    # Outputs of the sub-batches that succeeded, in the order of the batch
+    results = []
+    valid_indices = []
 
-        for i in range(len(resized_images)):
-            try:
-                # Retrieve single image and tabular input
-                image_input = np.expand_dims(resized_images[i], axis=0)
-                tabular_input = np.expand_dims(tabular_features[i], axis=0)
+    def process_range(start, end):
+        try:
+            # Slicing keeps the batch dimension
+            results.append(
+                model_fn(resized_images[start:end], tabular_features[start:end])
+            )
+            valid_indices.extend(range(start, end))
+        except Exception as error:
+            if end - start == 1:
+                print(f"Failed to process image {start}: {error}")
+                return
 
-                # Perform the prediction
-                pred = model.predict([image_input, tabular_input])
+            # Process both halves separately to isolate the failing samples
+            middle = (start + end) // 2
+            process_range(start, middle)
+            process_range(middle, end)
 
-                # Store successful prediction and its index
-                # so that the rest of the function can find it
-                predictions.append(pred[0])
-                valid_indices.append(i)
+    # The whole batch has already failed, so start with its halves
+    if len(resized_images) > 1:
+        middle = len(resized_images) // 2
+        process_range(0, middle)
+        process_range(middle, len(resized_images))
 
-            except Exception as individual_error:
-                print(f"Failed to process image {i}: {individual_error}")
-                continue
+    # Return no outputs if all samples failed
+    if not results:
+        return None, valid_indices
 
-        # Convert predictions list back to numpy array
-        # to match the original shape
-        if predictions:
-            predictions = np.array(predictions)
+    # Concatenate the sub-batch results back to batch arrays
+    # to match the original shape
+    outputs = tf.nest.map_structure(lambda *arrays: np.concatenate(arrays), *results)
 
-        # Return the predictions and valid indices
-        return predictions, valid_indices
+    # Return the outputs and valid indices
+    return outputs, valid_indices
 
 
 def start_prediction_manager():
-    # Create separate thread that will manage predictions
+    """
+    Starts the prediction manager threads of this process, unless they are running.
+
+    The jobs of the requests that were not finished before the last restart are
+    put on the queue again, as the previous queue was lost with its process. The
+    manager is started by the first request that needs it rather than when the
+    process starts, so that management commands do not load a model.
+    """
+
+    global manager_started
+    with manager_lock:
+        if manager_started:
+            return
+        manager_started = True
+
+    configure_inference_resources()
+
+    # Requests created from now on are queued by CreateRequest itself
+    job_queue = DatabaseJobQueue(get_db_path())
+    max_request_id = job_queue.get_max_request_id()
+
+    # Create separate threads that will manage predictions and explanations
     # daemon=True ensures thread is terminated alongside main thread
     prediction_thread = threading.Thread(daemon=True, target=manage_predictions)
+    explanation_thread = threading.Thread(daemon=True, target=manage_explanations)
+    recovery_thread = threading.Thread(
+        daemon=True, target=recover_prediction_jobs, args=(job_queue, max_request_id)
+    )
 
-    # Initialise thread
+    # Initialise threads
     prediction_thread.start()
+    explanation_thread.start()
+    recovery_thread.start()
 
 
-def signal_model_reload():
-    # Set event to signal model reload
-    model_reload_event.set()
+def recover_prediction_jobs(job_queue, max_request_id):
+    """
+    Puts the unfinished requests up to `max_request_id` on the prediction queue.
+
+    The images are decoded from the stored request again, once the first model
+    is served, so that they are resized to its input size. Putting a job blocks
+    while the queue is full, so the recovered jobs are admitted as the prediction
+    thread drains the queue. Queueing a request twice is harmless, as its results
+    are overwritten.
+    """
+
+    # The jobs cannot be classified before a model is loaded anyway
+    serving_model_published.wait()
+
+    recovered = 0
+    try:
+        for job in job_queue.iter_unfinished_jobs(
+            JOB_EXPIRY_TIME, get_serving_input_shape(), max_request_id
+        ):
+            PREDICTION_JOBS.put(job)
+            recovered += 1
+    except Exception as e:
+        print(f"Error recovering unfinished requests: {e}")
+    finally:
+        # The connection of the recovery thread is not used after it exits
+        close_db_connections()
+
+    if recovered:
+        print(f"Recovered {recovered} unfinished requests")
+
+
+def run_prediction_worker():
+    """
+    Runs a standalone prediction worker that processes the pending requests
+    in the database. Blocks forever.
+    """
+
+    configure_inference_resources()
+
+    # Explanations are computed on a separate thread of the worker process
+    explanation_thread = threading.Thread(daemon=True, target=manage_explanations)
+    explanation_thread.start()
 
+    print("Prediction worker started")
+    manage_predictions(
+        DatabaseJobQueue(
+            get_db_path(),
+            lease_time=getattr(settings, "PREDICTION_JOB_LEASE_TIME", 300),
+        )
+    )
+
+
+def configure_inference_resources():
+    """
+    Sizes the thread pools of the prediction pipeline from the settings. This must
+    run before the first model is loaded, as TensorFlow creates its pools then.
+    """
 
-def get_model_input_shape(model):
-    # Extract the input shape from the model
-    target_input_shape = model.input_shape[0]
+    configure_tensorflow_threads(
+        getattr(settings, "PREDICTION_INTRA_OP_THREADS", None),
+        getattr(settings, "PREDICTION_INTER_OP_THREADS", None),
+    )
+    configure_preprocess_pool(getattr(settings, "PREDICTION_PREPROCESS_THREADS", None))
+
+
+def get_inference_backend():
+    """Returns the configured inference backend, or None for the float model."""
+
+    backend = getattr(settings, "PREDICTION_INFERENCE_BACKEND", "tensorflow")
+    if backend == "tensorflow":
+        return None
+    if backend == "tflite":
+        return TFLiteBackend(
+            getattr(settings, "PREDICTION_TFLITE_QUANTIZATION", "dynamic"),
+            getattr(settings, "PREDICTION_BACKEND_CALIBRATION_SAMPLES", 64),
+            getattr(settings, "PREDICTION_BACKEND_MIN_AGREEMENT", 0.95),
+            getattr(settings, "PREDICTION_BACKEND_NUM_THREADS", None),
+            get_images_db_path(),
+        )
+    if backend == "onnx":
+        return OnnxBackend(
+            getattr(settings, "PREDICTION_BACKEND_CALIBRATION_SAMPLES", 64),
+            getattr(settings, "PREDICTION_BACKEND_MIN_AGREEMENT", 0.95),
+            getattr(settings, "PREDICTION_BACKEND_NUM_THREADS", None),
+            get_images_db_path(),
+        )
+    raise ValueError(f"Unknown inference backend: {backend}")
 
-    # Extract target height and width from input shape tuple
-    target_height, target_width = target_input_shape[1:3]
 
-    # Return target height and width
-    return (target_height, target_width)
+def publish_serving_model(serving_model):
+    """Makes the input dimensions and the version of the served model available to new requests."""
+    global serving_input_shape, serving_model_version
+    if serving_model is not None:
+        serving_input_shape = serving_model.input_shape
+        serving_model_version = serving_model.version
+        serving_model_published.set()
 
 
-def get_scaler(hyperparameters):
-    # Decode and unpickle the scaler
-    encoded_scaler = hyperparameters["tabular_scaler"]
-    pickled_scaler = base64.b64decode(encoded_scaler)
+def get_serving_input_shape():
+    """Returns the input dimensions (height, width) of the served model, or None."""
+    return serving_input_shape
 
-    # Return Scaler object
-    return pickle.loads(pickled_scaler)
 
+def get_serving_model_version():
+    """Returns the version of the served model, or None."""
+    return serving_model_version
 
-def get_encoders(hyperparameters):
-    # Decode and unpickle the localization encoder
-    encoded_loc_encoder = hyperparameters["localization_encoder"]
-    pickled_loc_encoder = base64.b64decode(encoded_loc_encoder)
-    localization_encoder = pickle.loads(pickled_loc_encoder)
-    # Decode and unpickle the lesion_type encoder
-    encoded_lesion_encoder = hyperparameters["lesion_type_encoder"]
-    pickled_lesion_encoder = base64.b64decode(encoded_lesion_encoder)
-    lesion_type_encoder = pickle.loads(pickled_lesion_encoder)
 
-    # Return Encoder objects
-    return localization_encoder, lesion_type_encoder
+def signal_model_reload():
+    # The cached results were produced by the previous model
+    RESULT_CACHE.clear()
 
+    # Set event to signal model reload
+    model_reload_event.set()
 
-def extract_jobs_from_queue(BATCH_SIZE, JOB_EXPIRY_TIME):
+
+def wait_for_jobs(
+    BATCH_SIZE, MAX_BATCH_WAIT, JOB_EXPIRY_TIME, IDLE_TIMEOUT, job_queue=None
+):
     """
-    Extracts a batch of valid jobs from the queue and identifies expired jobs.
+    Waits for jobs to arrive in the queue and coalesces them into a batch.
 
-    This function dequeues jobs from the global queue (`PREDICTION_JOBS`) up to the
-    specified `BATCH_SIZE`, checks if any are expired based on `JOB_EXPIRY_TIME`,
-    and returns two lists:
-    1. A list of valid job objects.
-    2. A list of expired job IDs for deletion.
+    This function blocks on the job queue (`PREDICTION_JOBS` by default) until the first
+    valid job arrives, which wakes it up immediately instead of polling. It then keeps
+    collecting jobs for at most `MAX_BATCH_WAIT` seconds, or until `BATCH_SIZE` jobs
+    have been collected. Jobs that are already queued when the window closes are
+    still added to the batch without waiting. Jobs that were queued longer than
+    `JOB_EXPIRY_TIME` ago are returned as expired and do not count towards the
+    batch size.
 
     Args:
         BATCH_SIZE (int): Maximum number of jobs to retrieve.
+        MAX_BATCH_WAIT (float): Max time (seconds) to wait for more jobs after the first one.
         JOB_EXPIRY_TIME (int): Expiry time for pending jobs (seconds)
+        IDLE_TIMEOUT (float): Max time (seconds) to block while the queue is empty.
+        job_queue (Queue): The queue to take the jobs from.
 
     Returns:
         tuple: A tuple containing:
@@ -302,17 +707,31 @@ def extract_jobs_from_queue(BATCH_SIZE, JOB_EXPIRY_TIME):
             - List of expired job IDs.
     """
 
-    current_time = time.time()  # Current UNIX timestamp
+    if job_queue is None:
+        job_queue = PREDICTION_JOBS
 
     jobs_batch = []  # List to collect valid jobs
     expired_jobs = []  # List to collect expired job IDs
+    deadline = None  # End of the batching window, set when the first valid job arrives
+
+    while len(jobs_batch) < BATCH_SIZE:
+        # Block until the first valid job arrives, then only wait until the deadline
+        if deadline is None:
+            timeout = IDLE_TIMEOUT
+        else:
+            timeout = deadline - time.monotonic()
 
-    # Dequeue valid jobs and check for expired ones
-    while not PREDICTION_JOBS.empty() and len(jobs_batch) < BATCH_SIZE:
-        job = PREDICTION_JOBS.get()  # Dequeue the next job from the queue
+        try:
+            if timeout > 0:
+                job = job_queue.get(timeout=timeout)
+            else:
+                # The window has closed, only take jobs that are already queued
+                job = job_queue.get_nowait()
+        except Empty:
+            break
 
         # Check if the job is expired using its start_time
-        if current_time - job.start_time > JOB_EXPIRY_TIME:
+        if time.time() - job.start_time > JOB_EXPIRY_TIME:
             job_id = job.parameters["request_id"]
             print(
                 f"Job {job_id} expired. Deleting corresponding Request record from database..."
@@ -324,199 +743,165 @@ def extract_jobs_from_queue(BATCH_SIZE, JOB_EXPIRY_TIME):
             # Append valid job objects to the batch
             jobs_batch.append(job)
 
+            # Open the batching window when the first valid job arrives
+            if deadline is None:
+                deadline = time.monotonic() + MAX_BATCH_WAIT
+
     return jobs_batch, expired_jobs
 
 
-def update_requests_in_db(
-    db_path, jobs_batch, predictions, lesion_type_encoder, model_version
-):
+def execute_batch_update(db_path, query, rows):
     """
-    Update the Requests table with the predictions for the given Jobs batch.
+    Executes an update query for all rows of a batch with a single `executemany`
+    in one transaction over the persistent connection of the calling thread.
+
+    Returns:
+        bool: True if the update succeeded.
     """
 
-    # Connect to the database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    conn = get_db_connection(db_path)
 
     try:
-        # Prepare Request table updates
-        for job, prediction in zip(jobs_batch, predictions, strict=True):
-            # Extract the request id from the job_id as they are the same
-            request_id = job.job_id
-            # Extract the probability of the predicted class
-            probability = float(np.max(prediction))
-
-            # Get the index of the predicted class
-            predicted_class_index = np.argmax(prediction)
-            # Decode the label (return value is a list so we access the first element)
-            predicted_label = lesion_type_encoder.inverse_transform(
-                [predicted_class_index]
-            )[0]
-
-            # Convert job.feature_impact to JSON string
-            ser_feature_impact = json.dumps(job.feature_impact)
-
-            # Extract binary heatmap from the job
-            heatmap_binary = getattr(job, "heatmap_binary", None)
-
-            # Update database query
-            cursor.execute(
-                """
-                UPDATE requests
-                SET probability = ?, lesion_type = ?, model = ?, 
-                    feature_impact = ?, heatmap = ?
-                WHERE request_id = ?;
-                """,
-                (
-                    probability,
-                    predicted_label,
-                    model_version,
-                    ser_feature_impact,
-                    heatmap_binary,
-                    request_id,
-                ),
-            )
-
-        # Commit database transaction
-        conn.commit()
+        # Update all rows of the batch in one transaction
+        with conn:
+            conn.executemany(query, rows)
     except Exception as e:
-        # Rollback if there was an error
-        conn.rollback()
+        # The transaction is rolled back by the context manager, and the
+        # callers mark the requests of a failed update as failed
         print(f"Error updating database request table: {e}")
-        # TODO error handling of processed jobs, add to some other queue?
-    finally:
-        # Close database connection
-        conn.close()
+        return False
 
+    return True
 
-def delete_jobs_from_db(job_ids):
-    """Delete jobs from the database based on their job_ids."""
-    try:
-        Requests.objects.filter(request_id__in=job_ids).delete()
-        print(f"Jobs {job_ids} deleted successfully.")
-    except Exception as e:
-        print(f"Error deleting jobs {job_ids}: {e}")
 
+def update_classifications_in_db(
+    db_path, jobs_batch, predictions, lesion_type_encoder, model_version
+):
+    """
+    Update the Requests table with the predictions for the given Jobs batch.
 
-def compute_tabular_importance(model, inputs, predicted_class_index):
-    # By utilizing the gradient tape we track the gradient/derivative
-    # and can calculate its importance
-
-    # Ensure inputs are tensors with valid data types
-    image_input = tf.convert_to_tensor(inputs[0], dtype=tf.float32)
-    tabular_input = tf.convert_to_tensor(inputs[1], dtype=tf.float32)
-
-    # Create new tape to record all tensor operations
-    with tf.GradientTape() as tape:
-        # Ensure we only watch the tabular_input tensor
-        tape.watch(tabular_input)
-        # Invoke a prediction without using the predict wrapper
-        # as that doesnt allow us to track the gradient
-        pred = model([image_input, tabular_input])
-        # Retrieve the first batch prediction
-        first_batch_prediction = pred[0, predicted_class_index]
-
-    # Calculate partial derivative with respect to
-    # each input feature in the tabular data.
-    # We do this because this tells use how much the
-    # first batch prediction changes when we change
-    # the input feature by a small amount
-    gradients = tape.gradient(first_batch_prediction, tabular_input)
-
-    # Calculate the feature importance by taking the absolute value
-    # of all the gradients. We do this because we are only interested
-    # in the magnitude of the impact of each feature
-    feature_importance = tf.abs(gradients).numpy()[0]
+    Returns:
+        float: The write latency in seconds, or None if the update failed.
+    """
 
-    return feature_importance
+    start_time = time.perf_counter()
 
+    predictions = np.asarray(predictions)
 
-def compute_grad_cam(model, inputs, predicted_class_index, original_image_shape):
-    import cv2
-    import numpy as np
+    # Get the index and the probability of the predicted class for every sample
+    predicted_class_indices = np.argmax(predictions, axis=1)
+    probabilities = predictions[np.arange(len(predictions)), predicted_class_indices]
 
-    # Get the last conv layer from DenseNet121
-    last_conv_layer = model.get_layer("conv5_block16_2_conv")
+    # Decode all labels at once
+    predicted_labels = lesion_type_encoder.inverse_transform(predicted_class_indices)
 
-    # Create an instance of the model that returns the same shape
-    # as the last conv layer and the model output.
-    # We cant reuse the model as it has a different output shape
-    grad_model = tf.keras.models.Model(
-        inputs=model.inputs, outputs=[last_conv_layer.output, model.output]
-    )
+    # The lease of a claimed request is renewed, so that it covers the explanation
+    # stage and the request is not claimed again by another worker meanwhile
+    claimed_at = int(time.time())
 
-    with tf.GradientTape() as tape:
-        # We dont need to track the features here
-        # as that is done automatically because these layers
-        # are trainable
-        conv_outputs, predictions = grad_model(inputs)
-        # Select all probabilities for the predicted class
-        # for all samples in the batch
-        all_batch_predictions = predictions[:, predicted_class_index]
-
-    # Calculate derivative of the predicted class
-    # with respect to the conv layer features.
-    # The higher this value the more the output would change
-    # if we change that particular feature
-    derivatives = tape.gradient(all_batch_predictions, conv_outputs)
+    # Prepare Request table updates
+    rows = [
+        (
+            float(probability),
+            str(predicted_label),
+            model_version,
+            claimed_at,
+            # The request id is the same as the job_id
+            job.job_id,
+        )
+        for job, probability, predicted_label in zip(
+            jobs_batch, probabilities, predicted_labels, strict=True
+        )
+    ]
 
-    # For each conv feature calculate its importance
-    # for the predicted class across the entire image
-    average_derivative = tf.reduce_mean(derivatives, axis=(0, 1, 2))
+    query = """
+        UPDATE requests
+        SET probability = ?, lesion_type = ?, model = ?, status = 'classified',
+            claimed_at = ?
+        WHERE request_id = ?;
+    """
 
-    # Reshape so that they are compatible with outputs of
-    # the convolutional layer to calculate impact for each feature
-    average_derivative = tf.reshape(average_derivative, (1, 1, 1, -1))
+    if not execute_batch_update(db_path, query, rows):
+        return None
 
-    # Calculate the weighted sum of the conv outputs
-    # This operation basically promotes features that have
-    # high activation value for the predicted class
-    # and also a high derivative whilst suppressing others
-    weighted_conv_outputs = conv_outputs * average_derivative
+    # Keep the classification on the jobs, so it can be cached with the explanation
+    for job, (probability, predicted_label, model_version, *_) in zip(jobs_batch, rows):
+        job.classification = {
+            "probability": probability,
+            "lesion_type": predicted_label,
+            "model": model_version,
+        }
 
-    # Calculate the heatmap by summing all the weighted outputs
-    # per pixel
-    heatmap = tf.reduce_sum(weighted_conv_outputs, axis=-1)
+    write_time = time.perf_counter() - start_time
+    print(
+        f"Wrote {len(rows)} classifications to the database in {write_time * 1000:.1f} ms"
+    )
+    return write_time
 
-    # Convert heatmap to numpy array
-    heatmap = heatmap.numpy()
 
-    # Remove negatives
-    heatmap = np.maximum(heatmap, 0)
+def update_explanations_in_db(db_path, jobs_batch):
+    """
+    Update the Requests table with the explanations for the given Jobs batch.
 
-    # Normalize heatmap by rescaling it from 0 to 1
-    heatmap = heatmap / (np.max(heatmap) + 1e-7)  # Use 1e-7 to avoid division by zero
+    Returns:
+        float: The write latency in seconds, or None if the update failed.
+    """
 
-    # Convert heatmap to 0-255 range
-    heatmap = np.uint8(255 * heatmap)
+    start_time = time.perf_counter()
 
-    # Resize heatmap to match original image size
-    heatmap = cv2.resize(heatmap, (original_image_shape[1], original_image_shape[0]))
+    # Prepare Request table updates
+    rows = [
+        (
+            # Convert job.feature_impact to JSON string
+            json.dumps(job.feature_impact),
+            # Extract the encoded heatmap artifacts from the job
+            job.heatmap_artifacts["heatmap_base64"],
+            job.heatmap_artifacts["heatmap_format"],
+            job.heatmap_artifacts["cam_grid"],
+            # The request id is the same as the job_id
+            job.job_id,
+        )
+        for job in jobs_batch
+    ]
+
+    query = """
+        UPDATE requests
+        SET feature_impact = ?, heatmap_base64 = ?, heatmap_format = ?,
+            cam_grid = ?, status = 'explained'
+        WHERE request_id = ?;
+    """
 
-    # Take the first channel only for heatmap
-    heatmap = heatmap[:, :, 0]
+    if not execute_batch_update(db_path, query, rows):
+        return None
 
-    # Convert heatmap to RGB
-    heatmap_colored = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
+    write_time = time.perf_counter() - start_time
+    print(
+        f"Wrote {len(rows)} explanations to the database in {write_time * 1000:.1f} ms"
+    )
+    return write_time
 
-    # Get the original image from inputs
-    original_img = inputs[0][0]  # Already a numpy array, just remove batch dimension
 
-    # Normalize image so 0-255 range as it was rescaled to -1 to 1
-    # for model input earlier
-    original_img = (original_img * 255).astype(np.uint8)
+def update_failed_jobs_in_db(db_path, jobs_batch):
+    """
+    Marks the requests of jobs that could not be processed as failed, so that
+    clients stop waiting for their results.
 
-    # Add the heatmap as a layer on top of the original image
-    # with a weight of 0.6 for the original image and 0.4 for the heatmap.
-    # The weights is how much each layer should be visible
-    layered = cv2.addWeighted(original_img, 0.6, heatmap_colored, 0.4, 0)
+    Returns:
+        bool: True if the requests were updated.
+    """
 
-    return heatmap, heatmap_colored, layered
+    job_ids = [job.job_id for job in jobs_batch]
+    print(f"Failed to process jobs with IDs: {job_ids}")
+    PIPELINE_METRICS.count_jobs("failed", len(job_ids))
 
+    query = "UPDATE requests SET status = 'failed' WHERE request_id = ?;"
+    return execute_batch_update(db_path, query, [(job_id,) for job_id in job_ids])
 
-def encode_heatmap_to_binary(heatmap_tuple):
-    import cv2
 
-    layered_image = heatmap_tuple[2]
-    _, encoded_img = cv2.imencode(".png", layered_image)
-    return encoded_img.tobytes()
+def delete_jobs_from_db(job_ids):
+    """Delete jobs from the database based on their job_ids."""
+    try:
+        Requests.objects.filter(request_id__in=job_ids).delete()
+        print(f"Jobs {job_ids} deleted successfully.")
+    except Exception as e:
+        print(f"Error deleting jobs {job_ids}: {e}")
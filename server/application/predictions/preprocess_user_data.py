@@ -2,8 +2,155 @@
 # * Contributor: <elindstr@student.chalmers.se>
 # * Contributor: <kaisa.arumeel@gmail.com>
 # * Contributor: <amirpooya78@gmail.com>
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 import cv2
 import numpy as np
+from PIL import Image
+
+# Lookup table that maps every uint8 pixel value to its normalized [-1, 1] value.
+# Normalizing through the table is a single operation without float64 intermediates.
+# Only used for models that do not normalize their inputs themselves
+NORMALIZATION_LUT = (np.arange(256) / 127.5 - 1.0).astype(np.float16)
+
+# Longest side (in pixels) of queued images while the model input size is not known
+MAX_QUEUED_IMAGE_SIDE = 512
+
+# Limits of the dimensions of uploaded images
+MIN_IMAGE_SIDE = 32
+MAX_IMAGE_PIXELS = 50_000_000
+
+# Range of valid ages of the users
+MIN_AGE = 0
+MAX_AGE = 130
+
+# Thread pool used to preprocess the images of a batch in parallel,
+# this scales with the number of cores because cv2 releases the GIL
+_preprocess_pool = None
+# Number of threads of the pool (None uses the default of ThreadPoolExecutor)
+_preprocess_threads = None
+
+
+def get_preprocess_pool():
+    """Returns the shared preprocessing thread pool, creating it on first use."""
+    global _preprocess_pool
+    if _preprocess_pool is None:
+        _preprocess_pool = ThreadPoolExecutor(
+            max_workers=_preprocess_threads, thread_name_prefix="preprocess"
+        )
+    return _preprocess_pool
+
+
+def configure_preprocess_pool(max_workers):
+    """
+    Sets the number of threads of the preprocessing pool. A pool that was already
+    created is replaced once its running tasks have finished.
+    """
+    global _preprocess_pool, _preprocess_threads
+    _preprocess_threads = max_workers
+    if _preprocess_pool is not None:
+        _preprocess_pool.shutdown(wait=False)
+        _preprocess_pool = None
+
+
+def resize_for_queue(image, target_input_shape=None):
+    """
+    Resizes an uploaded image when its request is admitted, so that the queued job
+    only holds a small uint8 tensor instead of the full resolution image.
+
+    Args:
+        image (np.ndarray): The decoded uint8 image (H, W, 3).
+        target_input_shape: The input dimensions (height, width) of the served model,
+            or None if no model has been loaded yet. In that case the image is only
+            scaled down to at most `MAX_QUEUED_IMAGE_SIDE` pixels on its longest side.
+
+    Returns:
+        np.ndarray: The resized uint8 image.
+    """
+
+    if target_input_shape is not None:
+        target_height, target_width = target_input_shape
+    else:
+        # Keep the aspect ratio, the image is resized to the model input later
+        scale = MAX_QUEUED_IMAGE_SIDE / max(image.shape[:2])
+        if scale >= 1:
+            return image
+        target_height = max(1, round(image.shape[0] * scale))
+        target_width = max(1, round(image.shape[1] * scale))
+
+    if image.shape[:2] == (target_height, target_width):
+        return image
+
+    return cv2.resize(
+        image, (target_width, target_height), interpolation=cv2.INTER_AREA
+    )
+
+
+def validate_image(image):
+    """
+    Checks that a decoded image can be preprocessed, so that a malformed image
+    is rejected when its request is admitted instead of failing its batch.
+
+    Returns:
+        str: The reason why the image is invalid, or None if it is valid.
+    """
+
+    if not isinstance(image, np.ndarray) or image.dtype != np.uint8:
+        return "Image must be decoded to 8-bit pixel values."
+    if image.ndim != 3 or image.shape[-1] != 3:
+        return "Image must have 3 colour channels (RGB)."
+    if min(image.shape[:2]) < MIN_IMAGE_SIDE:
+        return f"Image must be at least {MIN_IMAGE_SIDE}x{MIN_IMAGE_SIDE} pixels."
+    if image.shape[0] * image.shape[1] > MAX_IMAGE_PIXELS:
+        return f"Image must have at most {MAX_IMAGE_PIXELS} pixels."
+    return None
+
+
+def validate_tabular_features(age, sex, localization):
+    """
+    Checks the tabular features of a request in the same way as `validate_image`.
+
+    Returns:
+        str: The reason why the features are invalid, or None if they are valid.
+    """
+
+    try:
+        age = float(age)
+    except (TypeError, ValueError):
+        age = np.nan
+
+    # Comparisons with NaN are False, so missing ages are invalid as well
+    if not MIN_AGE <= age <= MAX_AGE:
+        return f"Age must be a number between {MIN_AGE} and {MAX_AGE}."
+    if not isinstance(sex, str) or sex.lower() not in ("male", "female"):
+        return "Sex must be 'male' or 'female'."
+    if not isinstance(localization, str) or not localization:
+        return "Localization must be provided."
+    return None
+
+
+def find_invalid_samples(resized_images, tabular_features):
+    """
+    Returns the indices of the preprocessed samples that contain non-finite values,
+    which would make the whole batch fail or produce meaningless predictions.
+    """
+
+    finite_images = np.isfinite(resized_images).reshape(len(resized_images), -1)
+    finite_tabular = np.isfinite(np.asarray(tabular_features, dtype=np.float64))
+    valid = finite_images.all(axis=1) & finite_tabular.all(axis=1)
+    return np.flatnonzero(~valid).tolist()
+
+
+def decode_image(image_bytes, target_input_shape=None):
+    """
+    Decodes the stored bytes of an uploaded image into an RGB uint8 array and
+    resizes it in the same way as when a request is admitted.
+    """
+
+    with Image.open(BytesIO(image_bytes)) as image:
+        image_array = np.array(image.convert("RGB"), np.uint8)
+
+    return resize_for_queue(image_array, target_input_shape)
 
 
 def extract_images(jobs):
@@ -21,43 +168,72 @@ def extract_images(jobs):
     return [job.parameters.get("image") for job in jobs]
 
 
-def preprocess_images(image_list, target_input_shape):
+def preprocess_images(image_list, target_input_shape, normalize=True):
     """
     Preprocesses a batch of images for model prediction.
 
+    The images are resized in parallel and normalized straight into one
+    preallocated output buffer.
+
     Args:
         image_list (list): List of numpy image arrays.
-        target_input_shape: The target dimensions of the images.
+        target_input_shape: The target dimensions (height, width) of the images.
+        normalize (bool): Normalize the pixels to the [-1, 1] range. Models that
+            normalize their inputs themselves take the raw uint8 pixels instead.
 
     Returns:
         np.ndarray: A batch of preprocessed images ready for model prediction.\n
-        Resized to target dimensions and normalized to [-1, 1] range.
+        Resized to target dimensions and normalized to [-1, 1] range (float16),
+        or raw pixels (uint8) if `normalize` is False.
     """
 
-    preprocessed_images = []
+    target_height, target_width = target_input_shape
+
+    # Preallocate the output buffer for the whole batch
+    # We use float16 (or uint8 for raw pixels) to save memory
+    preprocessed_images = np.empty(
+        (len(image_list), target_height, target_width, 3),
+        dtype=np.float16 if normalize else np.uint8,
+    )
 
-    # Process all images
-    for image in image_list:
+    def preprocess_image(index):
+        image = image_list[index]
 
         # Convert to RGB if the image has 4 channels (e.g., RGBA)
         if image.shape[-1] == 4:
             image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
 
-        # Resize the image to the model's input dimensions
-        resized_image = cv2.resize(
-            image, target_input_shape, interpolation=cv2.INTER_AREA
-        )
-
-        # Normalize pixel values to [-1, 1] range
-        normalized_image = resized_image / 127.5 - 1.0
+        # Images are already resized to the model input when they are admitted,
+        # unless the served model changed in the meantime
+        if image.shape[:2] != (target_height, target_width):
+            # Resize the image to the model's input dimensions (cv2 expects width first)
+            resized_image = cv2.resize(
+                image, (target_width, target_height), interpolation=cv2.INTER_AREA
+            )
+        else:
+            resized_image = image
 
-        # Ensure the image is in float16 format
-        normalized_image = normalized_image.astype(np.float16)
+        if not normalize:
+            # Raw pixels are copied as they are, other types are clipped to 0-255
+            if resized_image.dtype == np.uint8:
+                preprocessed_images[index] = resized_image
+            else:
+                preprocessed_images[index] = np.clip(resized_image, 0, 255)
+        # Normalize pixel values to [-1, 1] range directly into the output buffer
+        elif resized_image.dtype == np.uint8:
+            np.take(NORMALIZATION_LUT, resized_image, out=preprocessed_images[index])
+        else:
+            preprocessed_images[index] = resized_image / 127.5 - 1.0
 
-        preprocessed_images.append(normalized_image)
+    # Process all images, in parallel if there is more than one
+    if len(image_list) > 1:
+        # Consume the results to raise any exception from the threads
+        list(get_preprocess_pool().map(preprocess_image, range(len(image_list))))
+    else:
+        for index in range(len(image_list)):
+            preprocess_image(index)
 
-    # Convert to a numpy array and return the images
-    return np.array(preprocessed_images)
+    return preprocessed_images
 
 
 def extract_tabular_features(jobs, scaler, localization_encoder):
@@ -71,15 +247,26 @@ def extract_tabular_features(jobs, scaler, localization_encoder):
 
     Returns:
         np.ndarray: A 2D numpy array of standardized tabular features ready for model prediction.
+            The localizations that the model was not trained on are NaN, so that
+            only their samples are left out by `find_invalid_samples`.
     """
 
     # Extract features using list comprehension
     ages = [job.parameters.get("age") for job in jobs]
-    localizations = [job.parameters.get("localization") for job in jobs]
+    localizations = np.array(
+        [job.parameters.get("localization") for job in jobs], dtype=object
+    )
     sexes = [job.parameters.get("sex").lower() == "male" for job in jobs]
 
-    # Encode the localization labels
-    localizations = localization_encoder.transform(localizations)
+    # Encode the localization labels, the encoder fails for the whole
+    # batch on a label that it was not fitted on
+    known = np.isin(localizations, localization_encoder.classes_)
+    encoded_localizations = np.full(len(jobs), np.nan)
+    if known.any():
+        encoded_localizations[known] = localization_encoder.transform(
+            localizations[known]
+        )
+    localizations = encoded_localizations
 
     # TODO one-hot encode localization
 
@@ -0,0 +1,120 @@
+import os
+import threading
+import warnings
+import tensorflow as tf
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Parses a list of CPUs in the format of taskset, e.g. "0-3,6".
+
+    Returns:
+        set: The CPU indices, or None if the list is empty.
+    """
+
+    if cpu_list is None:
+        return None
+    if not isinstance(cpu_list, str):
+        return set(cpu_list) or None
+
+    cpus = set()
+    for part in cpu_list.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus or None
+
+
+def configure_tensorflow_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Sets the sizes of the TensorFlow thread pools of this process. The intra-op pool
+    runs the parallel kernels of a single operation (e.g. a convolution) and the
+    inter-op pool runs independent operations of a graph at the same time.
+
+    The pools are created when TensorFlow runs its first operation, so this only
+    takes effect before any model is loaded. A value of None keeps the default
+    of TensorFlow, which is one thread per core for each pool.
+
+    Returns:
+        bool: True if the pools were configured.
+    """
+
+    try:
+        if intra_op_threads is not None:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads is not None:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError as e:
+        warnings.warn(
+            f"TensorFlow thread pools are already initialized: {e}",
+            category=UserWarning,
+        )
+        return False
+    return True
+
+
+def set_thread_affinity(cpus):
+    """
+    Restricts the calling thread to the given CPUs. Threads that it starts afterwards
+    (e.g. the TensorFlow and preprocessing thread pools) inherit the affinity.
+    The TensorFlow pools are shared by all threads of the process and are created by
+    its first operation, so they keep the affinity of the thread that created them.
+
+    Returns:
+        bool: True if the affinity was set.
+    """
+
+    cpus = parse_cpu_list(cpus)
+    if cpus is None:
+        return False
+
+    # Only supported on Linux, where a thread ID restricts a single thread
+    if not hasattr(os, "sched_setaffinity"):
+        warnings.warn(
+            "CPU affinity is not supported on this platform", category=UserWarning
+        )
+        return False
+
+    try:
+        os.sched_setaffinity(threading.get_native_id(), cpus)
+    except (OSError, ValueError) as e:
+        warnings.warn(f"Failed to set the CPU affinity: {e}", category=UserWarning)
+        return False
+    return True
+
+
+def lower_thread_priority(niceness):
+    """
+    Increases the niceness of the calling thread, so that the scheduler prefers
+    the other threads of the process when the CPUs are busy. Threads that it starts
+    afterwards inherit the niceness, which does not apply to the TensorFlow pools
+    if they already exist (see `set_thread_affinity`).
+
+    Returns:
+        bool: True if the priority was lowered.
+    """
+
+    if not niceness:
+        return False
+
+    # Only supported on Linux, where a thread ID changes a single thread
+    if not hasattr(os, "setpriority"):
+        warnings.warn(
+            "Thread priorities are not supported on this platform",
+            category=UserWarning,
+        )
+        return False
+
+    try:
+        thread_id = threading.get_native_id()
+        current = os.getpriority(os.PRIO_PROCESS, thread_id)
+        os.setpriority(os.PRIO_PROCESS, thread_id, min(current + niceness, 19))
+    except OSError as e:
+        warnings.warn(f"Failed to lower the thread priority: {e}", category=UserWarning)
+        return False
+    return True
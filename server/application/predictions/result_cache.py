@@ -0,0 +1,114 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Fields of a Requests row that are filled in from a cached result
+RESULT_FIELDS = (
+    "probability",
+    "lesion_type",
+    "model",
+    "feature_impact",
+    "heatmap_base64",
+    "heatmap_format",
+    "cam_grid",
+)
+
+
+class ResultCache:
+    """
+    Least recently used cache of the results of explained requests.
+
+    The results are keyed by the content of the request (see `content_key`) and the
+    version of the model that produced them, so a resubmitted photo is answered
+    without running the model again. The cache is bounded by the number of results
+    and by their total size, as the encoded heatmaps make up most of a result.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        # Maximum number of cached results (0 disables the cache)
+        self.max_entries = max_entries
+        # Maximum total size (in bytes) of the cached results
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, content_key, model_version):
+        """Returns the cached result of a request, or None if it is not cached."""
+        if not self.max_entries or content_key is None or model_version is None:
+            return None
+
+        with self._lock:
+            entry = self._results.get((content_key, model_version))
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Mark the result as the most recently used one
+            self._results.move_to_end((content_key, model_version))
+            self.hits += 1
+            return dict(entry[0])
+
+    def put(self, content_key, model_version, result):
+        """Caches the result (a dict of `RESULT_FIELDS`) of an explained request."""
+        if not self.max_entries or content_key is None or model_version is None:
+            return
+
+        key = (content_key, model_version)
+        result = {field: result[field] for field in RESULT_FIELDS}
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._results:
+                self.size -= self._results.pop(key)[1]
+            self._results[key] = (result, size)
+            self.size += size
+
+            # Evict the least recently used results until the limits are met
+            while len(self._results) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size) = self._results.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """Removes all cached results, e.g. when another model is activated."""
+        with self._lock:
+            self._results.clear()
+            self.size = 0
+
+    def stats(self):
+        """Returns the size and the hit rate of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._results),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+
+def content_key(image, age, sex, localization):
+    """
+    Returns the key of the content of a request: a hash of the decoded image
+    (np.uint8) and the tabular features that the model is given.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(str(image.shape).encode("utf-8"))
+    digest.update(image.tobytes())
+    digest.update(f"{age}|{sex}|{localization}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def result_size(result):
+    """Returns the approximate size (in bytes) of a cached result."""
+    return sum(len(value) for value in result.values() if isinstance(value, str)) + 64
@@ -0,0 +1,210 @@
+import time
+import base64
+import pickle
+import threading
+import warnings
+from contextlib import closing
+import numpy as np
+
+# Custom modules
+from application.mlsym.persistence import load_active_model_from_db
+from .database import connect_db
+from .inference import BATCH_BUCKETS, CompiledPredictor
+from .explanations import GradCamExplainer
+
+
+class ServingModel:
+    """
+    Bundles a loaded model version with everything that is needed to serve it:
+    the compiled predictor, the explainer, the tabular feature scaler and the
+    label encoders.
+    """
+
+    def __init__(self, model, hyperparameters, version, buckets=BATCH_BUCKETS):
+        self.model = model
+        self.hyperparameters = hyperparameters
+        self.version = version
+        self.input_shape = get_model_input_shape(model)
+        # Models that were trained with a Rescaling layer take raw pixels (0-255),
+        # older models take pixels that are normalized to the [-1, 1] range
+        self.normalize_inputs = hyperparameters.get("input_normalization") != "model"
+
+        # Compile the forward pass used to classify batches
+        self.predictor = CompiledPredictor(model, buckets)
+        # Name of the backend that classifies the batches, and the result of its
+        # accuracy-drift check against the float model (None for the float model)
+        self.inference_backend = "tensorflow"
+        self.backend_check = None
+
+        # Build the explainer once for the loaded model
+        self.explainer = GradCamExplainer(
+            model, hyperparameters.get("grad_cam_layer"), buckets
+        )
+
+        # Load the feature scaler and decoders
+        self.tabular_scaler = get_scaler(hyperparameters)
+        self.localization_encoder, self.lesion_type_encoder = get_encoders(
+            hyperparameters
+        )
+
+        # Time (in seconds) it took to warm up the model
+        self.warmup_time = None
+
+    def warm_up(self):
+        """
+        Runs a dummy batch for every bucket size, so that the first real batch
+        does not pay for the memory allocations of the compiled functions.
+
+        Returns:
+            float: The warm-up time in seconds.
+        """
+
+        start_time = time.perf_counter()
+
+        image_shape, tabular_shape = self.model.input_shape
+        for size in self.explainer.buckets:
+            images = np.zeros((size, *image_shape[1:]), dtype=np.float32)
+            tabular = np.zeros((size, *tabular_shape[1:]), dtype=np.float32)
+            self.predictor.predict(images, tabular)
+            self.explainer.explain(images, tabular)
+
+        self.warmup_time = time.perf_counter() - start_time
+        return self.warmup_time
+
+
+def load_serving_model(db_path, buckets=BATCH_BUCKETS, backend=None):
+    """
+    Loads the active model from the database and warms it up.
+
+    Args:
+        backend (InferenceBackend): Optional backend that classifies the batches
+            instead of the float TensorFlow model.
+
+    Returns:
+        ServingModel: The warmed up model, or None if no model could be loaded.
+    """
+
+    start_time = time.perf_counter()
+
+    try:
+        with closing(connect_db(db_path)) as conn:
+            model, hyperparameters, model_version = load_active_model_from_db(conn)
+        if model is None:
+            return None
+
+        # Deserialize the model, build the explainer and warm it up
+        serving_model = ServingModel(model, hyperparameters, model_version, buckets)
+
+        # The float model keeps serving if the backend cannot be prepared
+        if backend is not None:
+            try:
+                backend.apply(serving_model, db_path)
+            except Exception as e:
+                warnings.warn(
+                    f"Failed to prepare the {backend.name} backend: {e}",
+                    category=UserWarning,
+                )
+
+        serving_model.warm_up()
+    except Exception as e:
+        warnings.warn(f"Failed to load the active model: {e}", category=UserWarning)
+        return None
+
+    print(
+        f"Model version {serving_model.version} loaded "
+        f"({serving_model.inference_backend}) in "
+        f"{time.perf_counter() - start_time:.2f} s "
+        f"(warm-up: {serving_model.warmup_time:.2f} s)"
+    )
+    return serving_model
+
+
+class ModelReloader:
+    """
+    Loads and warms up the active model on a background thread.
+
+    The prediction loop keeps serving batches with its current model while the
+    new one is loading, and swaps it in between two batches once it is ready.
+    """
+
+    def __init__(self, db_path, buckets=BATCH_BUCKETS, backend=None):
+        self.db_path = db_path
+        self.buckets = buckets
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._thread = None
+        self._reload_again = False
+        self._ready_model = None
+
+    def request_reload(self):
+        """Starts loading the active model, unless a reload is already in progress."""
+        with self._lock:
+            if self._thread is not None:
+                # The active model changed while loading, load it again afterwards
+                self._reload_again = True
+                return
+
+            self._thread = threading.Thread(daemon=True, target=self._reload)
+            self._thread.start()
+
+    def is_reloading(self):
+        """Returns True while a model is being loaded in the background."""
+        with self._lock:
+            return self._thread is not None
+
+    def take_ready_model(self):
+        """Returns the newly loaded model once (or None if no new model is ready)."""
+        with self._lock:
+            serving_model = self._ready_model
+            self._ready_model = None
+            return serving_model
+
+    def _reload(self):
+        while True:
+            with self._lock:
+                self._reload_again = False
+
+            serving_model = load_serving_model(self.db_path, self.buckets, self.backend)
+
+            with self._lock:
+                if serving_model is not None:
+                    self._ready_model = serving_model
+
+                # Finish unless another reload was requested in the meantime
+                if not self._reload_again:
+                    self._thread = None
+                    return
+
+
+def get_model_input_shape(model):
+    # Extract the input shape from the model
+    target_input_shape = model.input_shape[0]
+
+    # Extract target height and width from input shape tuple
+    target_height, target_width = target_input_shape[1:3]
+
+    # Return target height and width
+    return (target_height, target_width)
+
+
+def get_scaler(hyperparameters):
+    # Decode and unpickle the scaler
+    encoded_scaler = hyperparameters["tabular_scaler"]
+    pickled_scaler = base64.b64decode(encoded_scaler)
+
+    # Return Scaler object
+    return pickle.loads(pickled_scaler)
+
+
+def get_encoders(hyperparameters):
+    # Decode and unpickle the localization encoder
+    encoded_loc_encoder = hyperparameters["localization_encoder"]
+    pickled_loc_encoder = base64.b64decode(encoded_loc_encoder)
+    localization_encoder = pickle.loads(pickled_loc_encoder)
+    # Decode and unpickle the lesion_type encoder
+    encoded_lesion_encoder = hyperparameters["lesion_type_encoder"]
+    pickled_lesion_encoder = base64.b64decode(encoded_lesion_encoder)
+    lesion_type_encoder = pickle.loads(pickled_lesion_encoder)
+
+    # Return Encoder objects
+    return localization_encoder, lesion_type_encoder
@@ -0,0 +1,178 @@
+import numpy as np
+import tensorflow as tf
+
+# Custom modules
+from .backends import InferenceBackend
+from .inference import BATCH_BUCKETS, get_bucket_size, pad_batch
+
+# Post-training quantization modes of the converted models:
+# - "dynamic": int8 weights, activations are quantized on the fly
+# - "float16": float16 weights
+# - "int8": int8 weights and activations, calibrated on stored images
+QUANTIZATION_MODES = ("dynamic", "float16", "int8")
+
+
+def convert_to_tflite(model, quantization="dynamic", calibration_data=None):
+    """
+    Converts a Keras model to a quantized TFLite flatbuffer.
+
+    Args:
+        model (tf.keras.Model): The model with an image and a tabular input.
+        quantization (str): One of `QUANTIZATION_MODES`.
+        calibration_data (tuple): Preprocessed (images, tabular) samples that are used
+            to calibrate the activation ranges of the "int8" mode.
+
+    Returns:
+        bytes: The converted model.
+    """
+
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode: {quantization}")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if calibration_data is None:
+            raise ValueError("The int8 mode requires calibration data")
+        images, tabular = calibration_data
+        # The converter does not keep the order of the model inputs,
+        # so the samples are passed by the names of the inputs
+        image_name, tabular_name = (tensor.name for tensor in model.inputs)
+
+        def representative_dataset():
+            for i in range(len(images)):
+                yield {
+                    image_name: images[i : i + 1].astype(np.float32),
+                    tabular_name: tabular[i : i + 1].astype(np.float32),
+                }
+
+        converter.representative_dataset = representative_dataset
+
+    return converter.convert()
+
+
+class TFLitePredictor:
+    """
+    Classifies batches with a TFLite interpreter of the converted model, with the
+    same interface as `CompiledPredictor`.
+
+    One interpreter is allocated per batch bucket when the model is loaded,
+    so no tensors are reallocated while serving. Batches are padded and chunked
+    in the same way as the compiled TensorFlow functions.
+    """
+
+    def __init__(self, model_content, buckets=BATCH_BUCKETS, num_threads=None):
+        self.buckets = tuple(sorted(buckets))
+        self.model_size = len(model_content)
+        self._interpreters = {
+            size: self._build_interpreter(model_content, size, num_threads)
+            for size in self.buckets
+        }
+
+    @staticmethod
+    def _build_interpreter(model_content, batch_size, num_threads):
+        interpreter = tf.lite.Interpreter(
+            model_content=model_content, num_threads=num_threads
+        )
+
+        # Fix the batch dimension of the inputs to the bucket size
+        for details in interpreter.get_input_details():
+            interpreter.resize_tensor_input(
+                details["index"], [batch_size, *details["shape"][1:]]
+            )
+        interpreter.allocate_tensors()
+
+        # The inputs are not in the order of the model inputs,
+        # the image input is the only one with a rank of 4
+        input_details = interpreter.get_input_details()
+        image_index = next(d["index"] for d in input_details if len(d["shape"]) == 4)
+        tabular_index = next(
+            d["index"] for d in input_details if d["index"] != image_index
+        )
+        output_index = interpreter.get_output_details()[0]["index"]
+        return interpreter, image_index, tabular_index, output_index
+
+    def predict(self, image_batch, tabular_batch):
+        """
+        Predicts the class probabilities of a batch.
+
+        Args:
+            image_batch (np.ndarray): Batch of preprocessed images (N, H, W, 3).
+            tabular_batch (np.ndarray): Batch of standardized tabular features (N, F).
+
+        Returns:
+            np.ndarray: Class probabilities for each sample (N, num_classes).
+        """
+
+        image_batch = np.asarray(image_batch, dtype=np.float32)
+        tabular_batch = np.asarray(tabular_batch, dtype=np.float32)
+
+        # Batches larger than the largest bucket are processed in chunks
+        max_bucket = self.buckets[-1]
+        chunk_outputs = []
+
+        for start in range(0, len(image_batch), max_bucket):
+            images = image_batch[start : start + max_bucket]
+            tabular = tabular_batch[start : start + max_bucket]
+            n_samples = len(images)
+
+            size = get_bucket_size(n_samples, self.buckets)
+            interpreter, image_index, tabular_index, output_index = self._interpreters[
+                size
+            ]
+            interpreter.set_tensor(image_index, pad_batch(images, size))
+            interpreter.set_tensor(tabular_index, pad_batch(tabular, size))
+            interpreter.invoke()
+
+            # Copy the output, the interpreter reuses its buffer on the next call
+            chunk_outputs.append(
+                interpreter.get_tensor(output_index)[:n_samples].copy()
+            )
+
+        return np.concatenate(chunk_outputs)
+
+
+class TFLiteBackend(InferenceBackend):
+    """
+    Serves the classifications of a model with a quantized TFLite conversion of it,
+    which is made when the model is loaded.
+    """
+
+    def __init__(
+        self,
+        quantization="dynamic",
+        calibration_samples=64,
+        min_agreement=0.95,
+        num_threads=None,
+        images_db_path=None,
+    ):
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode: {quantization}")
+
+        super().__init__(
+            calibration_samples, min_agreement, num_threads, images_db_path
+        )
+        self.quantization = quantization
+
+    @property
+    def name(self):
+        return f"tflite-{self.quantization}"
+
+    @property
+    def requires_calibration(self):
+        # The ranges of the int8 activations are measured on the calibration data
+        return self.quantization == "int8"
+
+    def build_predictor(self, serving_model, db_path, calibration_data):
+        model_content = convert_to_tflite(
+            serving_model.model, self.quantization, calibration_data
+        )
+        return TFLitePredictor(
+            model_content, serving_model.explainer.buckets, self.num_threads
+        )
+
+    def check_details(self):
+        return {"quantization": self.quantization}
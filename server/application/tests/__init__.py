@@ -11,11 +11,25 @@ from .add_data import AddDataTests
 from .get_all_requests import GetAllRequestsTests
 from .get_all_users import GetAllUsersTests
 from .create_request import CreateRequestTests
-from .ml import MLTests
+from .admission import AdmissionTests
+from .metrics import PipelineMetricsTests
+from .result_cache import ResultCacheTests
+from .ml import MLTests, ImageCacheTests, TrainingDatasetTests
 from .retrain import RetrainTests
 from .get_specific_request import GetSpecificRequestTests
 from .get_requests_by_username import GetRequestsByUsernameTests
-from .predictions import PreprocessDataTests
+from .predictions import (
+    PreprocessDataTests,
+    ExplanationTests,
+    CompiledInferenceTests,
+    ServingModelTests,
+    TFLiteBackendTests,
+    OnnxBackendTests,
+    ThreadSettingsTests,
+    HeatmapEncoderTests,
+    ResultWriteBackTests,
+)
 from .delete_user import DeleteUserTests
 from .job_expiration import JobExpirationTests
+from .database_queue import DatabaseJobQueueTests, DatabaseQueueRequestTests
 from .get_total_datapoints import GetTotalDataPointsTests
@@ -0,0 +1,179 @@
+import os
+import json
+import base64
+from queue import Full
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.test import Client, TestCase
+from django.urls import reverse
+from unittest.mock import patch
+from ..models import Users, Requests
+from ..predictions.admission import AdmissionController
+from ..views.jobs.state import PREDICTION_ADMISSION, EXPLANATION_JOBS
+
+
+class AdmissionTests(TestCase):
+    def setUp(self):
+        """Set up test data and client"""
+        self.client = Client()
+
+        # Do not start the prediction threads, which would take the jobs
+        # of the shared queue from the other tests
+        manager_patcher = patch(
+            "application.views.create_request.start_prediction_manager"
+        )
+        manager_patcher.start()
+        self.addCleanup(manager_patcher.stop)
+
+        self.test_user = Users.objects.create(
+            username="testuser",
+            password=make_password("testpass123"),
+            age=25,
+            sex="male",
+            is_active=True,
+        )
+        self.admin_user = Users.objects.create(
+            username="adminuser",
+            password=make_password("testpass123"),
+            age=30,
+            sex="female",
+            is_admin=True,
+            is_active=True,
+        )
+
+        valid_image_path = os.path.join(
+            os.path.dirname(__file__), "test_data", "valid_test_image.jpg"
+        )
+        with open(valid_image_path, "rb") as img_file:
+            self.data = {
+                "localization": "face",
+                "image": base64.b64encode(img_file.read()).decode("utf-8"),
+            }
+
+    def post_request(self):
+        return self.client.post(
+            reverse("api-create-request"),
+            json.dumps(self.data),
+            content_type="application/json",
+        )
+
+    ################################## UNIT TESTS ##################################
+
+    def test_admit_until_queue_is_full(self):
+        """Test that jobs are rejected once the queue depth limit is reached"""
+        controller = AdmissionController(max_queue_depth=2)
+
+        self.assertEqual(controller.admit(0), (True, None))
+        self.assertEqual(controller.admit(1), (True, None))
+
+        # No throughput has been measured yet, so the default Retry-After is used
+        self.assertEqual(
+            controller.admit(2), (False, AdmissionController.DEFAULT_RETRY_AFTER)
+        )
+        self.assertEqual(controller.admitted, 2)
+        self.assertEqual(controller.rejected, 1)
+
+    def test_admit_within_wait_budget(self):
+        """Test that jobs are rejected once the estimated wait exceeds the budget"""
+        controller = AdmissionController(max_wait=2)
+
+        # 10 jobs per second
+        controller.record_batch(10, 1.0)
+        self.assertAlmostEqual(controller.estimate_wait(5), 0.5)
+
+        self.assertEqual(controller.admit(18), (True, None))
+
+        # 21 queued jobs would take 2.1 seconds, the client should retry
+        # once the queue has drained down to the 19 jobs that fit the budget
+        admitted, retry_after = controller.admit(30)
+        self.assertFalse(admitted)
+        self.assertEqual(retry_after, 2)
+
+    def test_throughput_is_smoothed(self):
+        """Test that the throughput is a moving average of the batches"""
+        controller = AdmissionController()
+        controller.record_batch(10, 1.0)
+        controller.record_batch(20, 1.0)
+        self.assertAlmostEqual(controller.throughput, 12.0)
+
+        # Empty batches are not recorded
+        controller.record_batch(0, 1.0)
+        self.assertAlmostEqual(controller.throughput, 12.0)
+
+    def test_explanation_backlog_counts_towards_wait(self):
+        """Test that the classified jobs waiting to be explained delay new jobs"""
+        controller = AdmissionController(max_wait=2)
+
+        # The classification is fast, the explanations are the bottleneck
+        controller.record_batch(100, 1.0)
+        controller.record_explanation_batch(10, 1.0)
+        self.assertAlmostEqual(controller.estimate_wait(5), 0.5)
+        self.assertAlmostEqual(controller.estimate_wait(5, 15), 2.0)
+
+        self.assertEqual(controller.admit(5, 10), (True, None))
+
+        # 30 jobs are ahead of the new job in both queues, which takes 3 seconds
+        # to explain, the client should retry once 11 of them are explained
+        admitted, retry_after = controller.admit(5, 25)
+        self.assertFalse(admitted)
+        self.assertEqual(retry_after, 2)
+
+    def test_explanation_queue_is_bounded(self):
+        """Test that the explanation queue is bounded like the prediction queue"""
+        self.assertEqual(
+            EXPLANATION_JOBS.maxsize, settings.PREDICTION_MAX_EXPLANATION_QUEUE_DEPTH
+        )
+        self.assertGreater(EXPLANATION_JOBS.maxsize, 0)
+
+    ################################## INTEGRATION TESTS ##################################
+
+    def test_create_request_rejected_when_queue_is_full(self):
+        """Test that requests are rejected with 503 and Retry-After when the queue is full"""
+        self.client.force_login(self.test_user)
+
+        with patch.object(PREDICTION_ADMISSION, "max_queue_depth", 5), patch(
+            "application.views.create_request.PREDICTION_JOBS.qsize", return_value=5
+        ):
+            response = self.post_request()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+
+        # No request is stored for rejected jobs
+        self.assertFalse(Requests.objects.exists())
+
+    def test_create_request_rejected_when_put_fails(self):
+        """Test that the request is removed again if the queue filled up in the meantime"""
+        self.client.force_login(self.test_user)
+
+        with patch(
+            "application.views.create_request.PREDICTION_JOBS.put", side_effect=Full
+        ):
+            response = self.post_request()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+        self.assertFalse(Requests.objects.exists())
+
+    def test_prediction_queue_stats(self):
+        """Test that the queue depth and the rejection counts are reported to admins"""
+        self.client.force_login(self.admin_user)
+        response = self.client.get(reverse("api-prediction-queue"))
+        self.assertEqual(response.status_code, 200)
+
+        stats = response.json()["prediction_queue"]
+        for key in (
+            "queue_depth",
+            "explanation_queue_depth",
+            "throughput",
+            "admitted",
+            "rejected",
+        ):
+            self.assertIn(key, stats)
+
+    def test_prediction_queue_stats_admin_only(self):
+        """Test that normal users cannot access the queue statistics"""
+        self.client.force_login(self.test_user)
+        response = self.client.get(reverse("api-prediction-queue"))
+        self.assertEqual(response.status_code, 401)
@@ -2,6 +2,7 @@
 # * Contributor: <arvinrahimi78@gmail.com>
 # * Contributor: <elindstr@student.chalmers.se>
 # * Contributor: <arvinra@student.chalmers.se>
+import io
 import os
 import json
 import base64
@@ -12,6 +13,7 @@ from django.test import Client, TestCase
 from django.urls import reverse
 from ..models import Users
 from unittest.mock import patch
+from PIL import Image
 
 
 class CreateRequestTests(TestCase):
@@ -19,6 +21,14 @@ class CreateRequestTests(TestCase):
         """Set up test data and client"""
         self.client = Client()
 
+        # Do not start the prediction threads, which would take the jobs
+        # of the shared queue from the other tests
+        manager_patcher = patch(
+            "application.views.create_request.start_prediction_manager"
+        )
+        manager_patcher.start()
+        self.addCleanup(manager_patcher.stop)
+
         # Creating a test user
         self.test_user = Users.objects.create(
             username="testuser",
@@ -109,6 +119,32 @@ class CreateRequestTests(TestCase):
             )
             self.assertIsInstance(created_job.parameters["image"], np.ndarray)
 
+    def test_create_request_queues_resized_image(self):
+        """Test that the queued Job only holds the image at the model input size"""
+        self.client.force_login(self.test_user)
+
+        data = {
+            "localization": "face",
+            "image": self.encode_image_to_base64(self.valid_image_path),
+        }
+
+        with patch(
+            "application.views.create_request.PREDICTION_JOBS.put"
+        ) as mock_put, patch(
+            "application.views.create_request.get_serving_input_shape",
+            return_value=(224, 224),
+        ):
+            response = self.client.post(
+                reverse("api-create-request"),
+                json.dumps(data),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 201)
+
+            created_job = mock_put.call_args[0][0]
+            self.assertEqual(created_job.parameters["image"].shape, (224, 224, 3))
+            self.assertEqual(created_job.parameters["image"].dtype, np.uint8)
+
     def test_create_request_missing_image(self):
         """Test upload with missing image"""
         self.client.force_login(self.test_user)
@@ -222,3 +258,24 @@ class CreateRequestTests(TestCase):
         self.assertEqual(
             response.json()["err"], "Image must have 3 colour channels (RGB)."
         )
+
+    def test_create_request_image_too_small(self):
+        """Test that images that are too small to classify are rejected at admission"""
+        self.client.force_login(self.test_user)
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (16, 16)).save(buffer, "JPEG")
+        data = {
+            "localization": "face",
+            "image": base64.b64encode(buffer.getvalue()).decode("utf-8"),
+        }
+        with patch("application.views.create_request.PREDICTION_JOBS.put") as mock_put:
+            response = self.client.post(
+                reverse("api-create-request"),
+                json.dumps(data),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("at least", response.json()["err"])
+        mock_put.assert_not_called()
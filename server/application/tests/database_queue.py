@@ -0,0 +1,304 @@
+import os
+import io
+import json
+import base64
+import time
+import sqlite3
+import tempfile
+from queue import Queue
+import numpy as np
+from PIL import Image
+from sklearn.preprocessing import LabelEncoder
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+from django.contrib.auth.hashers import make_password
+import threading
+from types import SimpleNamespace
+from unittest.mock import patch
+from ..models import Users, Requests
+from ..views.jobs.job import Job
+from ..predictions.database import db_connections
+from ..predictions.database_queue import DatabaseJobQueue
+from ..predictions.prediction_manager import (
+    recover_prediction_jobs,
+    publish_serving_model,
+    update_classifications_in_db,
+)
+
+
+def encode_test_image(height=120, width=160):
+    """Returns the JPEG bytes of a random RGB image."""
+    buffer = io.BytesIO()
+    image = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    Image.fromarray(image).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+class DatabaseJobQueueTests(TestCase):
+    def setUp(self):
+        """Setup for tests, called before each test method."""
+        super().setUp()
+
+        # Use a separate database file with the tables used by the queue
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, "queue.sqlite3")
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(
+            """
+            CREATE TABLE users (username TEXT PRIMARY KEY, age INTEGER, sex TEXT);
+            CREATE TABLE requests (
+                request_id INTEGER PRIMARY KEY, created_at INTEGER, localization TEXT,
+                image BLOB, user_id TEXT, status TEXT DEFAULT 'pending',
+                claimed_at INTEGER, probability REAL, lesion_type TEXT, model INTEGER
+            );
+            CREATE TABLE model_active (id INTEGER PRIMARY KEY, model_id INTEGER);
+            INSERT INTO users VALUES ('testuser', 42, 'female');
+            INSERT INTO model_active VALUES (1, 3);
+            """
+        )
+
+        # Three pending requests and one that is already expired
+        now = int(time.time())
+        image = encode_test_image()
+        conn.executemany(
+            """
+            INSERT INTO requests (request_id, created_at, localization, image, user_id)
+            VALUES (?, ?, 'face', ?, 'testuser');
+            """,
+            [(1, now - 3, image), (2, now - 2, image), (3, now - 1, image)]
+            + [(4, now - 3600, image)],
+        )
+        conn.commit()
+        conn.close()
+
+        self.queue = DatabaseJobQueue(self.db_path, poll_interval=0.01)
+
+    def tearDown(self):
+        # Close the persistent connection before removing the database file
+        connections = getattr(db_connections, "connections", {})
+        if self.db_path in connections:
+            connections.pop(self.db_path).close()
+        self.temp_dir.cleanup()
+        super().tearDown()
+
+    def get_statuses(self):
+        conn = sqlite3.connect(self.db_path)
+        statuses = dict(conn.execute("SELECT request_id, status FROM requests;"))
+        conn.close()
+        return statuses
+
+    def test_wait_for_jobs_claims_oldest_requests(self):
+        jobs, expired_jobs = self.queue.wait_for_jobs(2, 0, 900, 1, (32, 32))
+
+        # The oldest requests that have not expired are claimed
+        self.assertEqual([job.job_id for job in jobs], [1, 2])
+        self.assertEqual(expired_jobs, [4])
+        self.assertEqual(
+            self.get_statuses(),
+            {1: "processing", 2: "processing", 3: "pending", 4: "pending"},
+        )
+
+        # The jobs have the same parameters as the jobs created by CreateRequest
+        parameters = jobs[0].parameters
+        self.assertEqual(parameters["request_id"], 1)
+        self.assertEqual(parameters["age"], 42)
+        self.assertEqual(parameters["sex"], "female")
+        self.assertEqual(parameters["localization"], "face")
+        self.assertEqual(parameters["image"].shape, (32, 32, 3))
+        self.assertEqual(parameters["image"].dtype, np.uint8)
+
+    def test_requests_are_claimed_once(self):
+        # A second worker process uses its own connection
+        other_queue = DatabaseJobQueue(f"file:{self.db_path}?mode=rw")
+
+        first_rows, _ = self.queue.claim_jobs(2, 900)
+        second_rows, _ = other_queue.claim_jobs(2, 900)
+        third_rows, _ = self.queue.claim_jobs(2, 900)
+
+        self.assertEqual([row[0] for row in first_rows], [1, 2])
+        self.assertEqual([row[0] for row in second_rows], [3])
+        self.assertEqual(third_rows, [])
+
+        db_connections.connections.pop(other_queue.db_path).close()
+
+    def test_wait_for_jobs_empty_queue(self):
+        self.queue.claim_jobs(10, 900)
+
+        start_time = time.monotonic()
+        jobs, _ = self.queue.wait_for_jobs(4, 0, 900, 0.1)
+
+        # Polling stops after the idle timeout
+        self.assertEqual(jobs, [])
+        self.assertLess(time.monotonic() - start_time, 1)
+
+    def test_expired_lease_is_claimed_again(self):
+        first_rows, _ = self.queue.claim_jobs(1, 900)
+        self.assertEqual([row[0] for row in first_rows], [1])
+
+        # The worker crashed after the request was claimed, so the lease runs out
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "UPDATE requests SET claimed_at = ? WHERE request_id = 1;",
+            (int(time.time()) - 600,),
+        )
+        conn.commit()
+        conn.close()
+
+        # The request is claimed again before the newer pending requests
+        second_rows, _ = self.queue.claim_jobs(1, 900)
+        self.assertEqual([row[0] for row in second_rows], [1])
+
+        # An active lease is not claimed again
+        third_rows, _ = self.queue.claim_jobs(1, 900)
+        self.assertEqual([row[0] for row in third_rows], [2])
+
+    def test_classification_renews_lease(self):
+        rows, _ = self.queue.claim_jobs(1, 900)
+        self.assertEqual([row[0] for row in rows], [1])
+
+        # The classification took longer than the lease
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "UPDATE requests SET claimed_at = ? WHERE request_id = 1;",
+            (int(time.time()) - 600,),
+        )
+        conn.commit()
+        conn.close()
+
+        update_classifications_in_db(
+            self.db_path,
+            [Job(1, time.time(), {})],
+            np.array([[0.2, 0.8]]),
+            LabelEncoder().fit(["bcc", "mel"]),
+            3,
+        )
+
+        # The request is explained by the same worker and not claimed again
+        second_rows, _ = self.queue.claim_jobs(1, 900)
+        self.assertEqual([row[0] for row in second_rows], [2])
+
+    def test_claimed_request_expires_with_its_lease(self):
+        # The expired request is still being processed by another worker
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "UPDATE requests SET status = 'processing', claimed_at = ? "
+            "WHERE request_id = 4;",
+            (int(time.time()),),
+        )
+        conn.commit()
+
+        _, expired_jobs = self.queue.claim_jobs(1, 900)
+        self.assertEqual(expired_jobs, [])
+
+        # The worker crashed, so the lease runs out
+        conn.execute(
+            "UPDATE requests SET claimed_at = ? WHERE request_id = 4;",
+            (int(time.time()) - 600,),
+        )
+        conn.commit()
+        conn.close()
+
+        _, expired_jobs = self.queue.claim_jobs(1, 900)
+        self.assertEqual(expired_jobs, [4])
+
+    def test_expired_requests_use_index(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "CREATE INDEX requests_status_created ON requests (status, created_at);"
+        )
+        plan = conn.execute(
+            """
+            EXPLAIN QUERY PLAN SELECT request_id FROM requests
+            WHERE status IN ('pending', 'processing') AND created_at < 0
+                AND (status = 'pending' OR claimed_at IS NULL OR claimed_at < 0);
+            """
+        ).fetchall()
+        conn.close()
+
+        self.assertIn("requests_status_created", " ".join(row[-1] for row in plan))
+
+    def test_iter_unfinished_jobs(self):
+        self.queue.claim_jobs(1, 900)
+
+        # Processing and pending requests are recovered, the expired one is not
+        jobs = list(
+            self.queue.iter_unfinished_jobs(
+                900, (32, 32), max_request_id=2, chunk_size=1
+            )
+        )
+        self.assertEqual([job.job_id for job in jobs], [1, 2])
+        self.assertEqual(jobs[0].parameters["image"].shape, (32, 32, 3))
+
+    def test_recover_prediction_jobs(self):
+        recovered_jobs = Queue()
+        module = "application.predictions.prediction_manager"
+
+        with patch(f"{module}.PREDICTION_JOBS", recovered_jobs), patch(
+            f"{module}.serving_model_published", threading.Event()
+        ), patch(f"{module}.serving_input_shape", None), patch(
+            f"{module}.serving_model_version", None
+        ):
+            recovery_thread = threading.Thread(
+                target=recover_prediction_jobs,
+                args=(self.queue, self.queue.get_max_request_id()),
+            )
+            recovery_thread.start()
+
+            # The recovery waits for the first model to be served
+            recovery_thread.join(0.2)
+            self.assertTrue(recovery_thread.is_alive())
+            self.assertTrue(recovered_jobs.empty())
+
+            publish_serving_model(SimpleNamespace(input_shape=(32, 32), version=3))
+            recovery_thread.join(10)
+            self.assertFalse(recovery_thread.is_alive())
+
+        jobs = [recovered_jobs.get_nowait() for _ in range(3)]
+        self.assertEqual([job.job_id for job in jobs], [1, 2, 3])
+        self.assertTrue(recovered_jobs.empty())
+        # The images are resized to the input size of the served model
+        self.assertEqual(jobs[0].parameters["image"].shape, (32, 32, 3))
+
+    def test_get_active_model_version(self):
+        self.assertEqual(self.queue.get_active_model_version(), 3)
+
+
+@override_settings(PREDICTION_QUEUE_BACKEND="database")
+class DatabaseQueueRequestTests(TestCase):
+    def setUp(self):
+        """Set up test data and client"""
+        self.client = Client()
+        self.test_user = Users.objects.create(
+            username="testuser",
+            password=make_password("testpass123"),
+            age=25,
+            sex="male",
+            is_active=True,
+        )
+
+    def test_create_request_is_left_for_the_workers(self):
+        """Test that the request is stored as pending instead of being queued in memory"""
+        self.client.force_login(self.test_user)
+
+        with patch(
+            "application.views.create_request.PREDICTION_JOBS.put"
+        ) as mock_put, patch(
+            "application.views.create_request.start_prediction_manager"
+        ) as mock_start:
+            response = self.client.post(
+                reverse("api-create-request"),
+                json.dumps(
+                    {
+                        "localization": "face",
+                        "image": base64.b64encode(encode_test_image()).decode("utf-8"),
+                    }
+                ),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 201)
+        mock_put.assert_not_called()
+        mock_start.assert_not_called()
+
+        request = Requests.objects.get(request_id=response.json()["request_id"])
+        self.assertEqual(request.status, "pending")
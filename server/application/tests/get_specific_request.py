@@ -5,6 +5,7 @@
 from django.test import TestCase, Client
 from django.urls import reverse
 from ..models import Model, Requests, Users
+from unittest.mock import patch
 import base64
 import os
 import json
@@ -15,6 +16,14 @@ class GetSpecificRequestTests(TestCase):
         """Set up test data and client"""
         self.client = Client()
 
+        # Do not start the prediction threads, which would take the jobs
+        # of the shared queue from the other tests
+        manager_patcher = patch(
+            "application.views.get_specific_request.start_prediction_manager"
+        )
+        manager_patcher.start()
+        self.addCleanup(manager_patcher.stop)
+
         # Create a test admin user
         self.admin_user = Users.objects.create(
             username="adminuser",
@@ -198,6 +207,9 @@ class GetSpecificRequestTests(TestCase):
         self.assertIsNone(response_data["request"]["lesion_type"])
         self.assertIn("feature_impact", response_data["request"])
         self.assertIsNone(response_data["request"]["feature_impact"])
+
+        # The request has not been classified yet
+        self.assertEqual(response_data["request"]["stage"], "pending")
         self.assertIsNone(response_data["request"]["pixel_impact_visualized"])
 
     def test_feature_and_pixel_impact(self):
@@ -227,3 +239,57 @@ class GetSpecificRequestTests(TestCase):
             )
         else:
             self.assertIsNone(response_data["request"]["pixel_impact_visualized"])
+
+    def test_request_stage(self):
+        """Test that the stage of the prediction pipeline is returned"""
+        self.user_request.status = "classified"
+        self.user_request.save()
+
+        self.client.force_login(self.normal_user)
+        response = self.client.get(
+            reverse("api-get-specific-request", args=[self.user_request.request_id])
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["request"]["stage"], "classified")
+
+    def test_unfinished_request_starts_prediction_manager(self):
+        """Test that polling an unfinished request starts the prediction manager"""
+        self.client.force_login(self.normal_user)
+
+        for status, started in [("pending", True), ("explained", False)]:
+            self.user_request.status = status
+            self.user_request.save()
+
+            with patch(
+                "application.views.get_specific_request.start_prediction_manager"
+            ) as mock_start:
+                response = self.client.get(
+                    reverse(
+                        "api-get-specific-request",
+                        args=[self.user_request.request_id],
+                    )
+                )
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(mock_start.called, started)
+
+    def test_stored_heatmap_artifact(self):
+        """Test that the stored base64 heatmap is served with its format"""
+        self.user_request.heatmap = None
+        self.user_request.heatmap_base64 = "c3RvcmVkX2hlYXRtYXA="
+        self.user_request.heatmap_format = "image/webp"
+        self.user_request.cam_grid = "[[0.0, 1.0], [0.5, 0.25]]"
+        self.user_request.save()
+
+        self.client.force_login(self.normal_user)
+        response = self.client.get(
+            reverse("api-get-specific-request", args=[self.user_request.request_id])
+        )
+        self.assertEqual(response.status_code, 200)
+
+        request_data = response.json()["request"]
+        self.assertEqual(
+            request_data["pixel_impact_visualized"], "c3RvcmVkX2hlYXRtYXA="
+        )
+        self.assertEqual(request_data["pixel_impact_format"], "image/webp")
+        self.assertEqual(request_data["cam_grid"], "[[0.0, 1.0], [0.5, 0.25]]")
@@ -5,7 +5,7 @@ from django.test import TransactionTestCase
 from application.models import Requests, Users
 from application.predictions.prediction_manager import (
     delete_jobs_from_db,
-    extract_jobs_from_queue,
+    wait_for_jobs,
 )
 import time
 import threading
@@ -19,7 +19,7 @@ class JobExpirationTests(TransactionTestCase):
         Set up test data for requests.
         """
 
-        # Global Job queue, accessible by the extract_jobs_from_queue function
+        # Global Job queue, accessible by the wait_for_jobs function
         global PREDICTION_JOBS
 
         # Mock job class to simulate the job objects
@@ -123,16 +123,20 @@ class JobExpirationTests(TransactionTestCase):
 
     def test_extract_valid_job_single(self):
         """
-        Test that extract_jobs_from_queue correctly retrieves valid jobs.
+        Test that wait_for_jobs correctly retrieves valid jobs.
         """
         BATCH_SIZE = 1
         JOB_EXPIRY_TIME = 900  # 15 minutes
+        MAX_BATCH_WAIT = 0  # Only take the jobs that are already queued
+        IDLE_TIMEOUT = 0.1  # seconds
 
         # Add Mock jobs to global queue
         self.set_up_jobs_in_queue()
 
         # Extract valid jobs from the global queue
-        jobs_batch, _ = extract_jobs_from_queue(BATCH_SIZE, JOB_EXPIRY_TIME)
+        jobs_batch, _ = wait_for_jobs(
+            BATCH_SIZE, MAX_BATCH_WAIT, JOB_EXPIRY_TIME, IDLE_TIMEOUT
+        )
 
         # Assert that 1 valid jobs were retrieved
         self.assertEqual(len(jobs_batch), 1)
@@ -143,16 +147,20 @@ class JobExpirationTests(TransactionTestCase):
 
     def test_extract_valid_jobs_multiple(self):
         """
-        Test that extract_jobs_from_queue correctly retrieves valid jobs.
+        Test that wait_for_jobs correctly retrieves valid jobs.
         """
         BATCH_SIZE = 2
         JOB_EXPIRY_TIME = 900  # 15 minutes
+        MAX_BATCH_WAIT = 0  # Only take the jobs that are already queued
+        IDLE_TIMEOUT = 0.1  # seconds
 
         # Add Mock jobs to global queue
         self.set_up_jobs_in_queue()
 
         # Extract valid jobs from the global queue
-        jobs_batch, _ = extract_jobs_from_queue(BATCH_SIZE, JOB_EXPIRY_TIME)
+        jobs_batch, _ = wait_for_jobs(
+            BATCH_SIZE, MAX_BATCH_WAIT, JOB_EXPIRY_TIME, IDLE_TIMEOUT
+        )
 
         # Assert that 2 valid jobs were retrieved
         self.assertEqual(len(jobs_batch), 2)
@@ -167,16 +175,20 @@ class JobExpirationTests(TransactionTestCase):
 
     def test_extract_expired_job_single(self):
         """
-        Test that extract_jobs_from_queue correctly identifies expired jobs.
+        Test that wait_for_jobs correctly identifies expired jobs.
         """
         BATCH_SIZE = 1
         JOB_EXPIRY_TIME = 900  # 15 minutes
+        MAX_BATCH_WAIT = 0  # Only take the jobs that are already queued
+        IDLE_TIMEOUT = 0.1  # seconds
 
         # Add Mock jobs to global queue
         self.set_up_jobs_in_queue()
 
         # Extract expired jobs from the global queue
-        _, expired_jobs = extract_jobs_from_queue(BATCH_SIZE, JOB_EXPIRY_TIME)
+        _, expired_jobs = wait_for_jobs(
+            BATCH_SIZE, MAX_BATCH_WAIT, JOB_EXPIRY_TIME, IDLE_TIMEOUT
+        )
 
         # Assert that the expired job was identified correctly
         self.assertEqual(len(expired_jobs), 1)  # One expired job
@@ -184,16 +196,20 @@ class JobExpirationTests(TransactionTestCase):
 
     def test_extract_expired_jobs_multiple(self):
         """
-        Test that extract_jobs_from_queue correctly identifies expired jobs.
+        Test that wait_for_jobs correctly identifies expired jobs.
         """
         BATCH_SIZE = 2
         JOB_EXPIRY_TIME = 900  # 15 minutes
+        MAX_BATCH_WAIT = 0  # Only take the jobs that are already queued
+        IDLE_TIMEOUT = 0.1  # seconds
 
         # Add Mock jobs to global queue
         self.set_up_jobs_in_queue()
 
         # Extract expired jobs from the global queue
-        _, expired_jobs = extract_jobs_from_queue(BATCH_SIZE, JOB_EXPIRY_TIME)
+        _, expired_jobs = wait_for_jobs(
+            BATCH_SIZE, MAX_BATCH_WAIT, JOB_EXPIRY_TIME, IDLE_TIMEOUT
+        )
 
         # Assert that the expired job was identified correctly
         self.assertEqual(len(expired_jobs), 2)  # two expired jobs
@@ -206,13 +222,17 @@ class JobExpirationTests(TransactionTestCase):
         """
         BATCH_SIZE = 10
         JOB_EXPIRY_TIME = 900  # 15 minutes
+        MAX_BATCH_WAIT = 0  # Only take the jobs that are already queued
+        IDLE_TIMEOUT = 0.1  # seconds
 
         # Populate the global job queue
         for _ in range(0, BATCH_SIZE + 1):
             PREDICTION_JOBS.put(self.valid_job_1)
 
         # Extract valid jobs from the global queue
-        jobs_batch, _ = extract_jobs_from_queue(BATCH_SIZE, JOB_EXPIRY_TIME)
+        jobs_batch, _ = wait_for_jobs(
+            BATCH_SIZE, MAX_BATCH_WAIT, JOB_EXPIRY_TIME, IDLE_TIMEOUT
+        )
 
         # Asser that the correct number of jobs were extracted
         self.assertEqual(BATCH_SIZE, len(jobs_batch))
@@ -227,11 +247,13 @@ class JobExpirationTests(TransactionTestCase):
 
     def test_extract_empty_queue(self):
         """ "
-        Test that the thread doesn't hang if the extract function is called when the queue is empty.
+        Test that the thread doesn't hang if wait_for_jobs is called when the queue is empty.
         """
         TIMEOUT = 5  # seconds
         BATCH_SIZE = 1
         JOB_EXPIRY_TIME = 900  # 15 minutes
+        MAX_BATCH_WAIT = 0  # Only take the jobs that are already queued
+        IDLE_TIMEOUT = 0.1  # seconds
 
         # Ensure that the queue is empty before starting test
         while not (PREDICTION_JOBS.empty()):
@@ -244,8 +266,8 @@ class JobExpirationTests(TransactionTestCase):
         # Wrapper function is needed to share the result variables between the two threads
         def target_wrapper():
             nonlocal jobs_batch, expired_jobs
-            jobs_batch, expired_jobs = extract_jobs_from_queue(
-                BATCH_SIZE, JOB_EXPIRY_TIME
+            jobs_batch, expired_jobs = wait_for_jobs(
+                BATCH_SIZE, MAX_BATCH_WAIT, JOB_EXPIRY_TIME, IDLE_TIMEOUT
             )
 
         # Run in daemon to ensure child thread gets terminated even if it hangs
@@ -257,7 +279,7 @@ class JobExpirationTests(TransactionTestCase):
 
         if thread.is_alive():
             self.fail(
-                "The 'extract_jobs_from_queue' function timed out / hanged when called with an empty queue."
+                "The 'wait_for_jobs' function timed out / hanged when called with an empty queue."
             )
 
         # Assert that the function returned empty lists
@@ -270,21 +292,81 @@ class JobExpirationTests(TransactionTestCase):
         """
         BATCH_SIZE = 0
         JOB_EXPIRY_TIME = 900  # 15 minutes
+        MAX_BATCH_WAIT = 0  # Only take the jobs that are already queued
+        IDLE_TIMEOUT = 0.1  # seconds
 
         self.set_up_jobs_in_queue()
         try:
-            jobs_batch, expired_jobs = extract_jobs_from_queue(
-                BATCH_SIZE, JOB_EXPIRY_TIME
+            jobs_batch, expired_jobs = wait_for_jobs(
+                BATCH_SIZE, MAX_BATCH_WAIT, JOB_EXPIRY_TIME, IDLE_TIMEOUT
             )
         except Exception as e:
-            self.fail(
-                f"extract_jobs_from_queue threw an exception due to batch size being 0 {e}"
-            )
+            self.fail(f"wait_for_jobs threw an exception due to batch size being 0 {e}")
 
         # Assert nothing was returned
         self.assertEqual(len(jobs_batch), 0)
         self.assertEqual(len(expired_jobs), 0)
 
+    def test_wait_for_jobs_wakes_up_on_new_job(self):
+        """
+        Test that wait_for_jobs returns as soon as a job is put on the queue instead of waiting for the idle timeout.
+        """
+        IDLE_TIMEOUT = 5  # seconds
+        MAX_BATCH_WAIT = 0.05  # seconds
+
+        # Ensure that the queue is empty before starting test
+        while not (PREDICTION_JOBS.empty()):
+            _ = PREDICTION_JOBS.get_nowait()
+
+        # Put a job on the queue from another thread shortly after waiting starts
+        timer = threading.Timer(0.1, PREDICTION_JOBS.put, args=(self.valid_job_1,))
+        timer.start()
+
+        start = time.monotonic()
+        jobs_batch, expired_jobs = wait_for_jobs(64, MAX_BATCH_WAIT, 900, IDLE_TIMEOUT)
+        elapsed = time.monotonic() - start
+        timer.join()
+
+        # Assert that the job was returned well before the idle timeout
+        self.assertEqual(len(jobs_batch), 1)
+        self.assertEqual(expired_jobs, [])
+        self.assertLess(elapsed, 1)
+
+    def test_wait_for_jobs_coalesces_batch(self):
+        """
+        Test that wait_for_jobs coalesces queued jobs into one batch and respects the batch size.
+        """
+        BATCH_SIZE = 3
+
+        # Add Mock jobs to global queue, followed by more valid jobs than fit in the batch
+        self.set_up_jobs_in_queue()
+        for _ in range(BATCH_SIZE):
+            PREDICTION_JOBS.put(self.valid_job_1)
+
+        jobs_batch, expired_jobs = wait_for_jobs(BATCH_SIZE, 0, 900, 1)
+
+        # Expired jobs are collected but do not count towards the batch size
+        self.assertEqual(len(jobs_batch), BATCH_SIZE)
+        self.assertEqual(len(expired_jobs), 2)
+
+        # Assert that the remaining valid jobs are left in the queue
+        self.assertEqual(PREDICTION_JOBS.qsize(), 2)
+        while not (PREDICTION_JOBS.empty()):
+            _ = PREDICTION_JOBS.get_nowait()
+
+    def test_wait_for_jobs_empty_queue(self):
+        """
+        Test that wait_for_jobs returns empty lists after the idle timeout when no jobs arrive.
+        """
+        # Ensure that the queue is empty before starting test
+        while not (PREDICTION_JOBS.empty()):
+            _ = PREDICTION_JOBS.get_nowait()
+
+        jobs_batch, expired_jobs = wait_for_jobs(64, 0.05, 900, 0.1)
+
+        self.assertEqual(jobs_batch, [])
+        self.assertEqual(expired_jobs, [])
+
     def test_delete_single_job_from_db(self):
         """
         Test that delete_jobs_from_db successfully deletes a list with a single job from the database.
@@ -0,0 +1,108 @@
+from django.contrib.auth.hashers import make_password
+from django.test import Client, TestCase
+from django.urls import reverse
+from unittest.mock import patch
+from ..models import Users
+from ..predictions.metrics import Histogram, PipelineMetrics
+
+
+class PipelineMetricsTests(TestCase):
+    def setUp(self):
+        """Set up test data and client"""
+        self.client = Client()
+
+        self.test_user = Users.objects.create(
+            username="testuser",
+            password=make_password("testpass123"),
+            age=25,
+            sex="male",
+            is_active=True,
+        )
+        self.admin_user = Users.objects.create(
+            username="adminuser",
+            password=make_password("testpass123"),
+            age=30,
+            sex="female",
+            is_admin=True,
+            is_active=True,
+        )
+
+    ################################## UNIT TESTS ##################################
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram((0.1, 1, 10))
+        for value in (0.05, 0.5, 5, 50):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [1, 2, 3])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 55.55)
+
+    def test_render_prometheus_text(self):
+        metrics = PipelineMetrics()
+        metrics.observe("forward_pass", 0.02)
+        metrics.observe("forward_pass", 3)
+        metrics.observe_batch("classification", 16)
+        metrics.count_jobs("classified", 16)
+        metrics.set_model_version(7)
+
+        text = metrics.render({"skinscan_test_gauge": ("Test gauge.", 1.5)})
+        lines = text.splitlines()
+
+        self.assertIn("# TYPE skinscan_prediction_stage_seconds histogram", lines)
+        self.assertIn(
+            'skinscan_prediction_stage_seconds_bucket{stage="forward_pass",le="0.025"} 1',
+            lines,
+        )
+        self.assertIn(
+            'skinscan_prediction_stage_seconds_bucket{stage="forward_pass",le="+Inf"} 2',
+            lines,
+        )
+        self.assertIn(
+            'skinscan_prediction_stage_seconds_sum{stage="forward_pass"} 3.02', lines
+        )
+        self.assertIn(
+            'skinscan_prediction_stage_seconds_count{stage="gradients"} 0', lines
+        )
+        self.assertIn(
+            'skinscan_prediction_batch_size_bucket{pipeline="classification",le="16"} 1',
+            lines,
+        )
+        self.assertIn('skinscan_prediction_jobs_total{result="classified"} 16', lines)
+        self.assertIn("skinscan_prediction_model_version 7", lines)
+        self.assertIn("skinscan_test_gauge 1.5", lines)
+
+    def test_time_records_failed_blocks(self):
+        metrics = PipelineMetrics()
+
+        with self.assertRaises(ValueError):
+            with metrics.time("heatmap_encoding"):
+                raise ValueError("Encoding failed")
+
+        self.assertEqual(metrics.stages["heatmap_encoding"].count, 1)
+
+    ############################### INTEGRATION TESTS ###############################
+
+    def test_metrics_endpoint(self):
+        """Test that admins can read the metrics in the Prometheus text format"""
+        metrics = PipelineMetrics()
+        metrics.observe("queue_wait", 0.5)
+
+        self.client.force_login(self.admin_user)
+        with patch("application.views.jobs.metrics.PIPELINE_METRICS", metrics):
+            response = self.client.get(reverse("api-metrics"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+
+        text = response.content.decode("utf-8")
+        self.assertIn(
+            'skinscan_prediction_stage_seconds_count{stage="queue_wait"} 1', text
+        )
+        self.assertRegex(text, r"\nskinscan_prediction_queue_depth \d+\n")
+
+    def test_metrics_endpoint_admin_only(self):
+        """Test that normal users cannot read the metrics"""
+        self.client.force_login(self.test_user)
+        response = self.client.get(reverse("api-metrics"))
+        self.assertEqual(response.status_code, 401)
@@ -1,9 +1,21 @@
 # Contributors:
 # * Contributor: <alexandersafstrom@proton.me>
 from django.test import TestCase
+import os
+import json
+import sqlite3
+import tempfile
+from unittest.mock import patch
+import cv2
+import numpy as np
+import tensorflow as tf
 
 # Use a symlinked ML module to trick Django
 from ..mlsym.train import train
+from ..mlsym import cache
+from ..mlsym.cache import query_db_or_cache
+from ..mlsym.dataset import split_indices, make_dataset
+from ..mlsym.preprocess import decode_images, preprocess_images
 
 
 class MLTests(TestCase):
@@ -29,3 +41,281 @@ class MLTests(TestCase):
     # Add some teardown here later if needed
     def tearDown(self):
         pass
+
+
+class ImageCacheTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Images database and cache directory of the test
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.temp_dir.name, "cache")
+        self.db_path = os.path.join(self.temp_dir.name, "images.sqlite3")
+
+        rng = np.random.default_rng(0)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            """CREATE TABLE images (image_id TEXT, created_at INTEGER, image BLOB,
+            age INTEGER, sex TEXT, localization TEXT, lesion_type TEXT)"""
+        )
+        for i in range(10):
+            image = rng.integers(0, 256, (20, 24, 3), dtype=np.uint8)
+            _, encoded = cv2.imencode(".png", image)
+            conn.execute(
+                "INSERT INTO images VALUES (?, 0, ?, ?, ?, ?, ?)",
+                (
+                    f"image_{i}",
+                    encoded.tobytes(),
+                    # The third row is dropped when the data is cleaned
+                    None if i == 2 else 20 + i,
+                    "male" if i % 2 else "female",
+                    "face" if i % 3 else "back",
+                    "nv" if i % 2 else "mel",
+                ),
+            )
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        super().tearDown()
+
+    def query(self, **kwargs):
+        """Helper function that loads the test database through the cache."""
+        return query_db_or_cache(
+            db_name=self.db_path, cache_dir=self.cache_dir, **kwargs
+        )
+
+    def test_images_are_memory_mapped(self):
+        """Test that the cached images are stored as .npy with a metadata sidecar and opened as a memory map."""
+        processed_data, _, _, images = self.query(requested_size=(16, 16))
+
+        self.assertIsInstance(images, np.memmap)
+        self.assertEqual(images.shape, (9, 16, 16, 3))
+        # Raw pixels, the model normalizes them itself
+        self.assertEqual(images.dtype, np.uint8)
+        self.assertEqual(len(processed_data), 9)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "images.npy.tmp")))
+
+        with open(os.path.join(self.cache_dir, "images.json")) as f:
+            metadata = json.load(f)
+        self.assertEqual(metadata["shape"], [9, 16, 16, 3])
+        self.assertEqual(metadata["requested_size"], [16, 16])
+        self.assertIsNone(metadata["row_limit"])
+
+        # The second run opens the cache without loading the database
+        with patch.object(cache, "load_data") as load_data:
+            cached_data, _, _, cached_images = self.query(requested_size=(16, 16))
+        load_data.assert_not_called()
+        self.assertIsInstance(cached_images, np.memmap)
+        np.testing.assert_array_equal(cached_images, images)
+        self.assertTrue(cached_data.equals(processed_data))
+
+    def test_partial_load_by_row_range(self):
+        """Test that row ranges within the cached rows are sliced from the cache."""
+        processed_data, _, _, images = self.query(requested_size=(16, 16))
+
+        with patch.object(cache, "load_data") as load_data:
+            partial_data, _, _, partial_images = self.query(
+                requested_size=(16, 16), start_row=1, row_limit=4
+            )
+        load_data.assert_not_called()
+
+        # Rows 1 to 4 without the dropped third row
+        self.assertEqual(list(partial_data.index), [1, 3, 4])
+        self.assertEqual(partial_images.shape, (3, 16, 16, 3))
+        np.testing.assert_array_equal(partial_images, images[[1, 2, 3]])
+        # The selected images are a view of the memory map
+        self.assertIsInstance(partial_images, np.memmap)
+
+    def test_cache_is_rebuilt_for_other_rows_or_size(self):
+        """Test that the cache is rebuilt when it does not cover the requested rows or size."""
+        self.query(requested_size=(16, 16), start_row=2, row_limit=4)
+
+        # Rows before the cached range
+        _, _, _, images = self.query(requested_size=(16, 16), row_limit=4)
+        self.assertEqual(len(images), 3)
+
+        # Another image size
+        _, _, _, images = self.query(requested_size=(8, 8), row_limit=4)
+        self.assertEqual(images.shape[1:], (8, 8, 3))
+
+        # Rows after the cached range
+        with patch.object(cache, "load_data", wraps=cache.load_data) as load_data:
+            _, _, _, images = self.query(requested_size=(8, 8), start_row=2)
+        load_data.assert_called_once()
+        self.assertEqual(len(images), 7)
+
+    def test_parallel_decoding_keeps_order(self):
+        """Test that the images decoded in parallel are stored in the order of the rows."""
+        conn = sqlite3.connect(self.db_path)
+        binary_images = np.array(
+            [row[0] for row in conn.execute("SELECT image FROM images")], dtype=object
+        )
+        conn.close()
+
+        expected = np.stack([preprocess_images(b, (16, 16)) for b in binary_images])
+        images = np.zeros_like(expected)
+        decode_images(images, binary_images, (16, 16), workers=3, chunk_size=3)
+        np.testing.assert_array_equal(images, expected)
+
+        # An image that cannot be decoded fails the whole decoding
+        binary_images[7] = b"not an image"
+        with self.assertRaises(Exception):
+            decode_images(images, binary_images, (16, 16), workers=3, chunk_size=3)
+
+    def insert_image(self, image_id, lesion_type="nv", created_at=1, replace=False):
+        """Helper function that adds (or replaces) an image in the test database."""
+        image = np.random.default_rng(len(image_id)).integers(
+            0, 256, (20, 24, 3), dtype=np.uint8
+        )
+        _, encoded = cv2.imencode(".png", image)
+        conn = sqlite3.connect(self.db_path)
+        if replace:
+            conn.execute(
+                "UPDATE images SET image = ?, created_at = ? WHERE image_id = ?",
+                (encoded.tobytes(), created_at, image_id),
+            )
+        else:
+            conn.execute(
+                "INSERT INTO images VALUES (?, ?, ?, 40, 'male', 'face', ?)",
+                (image_id, created_at, encoded.tobytes(), lesion_type),
+            )
+        conn.commit()
+        conn.close()
+
+    def assert_matches_rebuild(self, data, images):
+        """Helper function that compares the cached data with a rebuilt cache."""
+        rebuilt_data, _, _, rebuilt_images = query_db_or_cache(
+            db_name=self.db_path,
+            cache_dir=os.path.join(self.temp_dir.name, "rebuilt"),
+            requested_size=(16, 16),
+        )
+        self.assertTrue(data.equals(rebuilt_data))
+        np.testing.assert_array_equal(images, rebuilt_images)
+
+    def test_new_rows_are_appended_to_cache(self):
+        """Test that only the rows that were added since the cache was built are preprocessed."""
+        self.query(requested_size=(16, 16))
+        self.insert_image("image_10")
+        self.insert_image("image_11", lesion_type="mel")
+
+        with patch.object(cache, "load_data", wraps=cache.load_data) as load_data:
+            data, _, _, images = self.query(requested_size=(16, 16))
+        load_data.assert_called_once()
+        self.assertEqual(load_data.call_args.kwargs["start_row"], 10)
+
+        self.assertEqual(list(data.index), [0, 1, 3, 4, 5, 6, 7, 8, 9, 10, 11])
+        self.assertIsInstance(images, np.memmap)
+        self.assert_matches_rebuild(data, images)
+
+        with open(os.path.join(self.cache_dir, "images.json")) as f:
+            metadata = json.load(f)
+        self.assertEqual(len(metadata["image_ids"]), 12)
+        self.assertEqual(metadata["max_created_at"], 1)
+
+    def test_changed_rows_are_reprocessed(self):
+        """Test that the rows from the first changed row on are preprocessed again."""
+        self.query(requested_size=(16, 16))
+        self.insert_image("image_5", created_at=2, replace=True)
+
+        with patch.object(cache, "load_data", wraps=cache.load_data) as load_data:
+            data, _, _, images = self.query(requested_size=(16, 16))
+        load_data.assert_called_once()
+        self.assertEqual(load_data.call_args.kwargs["start_row"], 5)
+        self.assert_matches_rebuild(data, images)
+
+    def test_new_class_rebuilds_cache(self):
+        """Test that the cache is rebuilt when the new rows change the encoders."""
+        self.query(requested_size=(16, 16))
+        self.insert_image("image_10", lesion_type="bcc")
+
+        with patch.object(cache, "load_data", wraps=cache.load_data) as load_data:
+            data, lesion_type_encoder, _, images = self.query(requested_size=(16, 16))
+        self.assertEqual(load_data.call_args.kwargs["start_row"], 0)
+        self.assertEqual(list(lesion_type_encoder.classes_), ["bcc", "mel", "nv"])
+        self.assert_matches_rebuild(data, images)
+
+
+class TrainingDatasetTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Memory-mapped images whose pixels are the index of the sample
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.images = np.lib.format.open_memmap(
+            os.path.join(self.temp_dir.name, "images.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(40, 8, 8, 3),
+        )
+        self.images[:] = np.arange(40, dtype=np.uint8)[:, None, None, None]
+        self.tabular = np.arange(40 * 3, dtype=np.float64).reshape(40, 3)
+        self.labels = np.arange(40) % 4
+        self.labels_cat = np.eye(4)[self.labels]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        super().tearDown()
+
+    def sample_ids(self, dataset):
+        """Helper function that returns the samples of a dataset and checks their alignment."""
+        ids = []
+        for (images, tabular), labels in dataset:
+            batch_ids = images.numpy()[:, 0, 0, 0].astype(int)
+            np.testing.assert_array_equal(tabular.numpy(), self.tabular[batch_ids])
+            np.testing.assert_array_equal(labels.numpy(), self.labels_cat[batch_ids])
+            ids.extend(batch_ids)
+        return ids
+
+    def test_split_indices_is_stratified(self):
+        """Test that the samples are split by their indices and stratified by their labels."""
+        train_indices, val_indices = split_indices(self.labels, 0.2, 666)
+
+        self.assertEqual(len(train_indices), 32)
+        self.assertEqual(len(val_indices), 8)
+        self.assertEqual(
+            sorted(np.concatenate([train_indices, val_indices])), list(range(40))
+        )
+        # Every class has the same share of both sets
+        self.assertEqual(list(np.bincount(self.labels[val_indices])), [2, 2, 2, 2])
+        # The same seed gives the same split
+        np.testing.assert_array_equal(
+            split_indices(self.labels, 0.2, 666)[1], val_indices
+        )
+
+    def test_dataset_streams_selected_samples(self):
+        """Test that the validation dataset yields the selected samples in order."""
+        indices = np.array([1, 4, 5, 9, 20, 39])
+        dataset = make_dataset(
+            self.images, self.tabular, self.labels_cat, indices, batch_size=4
+        )
+
+        self.assertEqual(self.sample_ids(dataset), list(indices))
+        # The images keep their raw pixel type
+        (images, _), _ = next(iter(dataset))
+        self.assertEqual(images.dtype, tf.uint8)
+        self.assertEqual(tuple(images.shape), (4, 8, 8, 3))
+
+    def test_dataset_reshuffles_every_epoch(self):
+        """Test that a shuffled dataset yields every sample once per epoch in a new order."""
+        indices = np.arange(0, 40, 2)
+        for cache in [None, "", os.path.join(self.temp_dir.name, "dataset")]:
+            with self.subTest(cache=cache):
+                dataset = make_dataset(
+                    self.images,
+                    self.tabular,
+                    self.labels_cat,
+                    indices,
+                    batch_size=8,
+                    shuffle=True,
+                    seed=0,
+                    cache=cache,
+                    read_chunk_size=7,
+                )
+                first_epoch = self.sample_ids(dataset)
+                second_epoch = self.sample_ids(dataset)
+
+                self.assertEqual(sorted(first_epoch), list(indices))
+                self.assertEqual(sorted(second_epoch), list(indices))
+                self.assertNotEqual(first_epoch, second_epoch)
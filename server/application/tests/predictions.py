@@ -6,15 +6,88 @@ from django.test import TestCase
 import numpy as np
 import cv2
 import os
-from unittest.mock import MagicMock
+import time
+import base64
+import pickle
+import json
+import sqlite3
+import tempfile
+import threading
+import importlib.util
+from contextlib import closing
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
 from sklearn.preprocessing import StandardScaler, LabelEncoder
 from ..models import Requests
-from ..predictions.prediction_manager import get_model_input_shape
+from ..predictions.prediction_manager import (
+    get_model_input_shape,
+    get_db_connection,
+    update_classifications_in_db,
+    update_failed_jobs_in_db,
+    explain_jobs,
+    process_predictions,
+    manage_predictions,
+)
+from ..predictions.database import db_connections, connect_db, close_db_connections
+from ..views.jobs.job import Job
 from ..predictions.preprocess_user_data import (
     preprocess_images,
+    resize_for_queue,
+    MAX_QUEUED_IMAGE_SIDE,
     extract_images,
     extract_tabular_features,
+    validate_image,
+    validate_tabular_features,
+    find_invalid_samples,
+    configure_preprocess_pool,
+    get_preprocess_pool,
+)
+from ..predictions.resources import (
+    parse_cpu_list,
+    configure_tensorflow_threads,
+    set_thread_affinity,
+    lower_thread_priority,
+)
+from ..predictions.explanations import (
+    GradCamExplainer,
+    find_grad_cam_layer,
+    render_heatmap,
+    compute_feature_impact,
+)
+from ..predictions.inference import (
+    CompiledPredictor,
+    get_bucket_size,
+    pad_batch,
+)
+from ..predictions.heatmap_artifacts import HeatmapEncoder, serialize_cam_grid
+from ..predictions.serving_model import (
+    ServingModel,
+    ModelReloader,
+    load_serving_model,
 )
+from ..predictions.backends import InferenceBackend, load_calibration_data
+from ..predictions.tflite_backend import (
+    TFLiteBackend,
+    TFLitePredictor,
+    convert_to_tflite,
+)
+from ..predictions.onnx_backend import OnnxBackend, OnnxPredictor
+from ..mlsym.persistence import save_model, export_onnx, load_onnx_model_from_db
+
+
+def build_test_model(input_shape=(32, 32, 3), num_classes=7):
+    """Builds a small model with the same inputs and outputs as the served model."""
+    import tensorflow as tf
+
+    image_input = tf.keras.layers.Input(shape=input_shape)
+    tabular_input = tf.keras.layers.Input(shape=(3,))
+    x = tf.keras.layers.Conv2D(8, 3, strides=2, name="first_conv")(image_input)
+    x = tf.keras.layers.Conv2D(8, 3, strides=2, name="last_conv")(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    y = tf.keras.layers.Dense(4, activation="relu")(tabular_input)
+    z = tf.keras.layers.concatenate([x, y])
+    output = tf.keras.layers.Dense(num_classes, activation="softmax")(z)
+    return tf.keras.models.Model(inputs=[image_input, tabular_input], outputs=output)
 
 
 class PreprocessDataTests(TestCase):
@@ -71,6 +144,93 @@ class PreprocessDataTests(TestCase):
         except Exception as e:
             self.fail(f"Valid image preprocessing failed: {str(e)}")
 
+    def test_resize_for_queue(self):
+        image = np.random.randint(0, 256, (3024, 4032, 3), dtype=np.uint8)
+
+        # Resized to the model input when it is known
+        resized = resize_for_queue(image, (224, 224))
+        self.assertEqual(resized.shape, (224, 224, 3))
+        self.assertEqual(resized.dtype, np.uint8)
+
+        # Otherwise only scaled down, keeping the aspect ratio
+        resized = resize_for_queue(image)
+        self.assertEqual(resized.shape, (384, MAX_QUEUED_IMAGE_SIDE, 3))
+
+        # Small images are kept as they are
+        small_image = image[:100, :100]
+        self.assertIs(resize_for_queue(small_image), small_image)
+
+        # Preprocessing an image that was resized at admission only normalizes it
+        queued = resize_for_queue(image, (224, 224))
+        np.testing.assert_array_equal(
+            preprocess_images([queued], (224, 224))[0],
+            preprocess_images([image], (224, 224))[0],
+        )
+
+    def test_validate_image(self):
+        self.assertIsNone(validate_image(np.zeros((480, 640, 3), dtype=np.uint8)))
+
+        # Wrong dtype, channels and sizes are reported
+        self.assertIsNotNone(validate_image(np.zeros((480, 640, 3), dtype=np.float32)))
+        self.assertIsNotNone(validate_image(np.zeros((480, 640), dtype=np.uint8)))
+        self.assertIsNotNone(validate_image(np.zeros((480, 640, 4), dtype=np.uint8)))
+        self.assertIsNotNone(validate_image(np.zeros((16, 640, 3), dtype=np.uint8)))
+
+    def test_validate_tabular_features(self):
+        self.assertIsNone(validate_tabular_features(42, "Female", "face"))
+
+        self.assertIsNotNone(validate_tabular_features(None, "male", "face"))
+        self.assertIsNotNone(validate_tabular_features(float("nan"), "male", "face"))
+        self.assertIsNotNone(validate_tabular_features(-1, "male", "face"))
+        self.assertIsNotNone(validate_tabular_features(42, "other", "face"))
+        self.assertIsNotNone(validate_tabular_features(42, "male", ""))
+
+    def test_find_invalid_samples(self):
+        images = np.zeros((4, 8, 8, 3), dtype=np.float16)
+        tabular = np.zeros((4, 3))
+        images[1, 0, 0, 0] = np.inf
+        tabular[3, 2] = np.nan
+
+        self.assertEqual(find_invalid_samples(images, tabular), [1, 3])
+        self.assertEqual(find_invalid_samples(images[[0, 2]], tabular[[0, 2]]), [])
+
+    def test_preprocess_batch_matches_single_images(self):
+        # Non-square images with and without an alpha channel
+        rng = np.random.default_rng(0)
+        images = [
+            rng.integers(0, 256, (300, 200, 3), dtype=np.uint8),
+            rng.integers(0, 256, (120, 480, 4), dtype=np.uint8),
+            rng.integers(0, 256, (64, 64, 3), dtype=np.uint8),
+        ]
+        target_input_shape = (48, 32)
+
+        result = preprocess_images(images, target_input_shape)
+        self.assertEqual(result.shape, (3, 48, 32, 3))
+
+        # The parallel batch must be identical to normalizing every image on its own
+        for index, image in enumerate(images):
+            if image.shape[-1] == 4:
+                image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
+            expected = (
+                cv2.resize(image, (32, 48), interpolation=cv2.INTER_AREA) / 127.5 - 1.0
+            ).astype(np.float16)
+            np.testing.assert_array_equal(result[index], expected)
+
+    def test_preprocess_raw_pixels(self):
+        """Test that images are only resized for models that normalize their inputs themselves."""
+        rng = np.random.default_rng(0)
+        images = [
+            rng.integers(0, 256, (300, 200, 3), dtype=np.uint8),
+            rng.integers(0, 256, (48, 32, 3), dtype=np.uint8),
+        ]
+
+        result = preprocess_images(images, (48, 32), normalize=False)
+        self.assertEqual(result.dtype, np.uint8)
+        np.testing.assert_array_equal(
+            result[0], cv2.resize(images[0], (32, 48), interpolation=cv2.INTER_AREA)
+        )
+        np.testing.assert_array_equal(result[1], images[1])
+
     def test_preprocess_invalid_image(self):
         """Test preprocessing of an invalid image."""
         try:
@@ -211,6 +371,23 @@ class PreprocessDataTests(TestCase):
         # Compare arrays
         np.testing.assert_array_equal(encoded_localizations, expected_encodings)
 
+    def test_extract_tabular_features_unknown_localization(self):
+        """Test that only the sample with a localization unknown to the model is invalid."""
+        jobs = [
+            MagicMock(parameters={"age": 30, "localization": "ear", "sex": "male"}),
+            MagicMock(parameters={"age": 40, "localization": "acral", "sex": "male"}),
+            MagicMock(parameters={"age": 50, "localization": "face", "sex": "female"}),
+        ]
+        scaler = StandardScaler().fit(np.array([[30, 0, 1], [50, 1, 0]]))
+        encoder = LabelEncoder().fit(["ear", "face"])
+
+        features, _ = extract_tabular_features(jobs, scaler, encoder)
+
+        self.assertEqual(find_invalid_samples(np.zeros((3, 8, 8, 3)), features), [1])
+        np.testing.assert_array_almost_equal(
+            features[[0, 2]], scaler.transform([[30, 0, 1], [50, 1, 0]])
+        )
+
     def test_ordering_is_preserved(self):
         """Test that the ordering of features is preserved when processing the jobs."""
         # Create mock data with known values
@@ -265,3 +442,912 @@ class PreprocessDataTests(TestCase):
     def tearDown(self):
         """Teardown method for cleaning up after tests."""
         pass
+
+
+class ExplanationTests(TestCase):
+    def setUp(self):
+        """Setup for tests, called before each test method."""
+        super().setUp()
+
+        self.model = build_test_model()
+        self.explainer = GradCamExplainer(self.model)
+
+        # Random batch of preprocessed images and standardized tabular features
+        rng = np.random.default_rng(0)
+        self.images = rng.uniform(-1, 1, (4, 32, 32, 3)).astype(np.float16)
+        self.tabular = rng.normal(size=(4, 3))
+
+    def test_explain_batch_shapes(self):
+        """Test that a batch is predicted and explained in one pass with the expected shapes."""
+        predictions, cams, tabular_importances = self.explainer.explain(
+            self.images, self.tabular
+        )
+
+        self.assertEqual(predictions.shape, (4, 7))
+        self.assertEqual(cams.shape[0], 4)
+        self.assertEqual(cams.ndim, 3)
+        self.assertEqual(tabular_importances.shape, (4, 3))
+        self.assertTrue(np.all(tabular_importances >= 0))
+
+        # The probabilities must match a regular forward pass
+        expected = self.model.predict(
+            [self.images.astype(np.float32), self.tabular], verbose=0
+        )
+        np.testing.assert_allclose(predictions, expected, rtol=1e-4, atol=1e-6)
+
+    def test_explain_batch_matches_single_samples(self):
+        """Test that the batched explanations are equal to explaining each sample on its own."""
+        _, cams, tabular_importances = self.explainer.explain(self.images, self.tabular)
+
+        for i in range(len(self.images)):
+            _, single_cam, single_importances = self.explainer.explain(
+                self.images[i : i + 1], self.tabular[i : i + 1]
+            )
+            np.testing.assert_allclose(cams[i], single_cam[0], rtol=1e-4, atol=1e-6)
+            np.testing.assert_allclose(
+                tabular_importances[i], single_importances[0], rtol=1e-4, atol=1e-6
+            )
+
+    def test_find_grad_cam_layer(self):
+        """Test that the last layer with a spatial output is discovered from the model graph."""
+        self.assertEqual(find_grad_cam_layer(self.model), "last_conv")
+        self.assertEqual(self.explainer.conv_layer_name, "last_conv")
+
+    def test_stored_grad_cam_layer(self):
+        """Test that a Grad-CAM layer stored with the model is used, and an unknown one is discovered instead."""
+        explainer = GradCamExplainer(self.model, "first_conv")
+        self.assertEqual(explainer.conv_layer_name, "first_conv")
+
+        with self.assertWarns(UserWarning):
+            explainer = GradCamExplainer(self.model, "conv5_block16_2_conv")
+        self.assertEqual(explainer.conv_layer_name, "last_conv")
+
+    def test_explainer_is_traced_once_per_bucket(self):
+        """Test that explaining batches of different sizes does not retrace the explanation function."""
+        tracing_count = (
+            self.explainer._explain.function.experimental_get_tracing_count()
+        )
+        self.assertEqual(tracing_count, len(self.explainer._explain.buckets))
+
+        for batch_size in (1, 2, 3, 4):
+            predictions, cams, _ = self.explainer.explain(
+                self.images[:batch_size], self.tabular[:batch_size]
+            )
+            # The padding must be removed from the outputs
+            self.assertEqual(len(predictions), batch_size)
+            self.assertEqual(len(cams), batch_size)
+
+        self.assertEqual(
+            self.explainer._explain.function.experimental_get_tracing_count(),
+            tracing_count,
+        )
+
+    def test_render_heatmap(self):
+        """Test that the heatmap is rendered at the size of the image."""
+        _, cams, _ = self.explainer.explain(self.images, self.tabular)
+
+        heatmap, heatmap_colored, layered = render_heatmap(cams[0], self.images[0])
+
+        self.assertEqual(heatmap.shape, (32, 32))
+        self.assertEqual(heatmap_colored.shape, (32, 32, 3))
+        self.assertEqual(layered.shape, (32, 32, 3))
+        self.assertEqual(layered.dtype, np.uint8)
+
+        # Raw pixels are rendered in the same way as normalized pixels
+        raw_image = np.round((self.images[0].astype(np.float32) + 1) * 127.5)
+        _, _, raw_layered = render_heatmap(cams[0], raw_image.astype(np.uint8))
+        np.testing.assert_allclose(raw_layered, layered, atol=1)
+
+    def test_compute_feature_impact(self):
+        """Test that the relative feature impacts add up to 100 percent."""
+        heatmap = np.full((32, 32), 100, dtype=np.uint8)
+        impact = compute_feature_impact(
+            heatmap, np.array([50.0, 25.0, 25.0]), ["age", "localization", "sex"]
+        )
+
+        self.assertEqual(list(impact.keys()), ["image", "age", "localization", "sex"])
+        self.assertAlmostEqual(impact["image"], 50.0)
+        self.assertAlmostEqual(sum(impact.values()), 100.0)
+
+
+class CompiledInferenceTests(TestCase):
+    def setUp(self):
+        """Setup for tests, called before each test method."""
+        super().setUp()
+
+        self.model = build_test_model()
+
+        # Random batch of preprocessed images and standardized tabular features
+        rng = np.random.default_rng(0)
+        self.images = rng.uniform(-1, 1, (7, 32, 32, 3)).astype(np.float16)
+        self.tabular = rng.normal(size=(7, 3))
+
+    def test_get_bucket_size(self):
+        """Test that batches are assigned to the smallest bucket that fits them."""
+        buckets = (1, 4, 16, 64)
+        self.assertEqual(get_bucket_size(1, buckets), 1)
+        self.assertEqual(get_bucket_size(2, buckets), 4)
+        self.assertEqual(get_bucket_size(16, buckets), 16)
+        self.assertEqual(get_bucket_size(17, buckets), 64)
+        self.assertEqual(get_bucket_size(100, buckets), 64)
+
+    def test_pad_batch(self):
+        """Test that batches are padded with zero samples along the batch axis only."""
+        padded = pad_batch(np.ones((3, 2, 2)), 4)
+        self.assertEqual(padded.shape, (4, 2, 2))
+        self.assertTrue(np.all(padded[3] == 0))
+
+        # Batches that already fit are not copied
+        batch = np.ones((4, 2))
+        self.assertIs(pad_batch(batch, 4), batch)
+
+    def test_compiled_predictor_matches_predict(self):
+        """Test that the compiled predictor returns the same probabilities as model.predict."""
+        # Use small buckets so the batch is both padded and chunked
+        predictor = CompiledPredictor(self.model, buckets=(1, 2, 4))
+        expected = self.model.predict(
+            [self.images.astype(np.float32), self.tabular], verbose=0
+        )
+
+        for batch_size in (1, 3, 7):
+            predictions = predictor.predict(
+                self.images[:batch_size], self.tabular[:batch_size]
+            )
+            np.testing.assert_allclose(
+                predictions, expected[:batch_size], rtol=1e-4, atol=1e-6
+            )
+
+
+class ServingModelTests(TestCase):
+    def setUp(self):
+        """Setup for tests, called before each test method."""
+        super().setUp()
+
+        # Fit a scaler and encoders and store them like the hyperparameters of a saved model
+        scaler = StandardScaler().fit([[20, 0, 0], [60, 1, 1]])
+        localization_encoder = LabelEncoder().fit(["ear", "face"])
+        lesion_type_encoder = LabelEncoder().fit(
+            ["akiec", "bcc", "bkl", "df", "mel", "nv", "vasc"]
+        )
+        encode = lambda obj: base64.b64encode(pickle.dumps(obj)).decode("utf-8")
+        self.hyperparameters = {
+            "tabular_scaler": encode(scaler),
+            "localization_encoder": encode(localization_encoder),
+            "lesion_type_encoder": encode(lesion_type_encoder),
+        }
+
+    def wait_for_reload(self, reloader, timeout=60):
+        """Helper function that waits until the background reload has finished."""
+        deadline = time.monotonic() + timeout
+        while reloader.is_reloading() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def test_serving_model_warm_up(self):
+        """Test that a serving model bundles the explainer, scaler and encoders and can be warmed up."""
+        serving_model = ServingModel(build_test_model(), self.hyperparameters, 3)
+
+        self.assertEqual(serving_model.version, 3)
+        self.assertEqual(serving_model.input_shape, (32, 32))
+        self.assertEqual(serving_model.explainer.conv_layer_name, "last_conv")
+        self.assertIsNone(serving_model.warmup_time)
+
+        warmup_time = serving_model.warm_up()
+        self.assertGreater(warmup_time, 0)
+        self.assertEqual(serving_model.warmup_time, warmup_time)
+
+    def test_serving_model_input_normalization(self):
+        """Test that only models without a Rescaling layer get normalized inputs."""
+        serving_model = ServingModel(build_test_model(), self.hyperparameters, 3)
+        self.assertTrue(serving_model.normalize_inputs)
+
+        hyperparameters = {**self.hyperparameters, "input_normalization": "model"}
+        serving_model = ServingModel(build_test_model(), hyperparameters, 4)
+        self.assertFalse(serving_model.normalize_inputs)
+
+    def test_model_reloader_loads_in_background(self):
+        """Test that the reloader loads and warms up the active model and hands it over exactly once."""
+        model = build_test_model()
+        with patch(
+            "application.predictions.serving_model.load_active_model_from_db",
+            return_value=(model, self.hyperparameters, 5),
+        ):
+            reloader = ModelReloader(":memory:", buckets=(1, 4))
+            reloader.request_reload()
+            self.wait_for_reload(reloader)
+
+        serving_model = reloader.take_ready_model()
+        self.assertIsNotNone(serving_model)
+        self.assertEqual(serving_model.version, 5)
+        self.assertIsNotNone(serving_model.warmup_time)
+
+        # The model is only handed over once
+        self.assertIsNone(reloader.take_ready_model())
+
+    def test_model_reloader_failed_load(self):
+        """Test that no model is handed over when the active model could not be loaded."""
+        with patch(
+            "application.predictions.serving_model.load_active_model_from_db",
+            return_value=(None, None, None),
+        ):
+            reloader = ModelReloader(":memory:")
+            reloader.request_reload()
+            self.wait_for_reload(reloader)
+
+        self.assertFalse(reloader.is_reloading())
+        self.assertIsNone(reloader.take_ready_model())
+
+
+class TFLiteBackendTests(TestCase):
+    def setUp(self):
+        """Setup for tests, called before each test method."""
+        super().setUp()
+
+        self.model = build_test_model()
+
+        # Random batch of preprocessed images and standardized tabular features
+        rng = np.random.default_rng(0)
+        self.images = rng.uniform(-1, 1, (7, 32, 32, 3)).astype(np.float32)
+        self.tabular = rng.normal(size=(7, 3)).astype(np.float32)
+
+        # Fit a scaler and encoders and store them like the hyperparameters of a saved model
+        scaler = StandardScaler().fit([[20, 0, 0], [60, 1, 1]])
+        localization_encoder = LabelEncoder().fit(["ear", "face"])
+        lesion_type_encoder = LabelEncoder().fit(
+            ["akiec", "bcc", "bkl", "df", "mel", "nv", "vasc"]
+        )
+        encode = lambda obj: base64.b64encode(pickle.dumps(obj)).decode("utf-8")
+        self.hyperparameters = {
+            "tabular_scaler": encode(scaler),
+            "localization_encoder": encode(localization_encoder),
+            "lesion_type_encoder": encode(lesion_type_encoder),
+        }
+
+        # App database with the stored model version, and the separate
+        # database of the training images
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, "test.sqlite3")
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "CREATE TABLE models (version INTEGER PRIMARY KEY, hyperparameters TEXT)"
+        )
+        conn.execute(
+            "INSERT INTO models VALUES (3, ?)", (json.dumps(self.hyperparameters),)
+        )
+        conn.commit()
+        conn.close()
+
+        self.images_db_path = os.path.join(self.temp_dir.name, "images.sqlite3")
+        conn = sqlite3.connect(self.images_db_path)
+        conn.execute(
+            """CREATE TABLE images (image_id TEXT PRIMARY KEY, image BLOB,
+            age INTEGER, sex TEXT, localization TEXT)"""
+        )
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        super().tearDown()
+
+    def insert_image(self, image_id, localization, age=40):
+        """Helper function that stores an encoded training image."""
+        _, encoded = cv2.imencode(".png", np.full((40, 40, 3), 128, np.uint8))
+        conn = sqlite3.connect(self.images_db_path)
+        conn.execute(
+            "INSERT INTO images VALUES (?, ?, ?, 'male', ?)",
+            (image_id, encoded.tobytes(), age, localization),
+        )
+        conn.commit()
+        conn.close()
+
+    def test_tflite_predictor_matches_model(self):
+        """Test that the quantized predictors stay close to the float model for padded and chunked batches."""
+        expected = self.model.predict([self.images, self.tabular], verbose=0)
+
+        for quantization in ("dynamic", "float16", "int8"):
+            model_content = convert_to_tflite(
+                self.model, quantization, (self.images, self.tabular)
+            )
+            predictor = TFLitePredictor(model_content, buckets=(1, 2, 4))
+
+            for batch_size in (1, 3, 7):
+                predictions = predictor.predict(
+                    self.images[:batch_size], self.tabular[:batch_size]
+                )
+                self.assertEqual(predictions.shape, (batch_size, 7))
+                np.testing.assert_allclose(
+                    predictions, expected[:batch_size], atol=0.05
+                )
+
+    def test_calibration_data_from_images(self):
+        """Test that stored images are preprocessed for calibration, skipping unknown localizations."""
+        serving_model = ServingModel(self.model, self.hyperparameters, 3)
+        self.insert_image("known", "ear")
+        self.insert_image("unknown", "hand")
+        self.insert_image("no_age", "face", age=None)
+
+        images, tabular = load_calibration_data(self.images_db_path, serving_model, 8)
+        self.assertEqual(images.shape, (1, 32, 32, 3))
+        self.assertEqual(tabular.shape, (1, 3))
+        self.assertTrue(np.all(np.abs(images) <= 1))
+
+        # There is no calibration data without usable images
+        self.assertIsNone(load_calibration_data(None, serving_model, 8))
+        with self.assertWarns(UserWarning):
+            self.assertIsNone(load_calibration_data(self.db_path, serving_model, 8))
+        missing_db_path = os.path.join(self.temp_dir.name, "missing.sqlite3")
+        with self.assertWarns(UserWarning):
+            self.assertIsNone(load_calibration_data(missing_db_path, serving_model, 8))
+        # The missing database is not created
+        self.assertFalse(os.path.exists(missing_db_path))
+
+    def test_backend_stores_drift_check(self):
+        """Test that the quantized predictor is served and its drift check is stored with the model version."""
+        serving_model = ServingModel(self.model, self.hyperparameters, 3, (1, 4))
+        self.insert_image("known", "ear")
+
+        check = TFLiteBackend(
+            "dynamic", min_agreement=0, images_db_path=self.images_db_path
+        ).apply(serving_model, self.db_path)
+        self.assertTrue(check["accepted"])
+        self.assertTrue(check["checked"])
+        self.assertIsInstance(serving_model.predictor, TFLitePredictor)
+        self.assertEqual(serving_model.inference_backend, "tflite-dynamic")
+        self.assertGreater(serving_model.warm_up(), 0)
+
+        conn = sqlite3.connect(self.db_path)
+        hyperparameters = json.loads(
+            conn.execute("SELECT hyperparameters FROM models").fetchone()[0]
+        )
+        conn.close()
+        stored_check = hyperparameters["inference_backends"]["tflite-dynamic"]
+        self.assertEqual(stored_check["samples"], 1)
+        self.assertEqual(stored_check["top1_agreement"], check["top1_agreement"])
+        # The rest of the hyperparameters are kept
+        self.assertEqual(
+            hyperparameters["tabular_scaler"], self.hyperparameters["tabular_scaler"]
+        )
+
+    def test_backend_keeps_float_model_on_drift(self):
+        """Test that the float model keeps serving when the quantized model agrees with it too rarely."""
+        serving_model = ServingModel(self.model, self.hyperparameters, 3, (1, 4))
+        self.insert_image("known", "ear")
+
+        with self.assertWarns(UserWarning):
+            check = TFLiteBackend(
+                "float16", min_agreement=1.1, images_db_path=self.images_db_path
+            ).apply(serving_model, self.db_path)
+        self.assertFalse(check["accepted"])
+        self.assertEqual(check["samples"], 1)
+        self.assertIsInstance(serving_model.predictor, CompiledPredictor)
+        self.assertEqual(serving_model.inference_backend, "tensorflow")
+        self.assertEqual(serving_model.backend_check, check)
+
+    def test_backend_must_build_a_predictor(self):
+        """Test that a backend without a predictor fails when it is created."""
+
+        class IncompleteBackend(InferenceBackend):
+            name = "incomplete"
+
+        with self.assertRaises(TypeError):
+            IncompleteBackend()
+
+    def test_backend_without_stored_images(self):
+        """Test that int8 is refused without stored images and the other modes are served unchecked."""
+        serving_model = ServingModel(self.model, self.hyperparameters, 3, (1, 4))
+
+        with self.assertRaises(RuntimeError):
+            TFLiteBackend("int8", images_db_path=self.images_db_path).apply(
+                serving_model, self.db_path
+            )
+        self.assertIsInstance(serving_model.predictor, CompiledPredictor)
+
+        with self.assertWarns(UserWarning):
+            check = TFLiteBackend("dynamic", images_db_path=self.images_db_path).apply(
+                serving_model, self.db_path
+            )
+        self.assertTrue(check["accepted"])
+        self.assertFalse(check["checked"])
+        self.assertEqual(check["samples"], 0)
+        self.assertIsNone(check["top1_agreement"])
+        self.assertIsInstance(serving_model.predictor, TFLitePredictor)
+
+    def test_unknown_quantization(self):
+        """Test that unknown quantization modes are rejected."""
+        with self.assertRaises(ValueError):
+            TFLiteBackend("int4")
+
+
+class OnnxBackendTests(TestCase):
+    def setUp(self):
+        """Setup for tests, called before each test method."""
+        super().setUp()
+
+        self.model = build_test_model()
+
+        # Fit a scaler and encoders and store them like the hyperparameters of a saved model
+        self.scaler = StandardScaler().fit([[20, 0, 0], [60, 1, 1]])
+        self.localization_encoder = LabelEncoder().fit(["ear", "face"])
+        self.lesion_type_encoder = LabelEncoder().fit(
+            ["akiec", "bcc", "bkl", "df", "mel", "nv", "vasc"]
+        )
+        encode = lambda obj: base64.b64encode(pickle.dumps(obj)).decode("utf-8")
+        self.hyperparameters = {
+            "tabular_scaler": encode(self.scaler),
+            "localization_encoder": encode(self.localization_encoder),
+            "lesion_type_encoder": encode(self.lesion_type_encoder),
+        }
+
+        # Database with the same models table as the app database
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, "test.sqlite3")
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            """CREATE TABLE models (version INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER, weights BLOB, hyperparameters TEXT, onnx_model BLOB)"""
+        )
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        super().tearDown()
+
+    def save_test_model(self):
+        """Helper function that saves the test model like a trained model."""
+        save_model(
+            self.db_path,
+            "models",
+            self.model,
+            0.1,
+            (32, 32, 3),
+            0.0,
+            "categorical_crossentropy",
+            1,
+            16,
+            1e-5,
+            0.5,
+            self.scaler,
+            self.lesion_type_encoder,
+            self.localization_encoder,
+            0.5,
+        )
+
+    def test_save_model_stores_onnx_export(self):
+        """Test that the ONNX export is stored next to the weights of a saved model."""
+        with patch(
+            "application.mlsym.persistence.export_onnx", return_value=b"onnx model"
+        ):
+            self.save_test_model()
+
+        with closing(connect_db(self.db_path)) as conn:
+            self.assertEqual(load_onnx_model_from_db(conn, 1), b"onnx model")
+            self.assertIsNone(load_onnx_model_from_db(conn, 2))
+
+    def test_backend_without_export_keeps_float_model(self):
+        """Test that the float model keeps serving a model version that cannot be exported."""
+        with patch(
+            "application.mlsym.persistence.export_onnx", return_value=None
+        ), patch("application.predictions.onnx_backend.export_onnx", return_value=None):
+            self.save_test_model()
+
+            with patch(
+                "application.predictions.serving_model.load_active_model_from_db",
+                return_value=(self.model, self.hyperparameters, 1),
+            ), self.assertWarns(UserWarning):
+                serving_model = load_serving_model(self.db_path, (1, 4), OnnxBackend())
+
+        self.assertEqual(serving_model.version, 1)
+        self.assertEqual(serving_model.inference_backend, "tensorflow")
+        self.assertIsInstance(serving_model.predictor, CompiledPredictor)
+
+    @skipUnless(
+        importlib.util.find_spec("onnxruntime") and importlib.util.find_spec("tf2onnx"),
+        "onnxruntime and tf2onnx are optional dependencies",
+    )
+    def test_onnx_predictor_matches_model(self):
+        """Test that the ONNX Runtime predictor returns the same probabilities as the model."""
+        rng = np.random.default_rng(0)
+        images = rng.uniform(-1, 1, (7, 32, 32, 3)).astype(np.float32)
+        tabular = rng.normal(size=(7, 3)).astype(np.float32)
+        expected = self.model.predict([images, tabular], verbose=0)
+
+        # Use small buckets so the batch is chunked
+        predictor = OnnxPredictor(export_onnx(self.model), buckets=(1, 2, 4))
+        for batch_size in (1, 3, 7):
+            np.testing.assert_allclose(
+                predictor.predict(images[:batch_size], tabular[:batch_size]),
+                expected[:batch_size],
+                rtol=1e-4,
+                atol=1e-5,
+            )
+
+    @skipUnless(
+        importlib.util.find_spec("onnxruntime") and importlib.util.find_spec("tf2onnx"),
+        "onnxruntime and tf2onnx are optional dependencies",
+    )
+    def test_backend_serves_stored_export(self):
+        """Test that the export stored with a saved model is served with ONNX Runtime."""
+        self.save_test_model()
+
+        with patch(
+            "application.predictions.serving_model.load_active_model_from_db",
+            return_value=(self.model, self.hyperparameters, 1),
+        ), patch("application.predictions.onnx_backend.export_onnx") as export:
+            serving_model = load_serving_model(
+                self.db_path, (1, 4), OnnxBackend(min_agreement=0)
+            )
+        export.assert_not_called()
+
+        self.assertEqual(serving_model.inference_backend, "onnx")
+        self.assertIsInstance(serving_model.predictor, OnnxPredictor)
+        self.assertGreater(serving_model.warm_up(), 0)
+
+
+class ThreadSettingsTests(TestCase):
+    def run_in_thread(self, fn):
+        """Helper function that runs a function on a new thread and returns its result."""
+        results = []
+        thread = threading.Thread(target=lambda: results.append(fn()))
+        thread.start()
+        thread.join()
+        return results[0]
+
+    def test_parse_cpu_list(self):
+        """Test that CPU lists are parsed in the format of taskset."""
+        self.assertEqual(parse_cpu_list("0-3,6"), {0, 1, 2, 3, 6})
+        self.assertEqual(parse_cpu_list(" 2 "), {2})
+        self.assertEqual(parse_cpu_list([1, 2]), {1, 2})
+        self.assertIsNone(parse_cpu_list(""))
+        self.assertIsNone(parse_cpu_list(None))
+
+    @skipUnless(hasattr(os, "sched_setaffinity"), "CPU affinity requires Linux")
+    def test_set_thread_affinity(self):
+        """Test that the affinity only applies to the calling thread."""
+        cpus = os.sched_getaffinity(0)
+        first_cpu = min(cpus)
+
+        def pin():
+            set_thread_affinity(str(first_cpu))
+            return os.sched_getaffinity(threading.get_native_id())
+
+        self.assertEqual(self.run_in_thread(pin), {first_cpu})
+        self.assertEqual(os.sched_getaffinity(0), cpus)
+
+        # No affinity is set without a CPU list
+        self.assertFalse(set_thread_affinity(None))
+
+    @skipUnless(hasattr(os, "setpriority"), "Thread priorities require Linux")
+    def test_lower_thread_priority(self):
+        """Test that the niceness is only added to the calling thread."""
+        niceness = os.getpriority(os.PRIO_PROCESS, threading.get_native_id())
+
+        def lower():
+            lower_thread_priority(5)
+            return os.getpriority(os.PRIO_PROCESS, threading.get_native_id())
+
+        self.assertEqual(self.run_in_thread(lower), min(niceness + 5, 19))
+        self.assertEqual(
+            os.getpriority(os.PRIO_PROCESS, threading.get_native_id()), niceness
+        )
+        self.assertFalse(lower_thread_priority(0))
+
+    def test_configure_tensorflow_threads_after_initialization(self):
+        """Test that the thread pools cannot be resized once TensorFlow has run an operation."""
+        import tensorflow as tf
+
+        tf.constant(1.0) + 1
+        with self.assertWarns(UserWarning):
+            self.assertFalse(configure_tensorflow_threads(intra_op_threads=2))
+
+        # Nothing is changed without thread counts
+        self.assertTrue(configure_tensorflow_threads())
+
+    def test_configure_preprocess_pool(self):
+        """Test that the preprocessing pool is recreated with the configured size."""
+        try:
+            configure_preprocess_pool(2)
+            pool = get_preprocess_pool()
+            self.assertEqual(pool._max_workers, 2)
+            self.assertIs(get_preprocess_pool(), pool)
+        finally:
+            configure_preprocess_pool(None)
+        self.assertIsNot(get_preprocess_pool(), pool)
+
+
+class HeatmapEncoderTests(TestCase):
+    def setUp(self):
+        """Setup for tests, called before each test method."""
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.cam = rng.normal(size=(7, 7)).astype(np.float32)
+        self.image = rng.uniform(-1, 1, (32, 32, 3)).astype(np.float16)
+        self.heatmap_tuple = render_heatmap(self.cam, self.image)
+
+    def test_encode_formats(self):
+        """Test that the overlay is encoded in the configured format."""
+        for image_format, mime_type in (
+            ("png", "image/png"),
+            ("webp", "image/webp"),
+            ("jpeg", "image/jpeg"),
+        ):
+            artifacts = HeatmapEncoder(image_format, quality=80).encode(
+                self.cam, self.heatmap_tuple
+            )
+            self.assertEqual(artifacts["heatmap_format"], mime_type)
+            self.assertIsNone(artifacts["cam_grid"])
+
+            # The stored string decodes to an image of the overlay size
+            decoded = cv2.imdecode(
+                np.frombuffer(base64.b64decode(artifacts["heatmap_base64"]), np.uint8),
+                cv2.IMREAD_COLOR,
+            )
+            self.assertEqual(decoded.shape, (32, 32, 3))
+
+    def test_encode_size_and_cam_grid(self):
+        """Test that the overlay is resized and the raw grid is stored if configured."""
+        artifacts = HeatmapEncoder("png", size=16, store_cam_grid=True).encode(
+            self.cam, self.heatmap_tuple
+        )
+        decoded = cv2.imdecode(
+            np.frombuffer(base64.b64decode(artifacts["heatmap_base64"]), np.uint8),
+            cv2.IMREAD_COLOR,
+        )
+        self.assertEqual(decoded.shape, (16, 16, 3))
+
+        # The grid keeps the resolution of the conv layer and is normalized
+        cam_grid = np.array(json.loads(artifacts["cam_grid"]))
+        self.assertEqual(cam_grid.shape, (7, 7))
+        self.assertAlmostEqual(cam_grid.max(), 1.0, places=3)
+        self.assertGreaterEqual(cam_grid.min(), 0.0)
+        self.assertEqual(artifacts["cam_grid"], serialize_cam_grid(self.cam))
+
+    def test_unsupported_format(self):
+        """Test that an unknown heatmap format is rejected."""
+        with self.assertRaises(ValueError):
+            HeatmapEncoder("gif")
+
+
+class ResultWriteBackTests(TestCase):
+    def setUp(self):
+        """Setup for tests, called before each test method."""
+        super().setUp()
+
+        # Use a separate database file with a minimal requests table
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, "results.sqlite3")
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            """
+            CREATE TABLE requests (
+                request_id INTEGER PRIMARY KEY, probability REAL, lesion_type TEXT,
+                model INTEGER, feature_impact TEXT, heatmap_base64 TEXT,
+                heatmap_format TEXT, cam_grid TEXT, status TEXT DEFAULT 'pending',
+                claimed_at INTEGER
+            );
+            """
+        )
+        conn.executemany(
+            "INSERT INTO requests (request_id) VALUES (?);", [(1,), (2,), (3,)]
+        )
+        conn.commit()
+        conn.close()
+
+        self.lesion_type_encoder = LabelEncoder().fit(["akiec", "bcc", "mel"])
+
+    def tearDown(self):
+        # Close the persistent connection before removing the database file
+        connections = getattr(db_connections, "connections", {})
+        if self.db_path in connections:
+            connections.pop(self.db_path).close()
+        self.temp_dir.cleanup()
+        super().tearDown()
+
+    def select_requests(self):
+        return (
+            get_db_connection(self.db_path)
+            .execute(
+                "SELECT request_id, probability, lesion_type, model, feature_impact, "
+                "heatmap_base64, status FROM requests ORDER BY request_id;"
+            )
+            .fetchall()
+        )
+
+    def test_update_classifications_in_db_batch(self):
+        """Test that all classifications of a batch are written in one go."""
+        jobs = [Job(request_id, time.time(), {}) for request_id in (1, 3)]
+        predictions = np.array([[0.1, 0.7, 0.2], [0.8, 0.1, 0.1]])
+
+        write_time = update_classifications_in_db(
+            self.db_path, jobs, predictions, self.lesion_type_encoder, 5
+        )
+        self.assertIsNotNone(write_time)
+
+        # The explanations are not written by the classification stage
+        self.assertEqual(
+            self.select_requests(),
+            [
+                (1, 0.7, "bcc", 5, None, None, "classified"),
+                (2, None, None, None, None, None, "pending"),
+                (3, 0.8, "akiec", 5, None, None, "classified"),
+            ],
+        )
+
+    def test_explain_jobs_writes_explanations(self):
+        """Test that the explanation stage fills in the heatmap and the feature impact."""
+        explainer = GradCamExplainer(build_test_model(), buckets=(1, 4))
+        rng = np.random.default_rng(0)
+
+        jobs = []
+        for request_id in (1, 2):
+            job = Job(request_id, time.time(), {"request_id": request_id})
+            job.resized_image = rng.uniform(-1, 1, (32, 32, 3)).astype(np.float16)
+            job.tabular_features = rng.normal(size=3)
+            job.feature_names = ["age", "localization", "sex"]
+            job.classified_at = time.time()
+            jobs.append(job)
+
+        explain_jobs(self.db_path, explainer, jobs, HeatmapEncoder("png"))
+
+        rows = self.select_requests()
+        for row in rows[:2]:
+            feature_impact, heatmap_base64, status = row[4:]
+            self.assertEqual(status, "explained")
+            # The heatmap is stored as a base64 encoded PNG image
+            self.assertTrue(base64.b64decode(heatmap_base64).startswith(b"\x89PNG"))
+            self.assertEqual(
+                set(json.loads(feature_impact)),
+                {"image", "age", "localization", "sex"},
+            )
+        self.assertEqual(rows[2][6], "pending")
+
+    def test_process_predictions_falls_back_to_single_samples(self):
+        """Test that a failing batch is processed sample by sample, skipping failures."""
+        images = np.arange(4, dtype=np.float32).reshape(4, 1)
+        tabular = np.zeros((4, 1), dtype=np.float32)
+
+        def model_fn(image_batch, tabular_batch):
+            # Fail for whole batches and for the sample with value 2
+            if len(image_batch) > 1 or image_batch[0, 0] == 2:
+                raise ValueError("Invalid input")
+            return image_batch * 2, image_batch + tabular_batch
+
+        outputs, valid_indices = process_predictions(model_fn, images, tabular)
+        self.assertEqual(valid_indices, [0, 1, 3])
+        np.testing.assert_array_equal(outputs[0], [[0], [2], [6]])
+        np.testing.assert_array_equal(outputs[1], [[0], [1], [3]])
+
+    def test_process_predictions_bisects_failing_batch(self):
+        """Test that a single bad sample is isolated with a logarithmic number of calls."""
+        images = np.arange(64, dtype=np.float32).reshape(64, 1)
+        tabular = np.zeros((64, 1), dtype=np.float32)
+        calls = []
+
+        def model_fn(image_batch, tabular_batch):
+            calls.append(len(image_batch))
+            if 37 in image_batch:
+                raise ValueError("Invalid input")
+            return image_batch * 2
+
+        outputs, valid_indices = process_predictions(model_fn, images, tabular)
+
+        self.assertEqual(valid_indices, [i for i in range(64) if i != 37])
+        np.testing.assert_array_equal(outputs, images[valid_indices] * 2)
+        # One call for the batch and two for each of the log2(64) levels
+        self.assertLessEqual(len(calls), 1 + 2 * 6)
+
+    def test_update_failed_jobs_in_db(self):
+        """Test that the requests of failed jobs are marked as failed."""
+        jobs = [Job(request_id, time.time(), {}) for request_id in (1, 3)]
+
+        self.assertTrue(update_failed_jobs_in_db(self.db_path, jobs))
+        self.assertEqual(
+            [row[6] for row in self.select_requests()], ["failed", "pending", "failed"]
+        )
+
+    def run_prediction_batch(self, jobs, explanation_jobs=None, admission=None):
+        """Runs a single batch of jobs through the prediction loop."""
+        serving_model = MagicMock(
+            input_shape=(32, 32),
+            version=5,
+            lesion_type_encoder=self.lesion_type_encoder,
+        )
+        serving_model.predictor.predict.return_value = np.array(
+            [[0.1, 0.7, 0.2], [0.8, 0.1, 0.1], [0.2, 0.2, 0.6]]
+        )[: len(jobs)]
+        reloader = MagicMock()
+        reloader.take_ready_model.return_value = None
+
+        class StopLoop(Exception):
+            pass
+
+        module = "application.predictions.prediction_manager"
+        with patch(f"{module}.get_db_path", return_value=self.db_path), patch(
+            f"{module}.get_inference_backend", return_value=None
+        ), patch(f"{module}.ModelReloader", return_value=reloader), patch(
+            f"{module}.load_serving_model", return_value=serving_model
+        ), patch(
+            f"{module}.publish_serving_model"
+        ), patch(
+            f"{module}.PIPELINE_METRICS"
+        ), patch(
+            f"{module}.wait_for_jobs", side_effect=[(jobs, []), StopLoop]
+        ), patch(
+            f"{module}.extract_images"
+        ), patch(
+            f"{module}.preprocess_images",
+            return_value=np.zeros((len(jobs), 32, 32, 3)),
+        ), patch(
+            f"{module}.extract_tabular_features",
+            return_value=(np.zeros((len(jobs), 3)), ["age", "localization", "sex"]),
+        ), patch(
+            f"{module}.EXPLANATION_JOBS", explanation_jobs or MagicMock()
+        ), patch(
+            f"{module}.PREDICTION_ADMISSION", admission or MagicMock()
+        ):
+            # The loop only stops when the next batch is awaited
+            with self.assertRaises(StopLoop):
+                manage_predictions()
+
+    def test_failed_batch_keeps_explained_jobs(self):
+        """Test that an error after the hand-over only fails the jobs that were not handed over."""
+        jobs = [Job(request_id, time.time(), {}) for request_id in (1, 2, 3)]
+        explanation_jobs = MagicMock()
+        # The second job cannot be handed over to the explanation stage
+        explanation_jobs.put.side_effect = [None, RuntimeError("Queue error")]
+
+        self.run_prediction_batch(jobs, explanation_jobs)
+
+        # The first job stays with the explanation stage
+        self.assertEqual(
+            [row[6] for row in self.select_requests()],
+            ["classified", "failed", "failed"],
+        )
+
+    def test_failed_classification_write_fails_jobs(self):
+        """Test that the jobs whose classification could not be stored are failed, not explained."""
+        jobs = [Job(request_id, time.time(), {}) for request_id in (1, 2)]
+        explanation_jobs = MagicMock()
+
+        with patch(
+            "application.predictions.prediction_manager.update_classifications_in_db",
+            return_value=None,
+        ):
+            self.run_prediction_batch(jobs, explanation_jobs)
+
+        explanation_jobs.put.assert_not_called()
+        self.assertEqual(
+            [row[6] for row in self.select_requests()],
+            ["failed", "failed", "pending"],
+        )
+
+    def test_metrics_error_does_not_stop_prediction_loop(self):
+        """Test that an error while recording the metrics only fails the batch."""
+        jobs = [Job(request_id, time.time(), {}) for request_id in (1, 2)]
+        del jobs[1].queued_at
+        admission = MagicMock()
+
+        self.run_prediction_batch(jobs, admission=admission)
+
+        self.assertEqual(
+            [row[6] for row in self.select_requests()],
+            ["failed", "failed", "pending"],
+        )
+        # The throughput is still recorded
+        admission.record_batch.assert_called_once()
+
+    def test_db_connection_is_persistent_and_uses_wal(self):
+        """Test that the connection is reused and the database is in WAL mode."""
+        conn = get_db_connection(self.db_path)
+        self.assertIs(get_db_connection(self.db_path), conn)
+        self.assertEqual(conn.execute("PRAGMA journal_mode;").fetchone()[0], "wal")
+
+    def test_close_db_connections(self):
+        """Test that the connections of a thread are closed, so it can exit without leaking them."""
+        conn = get_db_connection(self.db_path)
+        close_db_connections()
+
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1;")
+        # A new connection is opened on the next use
+        self.assertIsNot(get_db_connection(self.db_path), conn)
@@ -0,0 +1,176 @@
+import os
+import json
+import base64
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.test import Client, TestCase
+from django.urls import reverse
+from unittest.mock import patch
+from PIL import Image
+from ..models import Users, Requests
+from ..predictions.prediction_manager import signal_model_reload
+from ..predictions.result_cache import ResultCache, content_key
+
+
+def build_result(heatmap_base64="aGVhdG1hcA=="):
+    """Returns a cached result with the given heatmap."""
+    return {
+        "probability": 0.9,
+        "lesion_type": "mel",
+        "model": 3,
+        "feature_impact": json.dumps({"image": 80.0, "age": 20.0}),
+        "heatmap_base64": heatmap_base64,
+        "heatmap_format": "image/webp",
+        "cam_grid": None,
+    }
+
+
+class ResultCacheTests(TestCase):
+    def setUp(self):
+        """Set up test data and client"""
+        self.client = Client()
+
+        # Do not start the prediction threads, which would take the jobs
+        # of the shared queue from the other tests
+        manager_patcher = patch(
+            "application.views.create_request.start_prediction_manager"
+        )
+        manager_patcher.start()
+        self.addCleanup(manager_patcher.stop)
+
+        self.test_user = Users.objects.create(
+            username="testuser",
+            password=make_password("testpass123"),
+            age=25,
+            sex="male",
+            is_active=True,
+        )
+
+        valid_image_path = os.path.join(
+            os.path.dirname(__file__), "test_data", "valid_test_image.jpg"
+        )
+        with open(valid_image_path, "rb") as img_file:
+            self.image_data = img_file.read()
+        self.image = np.array(Image.open(valid_image_path), np.uint8)
+
+    ################################## UNIT TESTS ##################################
+
+    def test_get_and_put(self):
+        cache = ResultCache(max_entries=4)
+
+        self.assertIsNone(cache.get("key", 3))
+        cache.put("key", 3, build_result())
+
+        self.assertEqual(cache.get("key", 3), build_result())
+        # The results of other model versions are not returned
+        self.assertIsNone(cache.get("key", 4))
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+        self.assertAlmostEqual(stats["hit_rate"], 1 / 3)
+
+    def test_least_recently_used_result_is_evicted(self):
+        cache = ResultCache(max_entries=2)
+        cache.put("first", 3, build_result())
+        cache.put("second", 3, build_result())
+
+        # Using the first result makes the second one the least recently used
+        cache.get("first", 3)
+        cache.put("third", 3, build_result())
+
+        self.assertIsNotNone(cache.get("first", 3))
+        self.assertIsNone(cache.get("second", 3))
+        self.assertIsNotNone(cache.get("third", 3))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_size_limit(self):
+        result_size = len(build_result("a" * 1000)["heatmap_base64"])
+        cache = ResultCache(max_entries=10, max_bytes=int(result_size * 2.5))
+
+        for key in ("first", "second", "third"):
+            cache.put(key, 3, build_result("a" * 1000))
+
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        self.assertIsNone(cache.get("first", 3))
+
+    def test_disabled_cache(self):
+        cache = ResultCache(max_entries=0)
+        cache.put("key", 3, build_result())
+        self.assertIsNone(cache.get("key", 3))
+
+    def test_content_key(self):
+        key = content_key(self.image, 25, "male", "face")
+
+        self.assertEqual(key, content_key(self.image.copy(), 25, "male", "face"))
+        # A different image or tabular feature gives a different key
+        self.assertNotEqual(key, content_key(self.image, 25, "male", "back"))
+        self.assertNotEqual(key, content_key(self.image, 26, "male", "face"))
+        self.assertNotEqual(key, content_key(255 - self.image, 25, "male", "face"))
+
+    def test_model_reload_clears_cache(self):
+        cache = ResultCache(max_entries=4)
+        cache.put("key", 3, build_result())
+
+        with patch(
+            "application.predictions.prediction_manager.RESULT_CACHE", cache
+        ), patch("application.predictions.prediction_manager.model_reload_event"):
+            signal_model_reload()
+
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    ############################### INTEGRATION TESTS ###############################
+
+    def test_cached_result_skips_queue(self):
+        """Test that a resubmitted image is answered from the cache without queueing it"""
+        self.client.force_login(self.test_user)
+
+        cache = ResultCache(max_entries=4)
+        cache.put(content_key(self.image, 25, "male", "face"), 3, build_result())
+
+        with patch("application.views.create_request.RESULT_CACHE", cache), patch(
+            "application.views.create_request.get_serving_model_version",
+            return_value=3,
+        ), patch("application.views.create_request.PREDICTION_JOBS.put") as mock_put:
+            response = self.client.post(
+                reverse("api-create-request"),
+                json.dumps(
+                    {
+                        "localization": "face",
+                        "image": base64.b64encode(self.image_data).decode("utf-8"),
+                    }
+                ),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 201)
+        mock_put.assert_not_called()
+
+        request = Requests.objects.get(request_id=response.json()["request_id"])
+        self.assertEqual(request.status, "explained")
+        self.assertEqual(request.lesion_type, "mel")
+        self.assertEqual(request.model, 3)
+        self.assertEqual(request.heatmap_base64, "aGVhdG1hcA==")
+        self.assertEqual(bytes(request.image), self.image_data)
+
+    def test_cache_miss_queues_job_with_content_key(self):
+        """Test that the job of a new image carries its content key"""
+        self.client.force_login(self.test_user)
+
+        with patch(
+            "application.views.create_request.RESULT_CACHE", ResultCache(max_entries=4)
+        ), patch("application.views.create_request.PREDICTION_JOBS.put") as mock_put:
+            response = self.client.post(
+                reverse("api-create-request"),
+                json.dumps(
+                    {
+                        "localization": "face",
+                        "image": base64.b64encode(self.image_data).decode("utf-8"),
+                    }
+                ),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 201)
+        job = mock_put.call_args[0][0]
+        self.assertEqual(job.content_key, content_key(self.image, 25, "male", "face"))
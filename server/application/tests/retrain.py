@@ -6,6 +6,10 @@ from ..models import Users
 import json
 from django.contrib.auth.hashers import make_password
 import time
+from queue import Queue
+from unittest.mock import MagicMock, patch
+from ..views.jobs.job import Job
+from ..views.jobs.training_process import run_training, relay_training_status
 
 
 class RetrainTests(TestCase):
@@ -114,6 +118,43 @@ class RetrainTests(TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json()["err"], "Missing fields")
 
+    def test_run_training_reports_status(self):
+        """Test that the training process sets its CPUs and reports the status of train"""
+        status_queue = Queue()
+
+        def train(job, **kwargs):
+            job.status = "Training model"
+
+        module = "application.views.jobs.training_process"
+        with patch("application.mlsym.train.train", train), patch(
+            f"{module}.set_thread_affinity"
+        ) as mock_affinity, patch(f"{module}.lower_thread_priority") as mock_priority:
+            run_training({"job": "job-id"}, status_queue, "4-7", 10)
+
+        mock_affinity.assert_called_once_with("4-7")
+        mock_priority.assert_called_once_with(10)
+        self.assertEqual(status_queue.get_nowait(), ("status", "Training model"))
+        self.assertEqual(status_queue.get_nowait(), ("completed", None))
+
+    def test_relay_training_status(self):
+        """Test that the job follows the status of the training process"""
+        job = Job("job-id", int(time.time()), {})
+        status_queue = Queue()
+        for message in [("status", "Training model"), ("failed", "Out of memory")]:
+            status_queue.put(message)
+
+        relay_training_status(job, MagicMock(), status_queue)
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.error, "Out of memory")
+
+        # A process that exits without a result fails the job
+        job = Job("job-id", int(time.time()), {})
+        process = MagicMock(exitcode=-9)
+        process.is_alive.return_value = False
+        relay_training_status(job, process, Queue(), poll_interval=0.01)
+        self.assertEqual(job.status, "failed")
+        self.assertIn("-9", job.error)
+
     def test_post_success(self):
         """Test successful training job creation and completion"""
         self.login_admin()
@@ -38,6 +38,8 @@ from .views.models.delete_model import DeleteModel
 from .views.get_all_requests import GetAllRequests
 from .views.get_all_users import GetAllUsers
 from .views.jobs.retrain import Retrain
+from .views.jobs.prediction_queue import PredictionQueue
+from .views.jobs.metrics import PredictionMetrics
 from .views.is_logged_in import IsLoggedIn
 from .views.logout import Logout
 from .views.is_admin import IsAdmin
@@ -67,6 +69,8 @@ urlpatterns = [
     path("get-all-requests/", GetAllRequests.as_view(), name="api-get-all-requests"),
     path("get-all-users/", GetAllUsers.as_view(), name="api-get-all-users"),
     path("retrain/", Retrain.as_view(), name="api-retrain-model"),
+    path("prediction-queue/", PredictionQueue.as_view(), name="api-prediction-queue"),
+    path("metrics/", PredictionMetrics.as_view(), name="api-metrics"),
     path("is_logged_in/", IsLoggedIn.as_view(), name="api-is-logged-in"),
     path("logout/", Logout.as_view(), name="api-logout"),
     path("is_admin/", IsAdmin.as_view(), name="api-is-admin"),
@@ -5,17 +5,45 @@
 # * Contributor: <alexandersafstrom@proton.me>
 import time
 import base64
+from queue import Full
 import numpy as np
 from django.http import JsonResponse
 from django.views import View
 from django.db import transaction, DatabaseError
 from ..models import Users, Requests
 from ..decorators import login_required, load_json
-from .jobs.state import PREDICTION_JOBS, MGR_INIT
+from .jobs.state import (
+    PREDICTION_JOBS,
+    EXPLANATION_JOBS,
+    PREDICTION_ADMISSION,
+    RESULT_CACHE,
+    MGR_INIT,
+    uses_database_queue,
+    get_prediction_queue_depth,
+)
 from .jobs.job import Job
 from io import BytesIO
 from PIL import Image
-from application.predictions.prediction_manager import start_prediction_manager
+from application.predictions.prediction_manager import (
+    start_prediction_manager,
+    get_serving_input_shape,
+    get_serving_model_version,
+)
+from application.predictions.preprocess_user_data import (
+    resize_for_queue,
+    validate_image,
+    validate_tabular_features,
+)
+from application.predictions.result_cache import content_key
+
+
+def service_unavailable(retry_after):
+    """Returns a 503 response that tells the client when to retry."""
+    response = JsonResponse(
+        {"err": "The server is busy. Please try again later."}, status=503
+    )
+    response["Retry-After"] = str(retry_after)
+    return response
 
 
 def fix_base64_padding(base64_str):
@@ -33,7 +61,9 @@ class CreateRequest(View):
         global MGR_INIT
         global PREDICTION_JOBS
 
-        if not MGR_INIT:
+        # The prediction manager runs in this process, unless standalone workers
+        # process the requests in the database
+        if not MGR_INIT and not uses_database_queue():
             start_prediction_manager()
             MGR_INIT = True
 
@@ -84,12 +114,61 @@ class CreateRequest(View):
                 {"err": "Image must have 3 colour channels (RGB)."}, status=400
             )
 
+        # Reject malformed inputs here, so that they never reach a prediction batch
+        image_error = validate_image(image_array)
+        if image_error:
+            return JsonResponse({"err": image_error}, status=400)
+
         # Get the corresponding user from the database
         user = Users.objects.get(username=request.user.username)
 
+        tabular_error = validate_tabular_features(user.age, user.sex, localization)
+        if tabular_error:
+            return JsonResponse({"err": tabular_error}, status=400)
+
         # Get current time of creating request
         created_at = int(time.time())
 
+        # Look up the result of the same image and tabular features that was explained
+        # by the served model. The results are cached by the prediction manager of
+        # this process, so there are none with the database queue
+        request_key = None
+        cached_result = None
+        if RESULT_CACHE.max_entries and not uses_database_queue():
+            request_key = content_key(image_array, user.age, user.sex, localization)
+            cached_result = RESULT_CACHE.get(request_key, get_serving_model_version())
+
+        # Store the cached result right away without queueing the request
+        if cached_result is not None:
+            try:
+                new_request = Requests.objects.create(
+                    created_at=created_at,
+                    image=image_data,
+                    localization=localization,
+                    user=user,
+                    status="explained",
+                    **cached_result,
+                )
+            except DatabaseError as e:
+                return JsonResponse({"err": str(e)}, status=500)
+
+            return JsonResponse(
+                {
+                    "msg": "Request created successfully! Results ready.",
+                    "request_id": new_request.request_id,
+                },
+                status=201,
+            )
+
+        # Reject the request if the queue is full or the estimated wait is too long
+        queue_depth = get_prediction_queue_depth()
+        admitted, retry_after = PREDICTION_ADMISSION.admit(
+            queue_depth, EXPLANATION_JOBS.qsize()
+        )
+        if not admitted:
+            print(f"Prediction request rejected, queue depth: {queue_depth}")
+            return service_unavailable(retry_after)
+
         # Insert new request into database
         try:
             # Treat insertion as atomic, i.e. rollback if there are any exceptions
@@ -110,6 +189,20 @@ class CreateRequest(View):
 
             return JsonResponse({"err": str(e)}, status=500)
 
+        # The pending request is picked up by a prediction worker
+        if uses_database_queue():
+            return JsonResponse(
+                {
+                    "msg": "Request created successfully! Results pending.",
+                    "request_id": request_id,
+                },
+                status=201,
+            )
+
+        # Only keep the image at the input size of the served model on the job,
+        # the original image is stored in the database
+        image_array = resize_for_queue(image_array, get_serving_input_shape())
+
         # Wrap all relevant request parameters in an object
         parameters = {
             "request_id": request_id,
@@ -121,7 +214,18 @@ class CreateRequest(View):
 
         # Create new Job and add it to the global queue
         job = Job(job_id=request_id, start_time=created_at, parameters=parameters)
-        PREDICTION_JOBS.put(job)
+        # The result of the job is cached under the content of the request
+        job.content_key = request_key
+        try:
+            PREDICTION_JOBS.put(job, block=False)
+        except Full:
+            # The queue filled up since the admission check, remove the request again
+            new_request.delete()
+            return service_unavailable(
+                PREDICTION_ADMISSION.reject(
+                    PREDICTION_JOBS.qsize(), EXPLANATION_JOBS.qsize()
+                )
+            )
         return JsonResponse(
             {
                 "msg": "Request created successfully! Results pending.",
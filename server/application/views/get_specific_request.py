@@ -8,6 +8,8 @@ from django.http import JsonResponse
 from django.views import View
 from ..decorators import login_required
 from ..models import Requests
+from .jobs.state import uses_database_queue
+from application.predictions.prediction_manager import start_prediction_manager
 
 
 class GetSpecificRequest(View):
@@ -27,12 +29,32 @@ class GetSpecificRequest(View):
             ):
                 return JsonResponse({"err": "Access denied."}, status=403)
 
-            # Encode the visualized image as base64
-            pixel_impact_visualized = (
-                base64.b64encode(specific_request.heatmap).decode("utf-8")
-                if specific_request.heatmap
-                else None
-            )
+            # The prediction manager of this process recovers the unfinished requests
+            # after a restart, so make sure it runs while the client waits for results
+            if (
+                specific_request.status
+                in (
+                    "pending",
+                    "processing",
+                    "classified",
+                )
+                and not uses_database_queue()
+            ):
+                start_prediction_manager()
+
+            # Serve the visualized image that was base64 encoded when it was stored
+            if specific_request.heatmap_base64:
+                pixel_impact_visualized = specific_request.heatmap_base64
+                pixel_impact_format = specific_request.heatmap_format
+            # Older requests only have the binary PNG heatmap
+            elif specific_request.heatmap:
+                pixel_impact_visualized = base64.b64encode(
+                    specific_request.heatmap
+                ).decode("utf-8")
+                pixel_impact_format = "image/png"
+            else:
+                pixel_impact_visualized = None
+                pixel_impact_format = None
 
             # Map lesion type values to their corresponding display names
             def get_lesion_display(lesion_type):
@@ -54,6 +76,13 @@ class GetSpecificRequest(View):
                 ),
                 "feature_impact": specific_request.feature_impact,
                 "pixel_impact_visualized": pixel_impact_visualized,
+                # MIME type of the visualized image (e.g. image/webp)
+                "pixel_impact_format": pixel_impact_format,
+                # Raw Grad-CAM grid (JSON) if it is stored
+                "cam_grid": specific_request.cam_grid,
+                # Stage of the prediction pipeline: pending, processing, classified,
+                # explained or failed
+                "stage": specific_request.status,
             }
 
             return JsonResponse({"request": request_data}, status=200)
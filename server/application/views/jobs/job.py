@@ -1,5 +1,8 @@
 # Contributors:
 # * Contributor: <alexandersafstrom@proton.me>
+import time
+
+
 class Job:
     # Initialize a Job object
     def __init__(self, job_id, start_time, parameters):
@@ -8,6 +11,8 @@ class Job:
         self.parameters = parameters
         self.status = "running"
         self.error = None
+        # Time when the job was queued, used to measure how long it waits
+        self.queued_at = time.time()
 
     # Convert TrainingJob object to dictionary
     def to_dict(self):
@@ -0,0 +1,65 @@
+from django.http import HttpResponse
+from django.views import View
+from ...decorators import admin_only
+from .state import (
+    EXPLANATION_JOBS,
+    PIPELINE_METRICS,
+    PREDICTION_ADMISSION,
+    RESULT_CACHE,
+    get_prediction_queue_depth,
+)
+
+
+class PredictionMetrics(View):
+    @admin_only
+    # Returns the metrics of the prediction pipeline in the Prometheus text format
+    def get(self, request):
+        cache_stats = RESULT_CACHE.stats()
+        gauges = {
+            "skinscan_prediction_queue_depth": (
+                "Number of jobs waiting to be classified.",
+                get_prediction_queue_depth(),
+            ),
+            "skinscan_explanation_queue_depth": (
+                "Number of classified jobs waiting to be explained.",
+                EXPLANATION_JOBS.qsize(),
+            ),
+            "skinscan_prediction_throughput_jobs_per_second": (
+                "Smoothed number of jobs classified per second.",
+                PREDICTION_ADMISSION.throughput,
+            ),
+            "skinscan_explanation_throughput_jobs_per_second": (
+                "Smoothed number of jobs explained per second.",
+                PREDICTION_ADMISSION.explanation_throughput,
+            ),
+            "skinscan_result_cache_entries": (
+                "Number of cached results.",
+                cache_stats["entries"],
+            ),
+            "skinscan_result_cache_bytes": (
+                "Approximate size of the cached results in bytes.",
+                cache_stats["bytes"],
+            ),
+            "skinscan_result_cache_hit_rate": (
+                "Share of the cache lookups that found a result.",
+                cache_stats["hit_rate"],
+            ),
+        }
+        counters = {
+            "skinscan_result_cache_hits_total": (
+                "Number of requests answered from the result cache.",
+                cache_stats["hits"],
+            ),
+            "skinscan_result_cache_misses_total": (
+                "Number of requests that were not found in the result cache.",
+                cache_stats["misses"],
+            ),
+            "skinscan_result_cache_evictions_total": (
+                "Number of results evicted from the result cache.",
+                cache_stats["evictions"],
+            ),
+        }
+        return HttpResponse(
+            PIPELINE_METRICS.render(gauges, counters),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
@@ -0,0 +1,15 @@
+from django.http import JsonResponse
+from django.views import View
+from ...decorators import admin_only
+from .state import EXPLANATION_JOBS, PREDICTION_ADMISSION, get_prediction_queue_depth
+
+
+class PredictionQueue(View):
+    @admin_only
+    # Returns the depth of the prediction queues and the admission statistics
+    def get(self, request):
+        # Explanations are computed by the worker processes with the database queue
+        stats = PREDICTION_ADMISSION.stats(
+            get_prediction_queue_depth(), EXPLANATION_JOBS.qsize()
+        )
+        return JsonResponse({"prediction_queue": stats}, status=200)
@@ -1,6 +1,8 @@
 # Contributors:
 # * Contributor: <alexandersafstrom@proton.me>
 from django.http import JsonResponse
+from django.conf import settings
+import multiprocessing
 import threading
 import time
 import uuid
@@ -9,6 +11,7 @@ from ...mlsym.train import train
 from django.views import View
 from inspect import signature
 from .job import Job
+from .training_process import run_training, relay_training_status
 
 train_sig = signature(train)
 
@@ -18,19 +21,33 @@ TRAINING_JOBS = []
 
 # Wrapper function to train the model
 def train_wrapper(job, train_args):
+    # The thread pools of TensorFlow are shared by all threads of a process, so
+    # training runs in a separate process that can be kept off the CPUs of the
+    # prediction threads and yields to the server process when the CPUs are busy.
+    # The process is spawned, as TensorFlow does not support forking
+    context = multiprocessing.get_context("spawn")
+    status_queue = context.Queue()
+    process = context.Process(
+        target=run_training,
+        args=(
+            train_args,
+            status_queue,
+            getattr(settings, "TRAINING_CPU_AFFINITY", None),
+            getattr(settings, "TRAINING_THREAD_NICENESS", 0),
+        ),
+        daemon=True,
+    )
+
     try:
-        # Train the model with the given arguments
-        modified_args = {
-            **train_args,  # Unpack all original arguments
-            "job": job,  # Add the job container
-        }
-        train(**modified_args)
-        # Update job status to completed when training is done
-        job.status = "completed"
+        process.start()
     except Exception as e:
         # If an error occurs, update job status to failed and store the error message
         job.status = "failed"
         job.error = str(e)
+        return
+
+    # Update the job with the status of the training process until it is done
+    relay_training_status(job, process, status_queue)
 
 
 class Retrain(View):
@@ -5,10 +5,47 @@
 import time
 import threading
 from queue import Queue
+from django.conf import settings
 from .job import Job
+from application.models import Requests
+from application.predictions.admission import AdmissionController
+from application.predictions.metrics import PipelineMetrics
+from application.predictions.result_cache import ResultCache
 
 # Global queue to store prediction jobs
 # Using the built in Queue class ensures thread safety
 # Docs: https://docs.python.org/3/library/queue.html#queue.Queue
-PREDICTION_JOBS = Queue()
+# The queue is bounded, as every job holds a decoded image
+PREDICTION_JOBS = Queue(maxsize=getattr(settings, "PREDICTION_MAX_QUEUE_DEPTH", 0))
+# Admission control of new prediction jobs based on the queue depth and throughput
+PREDICTION_ADMISSION = AdmissionController(
+    getattr(settings, "PREDICTION_MAX_QUEUE_DEPTH", 0),
+    getattr(settings, "PREDICTION_MAX_QUEUE_WAIT", 0),
+)
+# Queue of classified jobs that are waiting for their explanation
+# The queue is bounded as well, as every job holds its resized image until it is
+# explained. When it is full, the classification waits for the explanation stage
+EXPLANATION_JOBS = Queue(
+    maxsize=getattr(settings, "PREDICTION_MAX_EXPLANATION_QUEUE_DEPTH", 0)
+)
+# Latency of the stages of the prediction pipeline of this process
+PIPELINE_METRICS = PipelineMetrics()
+# Results of explained requests, used to answer resubmitted images right away
+RESULT_CACHE = ResultCache(
+    getattr(settings, "PREDICTION_RESULT_CACHE_SIZE", 0),
+    getattr(settings, "PREDICTION_RESULT_CACHE_MAX_BYTES", 0),
+)
 MGR_INIT = False
+
+
+def uses_database_queue():
+    """Returns True if the prediction jobs are processed by standalone workers."""
+    return getattr(settings, "PREDICTION_QUEUE_BACKEND", "memory") == "database"
+
+
+def get_prediction_queue_depth():
+    """Returns the number of prediction jobs that are waiting to be processed."""
+    if uses_database_queue():
+        # The pending requests in the database are the queue
+        return Requests.objects.filter(status="pending").count()
+    return PREDICTION_JOBS.qsize()
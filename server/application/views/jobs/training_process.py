@@ -0,0 +1,70 @@
+import queue
+from ...predictions.resources import set_thread_affinity, lower_thread_priority
+
+# This module is the entry point of the training process, so it must not
+# import any Django modules, which are not set up in that process
+
+
+class TrainingStatus:
+    """Status container of `train` that sends the status updates to the server process."""
+
+    def __init__(self, status_queue):
+        self._status_queue = status_queue
+        self._status = None
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = status
+        self._status_queue.put(("status", status))
+
+
+def run_training(train_args, status_queue, cpu_affinity=None, niceness=0):
+    """
+    Trains a model in a separate process. The affinity and the niceness are set
+    before TensorFlow creates its thread pools, so that the pools of the training
+    inherit them, rather than those of the prediction threads of the server.
+    """
+
+    set_thread_affinity(cpu_affinity)
+    lower_thread_priority(niceness)
+
+    try:
+        from ...mlsym.train import train
+
+        train(**{**train_args, "job": TrainingStatus(status_queue)})
+        status_queue.put(("completed", None))
+    except Exception as e:
+        status_queue.put(("failed", str(e)))
+
+
+def relay_training_status(job, process, status_queue, poll_interval=1):
+    """
+    Updates the job with the status updates of a training process until it exits.
+    """
+
+    while True:
+        try:
+            kind, value = status_queue.get(timeout=poll_interval)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+            # The process exited without reporting a result, e.g. it was killed
+            job.status = "failed"
+            job.error = f"Training process exited with code {process.exitcode}"
+            return
+
+        if kind == "status":
+            job.status = value
+        elif kind == "completed":
+            job.status = "completed"
+            break
+        else:
+            job.status = "failed"
+            job.error = value
+            break
+
+    process.join()
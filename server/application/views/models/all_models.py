@@ -12,7 +12,8 @@ class GetAllModels(View):
     def get(self, request):
 
         # retrieve all models in the database
-        models = Model.objects.all()
+        # (without loading the serialized weights, which are not returned)
+        models = Model.objects.defer("weights", "onnx_model")
 
         models_data = [
             {
@@ -100,6 +100,100 @@ IMAGE_DB_MODELS = [
     "data",
 ]
 
+# Prediction manager settings
+# Queue of the prediction jobs:
+# - "memory": the jobs are processed by a thread of the (single) web server process,
+#   which is started by the first created or polled request. The unfinished requests
+#   of a previous run are only recovered from then on
+# - "database": the pending requests in the database are processed by standalone
+#   worker processes (python manage.py run_prediction_worker)
+PREDICTION_QUEUE_BACKEND = os.getenv("PREDICTION_QUEUE_BACKEND", "memory")
+# Maximum number of jobs that are coalesced into a single prediction batch
+PREDICTION_MAX_BATCH_SIZE = int(os.getenv("PREDICTION_MAX_BATCH_SIZE", 64))
+# Maximum time (in seconds) to wait for more jobs once the first job of a batch has arrived
+PREDICTION_MAX_BATCH_WAIT = float(os.getenv("PREDICTION_MAX_BATCH_WAIT", 0.05))
+# Batch sizes that the compiled inference functions are traced for when a model is loaded
+# Batches are padded up to the nearest size, larger batches are processed in chunks
+PREDICTION_BATCH_BUCKETS = (1, 4, 16, 64)
+# Maximum number of queued prediction jobs before new requests are rejected (0 disables the limit)
+PREDICTION_MAX_QUEUE_DEPTH = int(os.getenv("PREDICTION_MAX_QUEUE_DEPTH", 256))
+# Maximum number of classified jobs waiting for their explanation (0 disables the limit)
+# The classification is held back while the explanation queue is full
+PREDICTION_MAX_EXPLANATION_QUEUE_DEPTH = int(
+    os.getenv("PREDICTION_MAX_EXPLANATION_QUEUE_DEPTH", 256)
+)
+# Maximum estimated wait (in seconds) before new requests are rejected (0 disables the limit)
+# Only used with the "memory" queue backend, as the throughput is measured by the workers
+PREDICTION_MAX_QUEUE_WAIT = float(os.getenv("PREDICTION_MAX_QUEUE_WAIT", 60))
+# Time (in seconds) after which a request claimed by a worker that has not been explained
+# is claimed again, e.g. when the worker crashed while processing it
+PREDICTION_JOB_LEASE_TIME = int(os.getenv("PREDICTION_JOB_LEASE_TIME", 300))
+# Backend that classifies the batches:
+# - "tensorflow": the float model
+# - "tflite": a quantized TFLite conversion of the model, made when the model is loaded
+# - "onnx": the ONNX export of the model, run with ONNX Runtime (requires onnxruntime)
+# The explanations are always computed with the float model
+PREDICTION_INFERENCE_BACKEND = os.getenv("PREDICTION_INFERENCE_BACKEND", "tensorflow")
+# Quantization of the TFLite model (dynamic, float16 or int8)
+PREDICTION_TFLITE_QUANTIZATION = os.getenv("PREDICTION_TFLITE_QUANTIZATION", "dynamic")
+# Number of stored images used to calibrate the backend and check its drift
+PREDICTION_BACKEND_CALIBRATION_SAMPLES = int(
+    os.getenv("PREDICTION_BACKEND_CALIBRATION_SAMPLES", 64)
+)
+# Minimum top-1 agreement with the float model, the float model is served otherwise
+PREDICTION_BACKEND_MIN_AGREEMENT = float(
+    os.getenv("PREDICTION_BACKEND_MIN_AGREEMENT", 0.95)
+)
+# Number of threads of the backend (the runtime decides if not set)
+PREDICTION_BACKEND_NUM_THREADS = (
+    int(os.getenv("PREDICTION_BACKEND_NUM_THREADS"))
+    if os.getenv("PREDICTION_BACKEND_NUM_THREADS")
+    else None
+)
+# Threads of the TensorFlow intra-op (parallel kernels of one operation) and inter-op
+# (independent operations) pools of the prediction process, TensorFlow uses one thread
+# per core for each pool if not set
+PREDICTION_INTRA_OP_THREADS = (
+    int(os.getenv("PREDICTION_INTRA_OP_THREADS"))
+    if os.getenv("PREDICTION_INTRA_OP_THREADS")
+    else None
+)
+PREDICTION_INTER_OP_THREADS = (
+    int(os.getenv("PREDICTION_INTER_OP_THREADS"))
+    if os.getenv("PREDICTION_INTER_OP_THREADS")
+    else None
+)
+# Threads that preprocess the images of a batch (the default of ThreadPoolExecutor if not set)
+PREDICTION_PREPROCESS_THREADS = (
+    int(os.getenv("PREDICTION_PREPROCESS_THREADS"))
+    if os.getenv("PREDICTION_PREPROCESS_THREADS")
+    else None
+)
+# CPUs of the prediction threads, in the format of taskset (e.g. "0-3"), all CPUs if not set
+PREDICTION_CPU_AFFINITY = os.getenv("PREDICTION_CPU_AFFINITY")
+# CPUs of the training process started by a retrain request (e.g. "4-7"), all CPUs if not set
+TRAINING_CPU_AFFINITY = os.getenv("TRAINING_CPU_AFFINITY")
+# Niceness that is added to the training process, so that serving is preferred (0 disables it)
+TRAINING_THREAD_NICENESS = int(os.getenv("TRAINING_THREAD_NICENESS", 10))
+# Maximum number of explained results that are cached for resubmitted images (0 disables the cache)
+PREDICTION_RESULT_CACHE_SIZE = int(os.getenv("PREDICTION_RESULT_CACHE_SIZE", 1024))
+# Maximum total size (in bytes) of the cached results
+PREDICTION_RESULT_CACHE_MAX_BYTES = int(
+    os.getenv("PREDICTION_RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+# Image format of the stored heatmap overlays (png, webp or jpeg)
+PREDICTION_HEATMAP_FORMAT = os.getenv("PREDICTION_HEATMAP_FORMAT", "webp")
+# Quality (0-100) of the lossy heatmap formats
+PREDICTION_HEATMAP_QUALITY = int(os.getenv("PREDICTION_HEATMAP_QUALITY", 90))
+# Size (in pixels) of the stored heatmap overlays, the model input size is used if not set
+PREDICTION_HEATMAP_SIZE = (
+    int(os.getenv("PREDICTION_HEATMAP_SIZE"))
+    if os.getenv("PREDICTION_HEATMAP_SIZE")
+    else None
+)
+# Store the raw Grad-CAM grid, so that clients can render the overlay themselves
+PREDICTION_STORE_CAM_GRID = os.getenv("PREDICTION_STORE_CAM_GRID") == "True"
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {